@@ -0,0 +1,229 @@
+import math
+import logging
+import numpy as np
+from gcode import Command
+from const import *
+
+LOGGER = logging.getLogger(__name__)
+
+MIN_ARC_POINTS = 4  # arc end points replaced by a single G2/G3, not counting the start
+MAX_ARC_POINTS = 512
+MAX_ARC_RADIUS = 2000  # above this the run is as good as straight, leave it as G1
+MAX_ARC_SWEEP = 1.5 * math.pi
+
+
+def fitArcs(
+    commands: "list[Command]",
+    tolerance=ARC_FIT_TOLERANCE,
+    minPoints=MIN_ARC_POINTS,
+    maxPoints=MAX_ARC_POINTS,
+) -> "list[Command]":
+    """
+    Replace runs of G1 points that lie on a circle with G2/G3 arcs.
+    Z is interpolated linearly along the arc (a helical move), and the
+    arc is only used if every original point and every original segment
+    is within tolerance of it. A run only covers consecutive commands with
+    the same flags, so arcs never span a stroke and a pot or holder macro.
+
+    The start of an arc is the point before it, so the first command of
+    the list is never replaced.
+    The feed of an arc is the length weighted harmonic mean of the feeds
+    it replaces, so the arc takes the same time as the segments did.
+    """
+    n = len(commands)
+    if n < minPoints + 1:
+        return commands
+    fittable = np.fromiter(
+        (
+            c.commandType == "G1"
+            and c.x is not None
+            and c.y is not None
+            and c.z is not None
+            and c.f is not None
+            for c in commands
+        ),
+        bool,
+        n,
+    )
+    flags = np.fromiter((c.flagBits for c in commands), np.int64, n)
+    nan = float("nan")
+    xyz = np.array(
+        [
+            (c.x, c.y, c.z, c.f) if ok else (nan,) * 4
+            for c, ok in zip(commands, fittable)
+        ],
+        dtype=np.float64,
+    ).reshape(n, 4)
+
+    candidates = _candidateStarts(xyz, fittable, flags, minPoints)
+    new = [commands[0]]
+    s = 0
+    while s < n - 1:
+        e = None
+        if candidates[s]:
+            e = _longestArc(xyz, fittable, flags, s, tolerance, minPoints, maxPoints)
+        if e is None:
+            new.append(commands[s + 1])
+            s += 1
+            continue
+        new.append(_arcCommand(commands, xyz, s, e))
+        s = e
+
+    removed = n - len(new)
+    if removed:
+        LOGGER.info(f"Arc fitting removed {removed} of {n} lines")
+    return new
+
+
+def _candidateStarts(xyz, fittable, flags, minPoints):
+    """
+    Cheap vectorized filter for the points an arc could start at: the next
+    minPoints points are fittable, have the same flags, and all turn the
+    same way. Only these are passed to the exact fit.
+    """
+    n = len(xyz)
+    candidates = np.zeros(n, bool)
+    if n <= minPoints:
+        return candidates
+    d = np.diff(xyz[:, :2], axis=0)
+    cross = d[:-1, 0] * d[1:, 1] - d[:-1, 1] * d[1:, 0]
+    # turn direction at each interior point 1..n-2, NaN compares False
+    left = np.concatenate(([0], np.cumsum(cross > 1e-12)))
+    right = np.concatenate(([0], np.cumsum(cross < -1e-12)))
+    good = fittable.copy()
+    good[1:] &= flags[1:] == flags[:-1]
+    goodCount = np.concatenate(([0], np.cumsum(good)))
+    s = np.arange(n - minPoints)
+    # points s..s+minPoints fittable, and flags unchanged from s to s+minPoints
+    runOk = (goodCount[s + minPoints + 1] - goodCount[s + 1] == minPoints) & fittable[s]
+    # interior points s+1..s+minPoints-1 are turns cross[s..s+minPoints-2]
+    turns = minPoints - 1
+    sameTurn = (left[s + turns] - left[s] == turns) | (
+        right[s + turns] - right[s] == turns
+    )
+    candidates[s] = runOk & sameTurn
+    return candidates
+
+
+def _longestArc(xyz, fittable, flags, s, tolerance, minPoints, maxPoints):
+    """
+    Index of the furthest point an arc starting at s can reach, or None
+    """
+    n = len(xyz)
+    first = s + minPoints
+    if _fit(xyz, s, first, tolerance) is None:
+        return None
+    # grow by doubling then binary search back to the last end that fits
+    good, step = first, minPoints
+    limit = min(n - 1, s + maxPoints)
+    while good < limit:
+        e = min(good + step, limit)
+        if not (
+            fittable[good : e + 1].all()
+            and (flags[good : e + 1] == flags[s]).all()
+            and _fit(xyz, s, e, tolerance) is not None
+        ):
+            break
+        good, step = e, step * 2
+    else:
+        return good
+    lo, hi = good, min(good + step, limit)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if (
+            fittable[lo : mid + 1].all()
+            and (flags[lo : mid + 1] == flags[s]).all()
+            and _fit(xyz, s, mid, tolerance) is not None
+        ):
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def _fit(xyz, s, e, tolerance):
+    """
+    Fit a circle through points s..e, returns (cx, cy, clockwise) or None
+    if the points are not on an arc within tolerance
+    """
+    pts = xyz[s : e + 1]
+    x, y, z = pts[:, 0], pts[:, 1], pts[:, 2]
+    m = (len(pts) - 1) // 2
+    center = _circleCenter(x[0], y[0], x[m], y[m], x[-1], y[-1])
+    if center is None:
+        return None
+    cx, cy = center
+    r = math.hypot(x[0] - cx, y[0] - cy)
+    if r > MAX_ARC_RADIUS:
+        return None
+    if np.abs(np.hypot(x - cx, y - cy) - r).max() > tolerance:
+        return None
+    theta = np.unwrap(np.arctan2(y - cy, x - cx))
+    dTheta = np.diff(theta)
+    if not ((dTheta > 0).all() or (dTheta < 0).all()):
+        return None
+    sweep = theta[-1] - theta[0]
+    if abs(sweep) > MAX_ARC_SWEEP:
+        return None
+    # the arc bulges away from each original chord by its sagitta
+    if (r * (1 - np.cos(dTheta / 2))).max() > tolerance:
+        return None
+    # helical, z must change linearly with the angle
+    zArc = z[0] + (z[-1] - z[0]) * (theta - theta[0]) / sweep
+    if np.abs(zArc - z).max() > tolerance:
+        return None
+    return cx, cy, sweep < 0
+
+
+def _circleCenter(x1, y1, x2, y2, x3, y3):
+    d = 2 * (x1 * (y2 - y3) + x2 * (y3 - y1) + x3 * (y1 - y2))
+    if abs(d) < 1e-9:
+        return None
+    s1, s2, s3 = x1**2 + y1**2, x2**2 + y2**2, x3**2 + y3**2
+    cx = (s1 * (y2 - y3) + s2 * (y3 - y1) + s3 * (y1 - y2)) / d
+    cy = (s1 * (x3 - x2) + s2 * (x1 - x3) + s3 * (x2 - x1)) / d
+    return cx, cy
+
+
+def _arcCommand(commands, xyz, s, e):
+    cx, cy, clockwise = _fit(xyz, s, e, math.inf)
+    start, end = commands[s], commands[e]
+    segments = np.diff(xyz[s : e + 1, :3], axis=0)
+    lengths = np.linalg.norm(segments, axis=1)
+    feeds = xyz[s + 1 : e + 1, 3]
+    if (feeds > 0).all() and lengths.sum() > 0:
+        feed = lengths.sum() / (lengths / feeds).sum()
+    else:
+        feed = feeds.min()
+    return Command(
+        x=end.x,
+        y=end.y,
+        z=end.z,
+        f=round(float(feed), 3),
+        flags=end.flagBits,
+        # in these coordinates, negated x and y on output keep the direction
+        command="G2" if clockwise else "G3",
+        i=float(cx - start.x),
+        j=float(cy - start.y),
+    )
+
+
+def arcExtremes(startX, startY, command: Command):
+    """
+    XY points reached by an arc beyond its end points, where it crosses
+    the axes through its center, used for bounds checks
+    """
+    cx, cy = startX + command.i, startY + command.j
+    r = math.hypot(command.i, command.j)
+    a0 = math.atan2(startY - cy, startX - cx)
+    a1 = math.atan2(command.y - cy, command.x - cx)
+    if command.commandType == "G2":
+        a0, a1 = a1, a0
+    # counter clockwise sweep from a0 to a1
+    sweep = (a1 - a0) % (2 * math.pi)
+    points = []
+    for k in range(4):
+        angle = k * math.pi / 2
+        if (angle - a0) % (2 * math.pi) <= sweep:
+            points.append((cx + r * math.cos(angle), cy + r * math.sin(angle)))
+    return points
@@ -0,0 +1,43 @@
+"""
+Benchmark the grid hash excludePointsWithin against the original per point
+cKDTree loop.
+Run from painter_code with: python -m benchmarks.benchCluster
+"""
+import json
+import timeit
+from pathlib import Path
+from gcode import GcodeMaker
+from preprocess import PreProcessors
+from benchmarks.benchParse import syntheticStroke
+
+ROOT = Path(__file__).parent.parent
+
+
+def bench(name, lines, repeat=5):
+    stroke = GcodeMaker().parseBulk(lines)
+    timings = {
+        "tree": lambda: PreProcessors.excludePointsWithin(
+            stroke, mode="tree"
+        ),
+        "grid": lambda: PreProcessors.excludePointsWithin(stroke, mode="grid"),
+    }
+    print(f"{name}: {len(stroke)} points")
+    base = None
+    for label, fn in timings.items():
+        best = min(timeit.repeat(fn, number=1, repeat=repeat))
+        base = base or best
+        print(
+            f"  {label:<26}{best * 1000:10.2f} ms {base / best:8.1f}x"
+            f" -> {len(fn())} points"
+        )
+
+
+def main():
+    with open(ROOT / "dummy_data/sample_brush_change.json") as f:
+        sample = json.load(f)
+    bench("sample_brush_change.json", sample["data"], repeat=50)
+    bench("synthetic stroke", syntheticStroke(100_000), repeat=3)
+
+
+if __name__ == "__main__":
+    main()
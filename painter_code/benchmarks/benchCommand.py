@@ -0,0 +1,88 @@
+"""
+Compare the memory use and flag test throughput of the slotted, bitmask
+flagged Command against the original dict based Command with a list of
+flag strings.
+Run from painter_code with: python -m benchmarks.benchCommand
+"""
+import timeit
+import tracemalloc
+from gcode import Command
+
+NUM_COMMANDS = 200_000
+
+
+class LegacyCommand:
+    """
+    The original Command layout: a __dict__ per instance and a list of flags
+    """
+
+    _autoinc = 0
+
+    def __init__(self, x=None, y=None, z=None, f=None, flags=None, command=None):
+        LegacyCommand._autoinc += 1
+        self.id = LegacyCommand._autoinc
+        self.x = x
+        self.y = y
+        self.z = z
+        self.f = f
+        self.flags = flags if isinstance(flags, list) else [flags] if flags else []
+        self.commandType = "G1" if command is None else command
+
+    def hasFlag(self, flag):
+        return flag in self.flags
+
+
+def makeJob(cls):
+    # mostly stroke points, with pot and brush change commands mixed in
+    commands = []
+    for i in range(NUM_COMMANDS):
+        if i % 50 == 0:
+            flags = ["required", "brushChange", "pickup", "required", "brushChange"]
+        elif i % 20 == 0:
+            flags = ["required", "paintPot", "scrape"]
+        else:
+            flags = ["contact"]
+        commands.append(cls(float(i), float(i), -58.0, 7200, flags=flags))
+    return commands
+
+
+def measureMemory(cls):
+    tracemalloc.start()
+    commands = makeJob(cls)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return commands, size
+
+
+def main():
+    print(f"{NUM_COMMANDS} commands")
+    results = {}
+    for label, cls in (("legacy", LegacyCommand), ("slotted", Command)):
+        commands, size = measureMemory(cls)
+        build = min(timeit.repeat(lambda: makeJob(cls), number=1, repeat=3))
+        lookup = min(
+            timeit.repeat(
+                lambda: [c for c in commands if c.hasFlag("contact")],
+                number=1,
+                repeat=5,
+            )
+        )
+        # a flag near the end of the list is the worst case for the list scan
+        lateFlag = min(
+            timeit.repeat(
+                lambda: [c for c in commands if c.hasFlag("drop")],
+                number=1,
+                repeat=5,
+            )
+        )
+        results[label] = (size, build, lookup, lateFlag)
+        print(
+            f"  {label:<8} memory {size / 1e6:7.2f} MB  build {build * 1000:7.1f} ms"
+            f"  filter contact {lookup * 1000:6.1f} ms  filter drop {lateFlag * 1000:6.1f} ms"
+        )
+    legacy, slotted = results["legacy"], results["slotted"]
+    print(f"  memory ratio {legacy[0] / slotted[0]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
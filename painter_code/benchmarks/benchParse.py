@@ -0,0 +1,98 @@
+"""
+Benchmark GcodeMaker's bulk parser against the line by line parser,
+after checking the shipped pressure tables against the linear formula.
+Run from painter_code with: python -m benchmarks.benchParse
+"""
+import json
+import timeit
+import numpy as np
+from pathlib import Path
+from gcode import GcodeMaker, Command
+from const import *
+
+ROOT = Path(__file__).parent.parent
+
+
+def legacyParse(streamData):
+    """
+    The original per-line GcodeMaker.parse loop, kept for comparison
+    """
+    maker = GcodeMaker()
+    commands = []
+    for line in streamData:
+        if line == "":
+            continue
+        data = line.split(" ")
+        x = float(data[0])
+        y = float(data[1])
+        z = maker.parsePressure(data[2])
+        f = min([int(float(data[3]) * 60), MAX_FEED_RATE])
+        commands.append(Command(x, y, z, f, flags=["contact"]))
+    return commands
+
+
+def syntheticStroke(numPoints, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 20 * np.pi, numPoints)
+    x = 400 + 300 * np.cos(t) * np.linspace(0.2, 1, numPoints)
+    y = 550 + 300 * np.sin(t) * np.linspace(0.2, 1, numPoints)
+    pressure = np.clip(0.4 + rng.normal(0, 0.1, numPoints), 0, 1)
+    speed = rng.uniform(0, 300, numPoints)
+    return [
+        f"{a:.3f} {b:.3f} {c:.3f} {d:.3f}" for a, b, c, d in zip(x, y, pressure, speed)
+    ]
+
+
+def bench(name, lines, repeat=5):
+    maker = GcodeMaker()
+    timings = {
+        "legacy loop": lambda: legacyParse(lines),
+        "parseBulk": lambda: maker.parseBulk(lines),
+        "parse (bulk + Commands)": lambda: maker.parse(lines),
+    }
+    print(f"{name}: {len(lines)} lines")
+    base = None
+    for label, fn in timings.items():
+        best = min(timeit.repeat(fn, number=1, repeat=repeat))
+        base = base or best
+        print(f"  {label:<26}{best * 1000:10.2f} ms {base / best:8.1f}x")
+
+    legacy = legacyParse(lines)
+    bulk = maker.parseBulk(lines).toCommands()
+    assert all(
+        str(a) == str(b) and a.flags == b.flags for a, b in zip(legacy, bulk)
+    ), "bulk parse does not match the legacy parser"
+
+
+def checkPressureTables(config=ROOT / "configs/pressureConfig.json"):
+    """
+    Check that every table in the shipped pressure config gives the same z
+    as the linear formula, from 0 to the pressure where the formula reaches
+    BED_MIN_Z and past it
+    """
+    with open(config) as f:
+        sizes = list(json.load(f))
+    maxPressure = BRUSH_TIP_Z_OFFSET - BED_MIN_Z
+    pressures = np.linspace(0, maxPressure + 1, 10_000)
+    expected = GcodeMaker().parsePressures(pressures)
+    for size in sizes:
+        table = GcodeMaker.loadPressureTable(
+            config, None if size == "default" else size
+        )
+        zs = GcodeMaker(table).parsePressures(pressures)
+        assert np.allclose(
+            zs, expected
+        ), f"pressure table {size} does not match the linear formula"
+    print(f"pressure tables {', '.join(sizes)} match the formula on [0, {maxPressure}]")
+
+
+def main():
+    checkPressureTables()
+    with open(ROOT / "dummy_data/sample_brush_change.json") as f:
+        sample = json.load(f)
+    bench("sample_brush_change.json", sample["data"], repeat=50)
+    bench("synthetic stroke", syntheticStroke(100_000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark streaming a compiled job to the GRBL simulator with the original
+line by line safeWrite loop against GrblStreamer's coalesced writes, for
+a few minWrite sizes. Writes are what would be syscalls and USB packets
+to the Arduino, machine and starved are the simulator's motion time and
+the time it sat waiting for lines.
+Run from painter_code with: python -m benchmarks.benchSerialWrite
+or with --time-scale to stream on the reader thread in simulated wall time.
+"""
+import argparse
+import logging
+import time
+from grblSim import GrblSim, SimSerial
+from session import GrblStreamer
+from serializer import encodeCommands
+from testStuff.dataCreators import CircleStack, Workload
+from benchmarks.pipeline import makeBackend
+from const import *
+
+MIN_WRITES = (1, 32, 64, 96)
+
+
+def legacySafeWrite(transport, c_line, data):
+    """
+    The original SerialSession.safeWrite loop, kept for comparison,
+    c_line is its list of the lengths of the lines GRBL hasn't answered
+    """
+    for line in data.splitlines():
+        l_block = line.strip()
+        c_line.append(len(l_block) + 1)
+        while sum(c_line) >= MAX_BUFFER_SIZE - 1 | transport.inWaiting():
+            out_temp = transport.readline().strip()
+            if out_temp.find(b"ok") >= 0 or out_temp.find(b"error") >= 0:
+                del c_line[0]
+        transport.write(l_block + b"\n")
+
+
+def compileJob(items):
+    """
+    The encoded chunks of items as the consumer sends them, one per stroke
+    """
+    backend = makeBackend()
+    return [encodeCommands(backend.run(item)) for item in items]
+
+
+def run(chunks, minWrite=None, timeScale=None):
+    """
+    Stream chunks to a fresh simulator, with legacySafeWrite if minWrite
+    is None, and wait for it to finish
+    """
+    transport = SimSerial(GrblSim(), timeScale=timeScale)
+    start = time.perf_counter()
+    if minWrite is None:
+        c_line = []
+        for chunk in chunks:
+            legacySafeWrite(transport, c_line, chunk)
+    else:
+        streamer = GrblStreamer(
+            transport, threaded=timeScale is not None, minWrite=minWrite
+        )
+        for chunk in chunks:
+            streamer.streamBuffer(chunk)
+        streamer.waitIdle()
+        streamer.stop()
+    wall = time.perf_counter() - start
+    transport.sim.drain()
+    report = transport.sim.report()
+    return transport.writes, wall, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--time-scale", type=float, default=None)
+    parser.add_argument("--strokes", type=int, default=0, help="add Workload strokes")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    items = CircleStack.create(6, 75, (300, 650))
+    for item in items:
+        item.update({"color": "1 0xff000000"})
+    # not color 6, pot 5's refills go past BED_MAX_X and fail checkLimits
+    workload = Workload(strokes=args.strokes, colors=dict.fromkeys(range(1, 6), 1))
+    items += [stroke for _, stroke in workload.messages()]
+    chunks = compileJob(items)
+    lines = sum(chunk.count(b"\n") for chunk in chunks)
+    clock = "virtual time" if args.time_scale is None else f"{args.time_scale}x"
+    print(f"{len(items)} strokes, {lines} lines, {clock}")
+
+    variants = {"legacy safeWrite": None}
+    variants.update({f"coalesced minWrite {m}": m for m in MIN_WRITES})
+    for label, minWrite in variants.items():
+        if minWrite is None and args.time_scale is not None:
+            # the legacy loop only reads when the buffer is full, no thread
+            continue
+        writes, wall, report = run(chunks, minWrite, args.time_scale)
+        print(
+            f"  {label:<24}{writes:7d} writes {lines / writes:6.2f} lines/write"
+            f"  wall {lines / wall:9.0f} lines/s"
+            f"  machine {report['simulatedSeconds']:7.1f} s"
+            f"  starved {report['starvedSeconds']:5.2f} s"
+            f"  overflows {report['overflows']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Benchmark Backend._handleStrokeLength, refill placement from an arc length
+prefix sum, against the original per command loop on a 50k point stroke.
+Run from painter_code with: python -m benchmarks.benchStrokeLength
+"""
+import logging
+import random
+import time
+from pathlib import Path
+from main import Backend
+from gcode import GcodeMaker, Command
+from benchmarks.benchParse import syntheticStroke
+
+ROOT = Path(__file__).parent.parent
+NUM_POINTS = 50_000
+
+
+def legacyHandleStrokeLength(self, commands: "list[Command]") -> "list[Command]":
+    """
+    The original Backend._handleStrokeLength, kept for comparison.
+    Add refills to the commands.
+    NOTE: the commands MUST be just those from the raw data, parsed by gcodeMaker.
+    Any commands added by adapters, or by this class, may be removed
+    """
+    # find the total length of the stroke
+    returnCommands = []
+
+    limit = self.hand.currentBrush.maxStrokeLength
+    total = 0
+    distVals = []
+    filtCommands = list(filter(lambda c: c.hasFlag("contact"), commands))
+    if self.tracker.length > limit:
+        self.log.info(f"Refill, reason = Leftover stroke length from previous stroke")
+        refillCommands = self.hand.currentBrush.refill(nextMove=filtCommands[0])
+        returnCommands.extend(refillCommands)
+        self.tracker.length = 0
+    total += self.tracker.length
+    hasStartRefill = False
+    self.log.info(f"Total length: {total}, limit: {limit}")
+    if not len(filtCommands) == len(commands):
+        self.log.warning("""_handleStrokeLength: commands removed by filtering,
+            commands passed to this function should not include anything
+            other than those produced by gcodeMaker""")
+
+    for i, command in enumerate(filtCommands[:-1]):
+        dist = command.distanceTo(filtCommands[i + 1])
+        distVals.append(dist)
+        total += dist
+
+    if (
+        limit * 0.9 < total < limit * 1.1 and returnCommands == []
+    ):  # check that returnCommands is empty
+        # (not added to by the self.tracker.length > limit block)
+        self.log.info("Refill, reason = Stroke length is within 10% of limit")
+        refillCommands = self.hand.currentBrush.refill(nextMove=filtCommands[0])
+
+        self.tracker.length = 0
+        returnCommands.extend(commands)
+        returnCommands.extend(refillCommands)
+        return returnCommands
+
+    elif total > limit:
+        for i, command in enumerate(filtCommands):
+            self.tracker.add(command)
+
+            if self.tracker.length > self.hand.currentBrush.maxStrokeLength:
+                # if the remaining stroke length is less that 25% of the max stroke length,
+                # just refill at the start of next stroke
+                if sum(distVals[i:]) < 0.25 * self.hand.currentBrush.maxStrokeLength:
+                    self.log.info(
+                        """Skipping Refill, reason = remainder of stroke exceeds
+                        max stroke length by less than 25%"""
+                    )
+                    # add the rest of the commands we havent iterated over
+                    for c in filtCommands[i:]:
+                        self.tracker.add(c)
+                    returnCommands.extend(filtCommands[i:])
+                    # dont reset tracker length, so will refill next stroke start
+                    return returnCommands
+                # if we exceed the max length within the first 25% of the stroke,
+                # refill at the start of the stroke
+                elif sum(distVals[:i]) < 0.25 * sum(distVals) and not hasStartRefill:
+                    self.log.info(
+                        """Refill, reason = refilling at start of stroke as stroke length
+                        exceeded within the first 25% of the stroke"""
+                    )
+                    # add the rest of the commands we havent iterated over
+                    returnCommands.append(command)
+                    refillCommands = self.hand.currentBrush.refill(nextMove=command)
+
+                    # add the refill commands to the start of returnCommands
+                    returnCommands = refillCommands + returnCommands
+                    self.tracker.length = 0
+                    hasStartRefill = True
+                # otherwise, simply add a refill step before the current command
+                else:
+                    self.log.info(
+                        f"""Refill, reason = Stroke length is over limit
+                        ({self.tracker.length} > {self.hand.currentBrush.maxStrokeLength})"""
+                    )
+                    returnCommands.append(command)
+                    refillCommands = self.hand.currentBrush.refill(nextMove=command)
+                    returnCommands.extend(refillCommands)
+                    self.tracker.length = 0
+
+            returnCommands.append(command)
+        return returnCommands
+    else:
+        return commands
+
+
+def makeBackend():
+    backend = Backend(
+        brushConfig=str(ROOT / "configs/brushConfig.json"),
+        holderConfig=str(ROOT / "configs/brushHolderConfig.json"),
+        serialSession=None,
+        # the legacy loop builds each refill, so the new one has to as well
+        useMacros=False,
+    )
+    backend.swapBrush(0, 0)
+    return backend
+
+
+def run(handle, commands):
+    """
+    Refill placement, final tracker length and seconds taken from a
+    fresh Backend, the Backend setup isn't timed
+    """
+    random.seed(0)
+    backend = makeBackend()
+    start = time.perf_counter()
+    placed = handle(backend, commands)
+    elapsed = time.perf_counter() - start
+    return [str(c) for c in placed], backend.tracker.length, elapsed
+
+
+def main():
+    # both log every refill
+    logging.disable(logging.INFO)
+    commands = GcodeMaker().parseBulk(syntheticStroke(NUM_POINTS)).toCommands()
+    timings = {
+        "legacy loop": legacyHandleStrokeLength,
+        "prefix sum": Backend._handleStrokeLength,
+    }
+    print(f"synthetic stroke: {len(commands)} points")
+    base = None
+    for label, handle in timings.items():
+        best = min(run(handle, commands)[2] for _ in range(3))
+        base = base or best
+        print(f"  {label:<26}{best * 1000:10.2f} ms {base / best:8.1f}x")
+
+    legacy, legacyLength, _ = run(legacyHandleStrokeLength, commands)
+    new, newLength, _ = run(Backend._handleStrokeLength, commands)
+    assert legacy == new, "refill placement differs from the legacy loop"
+    assert abs(legacyLength - newLength) < 1e-6, "tracker length differs"
+    print(f"  {len(new) - len(commands)} refill commands placed, identical")
+
+
+if __name__ == "__main__":
+    main()
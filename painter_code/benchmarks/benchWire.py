@@ -0,0 +1,71 @@
+"""
+Benchmark decoding a stroke message sent as the nested JSON envelope
+against the binary packed format in wire.py, both up to the parsed columns.
+Run from painter_code with: python -m benchmarks.benchWire
+"""
+import json
+import timeit
+import numpy as np
+from pathlib import Path
+from gcode import GcodeMaker
+from benchmarks.benchParse import syntheticStroke
+import wire
+
+ROOT = Path(__file__).parent.parent
+
+
+def jsonEnvelope(stroke):
+    """
+    The server's format, the point list and the stroke are each JSON
+    encoded again inside the envelope
+    """
+    inner = dict(stroke, data=json.dumps(stroke["data"]))
+    return json.dumps({"data": json.dumps(inner)})
+
+
+def bench(name, stroke, repeat=5):
+    maker = GcodeMaker()
+    text = jsonEnvelope(stroke)
+    packed = wire.encodeStroke(stroke)
+    timings = {
+        "json decode": lambda: wire.decodeJsonStroke(text),
+        "json decode + columns": lambda: maker.parseColumns(
+            wire.decodeJsonStroke(text)["data"]
+        ),
+        "binary decode": lambda: wire.decodeStroke(packed),
+        "binary decode + columns": lambda: maker.parseColumns(
+            wire.decodeStroke(packed)["data"]
+        ),
+    }
+    print(
+        f"{name}: {len(stroke['data'])} points, "
+        f"json {len(text) / 1024:.1f} KiB, binary {len(packed) / 1024:.1f} KiB"
+    )
+    base = None
+    for label, fn in timings.items():
+        best = min(timeit.repeat(fn, number=1, repeat=repeat))
+        base = base or best
+        print(f"  {label:<26}{best * 1000:10.3f} ms {base / best:8.1f}x")
+
+    fromJson = wire.decodeJsonStroke(text)
+    fromBinary = wire.decodeStroke(packed)
+    assert fromJson["color"] == fromBinary["color"], "color does not round trip"
+    assert fromJson["size"] == fromBinary["size"], "size does not round trip"
+    # float32 on the wire, the app sends 3 decimal places
+    assert np.allclose(
+        maker.parseColumns(fromJson["data"]),
+        maker.parseColumns(fromBinary["data"]),
+        atol=1e-3,
+    ), "points do not round trip"
+
+
+def main():
+    with open(ROOT / "dummy_data/sample_brush_change.json") as f:
+        sample = json.load(f)
+    bench("sample_brush_change.json", sample, repeat=50)
+    synthetic = dict(sample, data=syntheticStroke(100_000))
+    bench("synthetic stroke", synthetic)
+
+
+if __name__ == "__main__":
+    main()
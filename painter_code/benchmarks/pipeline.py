@@ -0,0 +1,295 @@
+"""
+End to end benchmark of Backend's parse, preprocess, refill, adapter and
+serialize stages on dummy_data, CircleStack, a job made from logo.png, a
+random Workload and synthetic strokes of 1k to 1M points, with no serial
+session.
+Jobs are compiled as the consumer compiles them, through Backend.runBatch
+in STREAM_CHUNK_SIZE chunks, and the stages are those the Backend's
+profiler times, see profiling.
+Reports the wall time and allocations (tracemalloc) of each stage and the
+lines and bytes sent, and saves them as a JSON baseline to compare later
+runs, such as on another commit, against.
+Run from painter_code with:
+    python -m benchmarks.pipeline --save before
+    python -m benchmarks.pipeline --compare before
+"""
+import argparse
+import itertools
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from main import Backend
+from preprocess import PreProcessors
+from profiling import Profiler
+from scheduler import brushKey
+from testStuff.dataCreators import CircleStack, Workload, picConvert
+from benchmarks.benchParse import syntheticStroke
+import commandAdapters as CA
+
+ROOT = Path(__file__).parent.parent
+BASELINES = Path(__file__).parent / "baselines"
+SYNTHETIC_SIZES = {
+    "synthetic1k": 1_000,
+    "synthetic10k": 10_000,
+    "synthetic100k": 100_000,
+    "synthetic1M": 1_000_000,
+}
+# slower or bigger than the baseline by more than this is a regression,
+# quick stages are noisy so timings under MIN_SECONDS aren't compared
+TIME_TOLERANCE = 1.25
+MEMORY_TOLERANCE = 1.10
+MIN_SECONDS = 0.005
+
+
+def makeBackend():
+    """
+    A Backend set up as main sets it up, with no serial session
+    """
+    return Backend(
+        brushConfig=str(ROOT / "configs/brushConfig.json"),
+        holderConfig=str(ROOT / "configs/brushHolderConfig.json"),
+        pressureConfig=str(ROOT / "configs/pressureConfig.json"),
+        serialSession=None,
+        commandAdapters=[CA.startAndEndLift, CA.mirrorOnY, CA.checkLimits],
+        preprocessors=[
+            PreProcessors.excludePointsWithin,
+            PreProcessors.smoothZ,
+            PreProcessors.simplify,
+            PreProcessors.modFeedRate,
+        ],
+    )
+
+
+def loadJobs(names=None, maxPoints=max(SYNTHETIC_SIZES.values())):
+    """
+    The benchmark jobs by name, each a list of stroke messages.
+    Files in dummy_data that aren't stroke messages are left out.
+    """
+    jobs = {}
+    for path in sorted((ROOT / "dummy_data").glob("*.json")):
+        with open(path) as f:
+            data = json.load(f)
+        strokes = data if isinstance(data, list) else [data]
+        if all(isinstance(s, dict) and "data" in s for s in strokes):
+            jobs[path.stem] = strokes
+    jobs["circleStack"] = CircleStack.create(6, 75, (300, 650))
+    jobs["logo"] = picConvert.strokes(ROOT / "logo.png")
+    # not color 6, pot 5's refills go past BED_MAX_X and fail checkLimits
+    workload = Workload(strokes=200, colors=dict.fromkeys(range(1, 6), 1))
+    jobs["workload"] = [stroke for _, stroke in workload.messages()]
+    for name, size in SYNTHETIC_SIZES.items():
+        if size <= maxPoints:
+            jobs[name] = [
+                {
+                    "color": "1 0xff000000",
+                    "size": "2 6.0",
+                    "data": syntheticStroke(size),
+                }
+            ]
+    if names:
+        jobs = {name: jobs[name] for name in names}
+    return jobs
+
+
+class TracingProfiler(Profiler):
+    """
+    A Profiler keeping every timing, that with traceMemory also records the
+    memory each stage leaves allocated and its peak above where it started.
+    Stages run inside other stages, such as arc fitting a refill, count
+    towards both.
+    """
+
+    def __init__(self, traceMemory=False):
+        super().__init__(window=None, reportEvery=0)
+        self.traceMemory = traceMemory
+        self.allocated = {}
+        self.peak = {}
+        # [memory at the start, highest peak seen] of each stage running
+        self._frames = []
+
+    def run(self, name, fn, *args, **kwargs):
+        if not self.traceMemory:
+            return super().run(name, fn, *args, **kwargs)
+        current, peak = tracemalloc.get_traced_memory()
+        if self._frames:
+            # reset_peak below loses the peak of the stage this is inside
+            self._frames[-1][1] = max(self._frames[-1][1], peak)
+        tracemalloc.reset_peak()
+        self._frames.append([current, current])
+        try:
+            return super().run(name, fn, *args, **kwargs)
+        finally:
+            before, highest = self._frames.pop()
+            after, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, highest)
+            if self._frames:
+                self._frames[-1][1] = max(self._frames[-1][1], peak)
+            self.allocated[name] = self.allocated.get(name, 0) + max(after - before, 0)
+            self.peak[name] = max(self.peak.get(name, 0), peak - before)
+
+    def seconds(self) -> dict:
+        """
+        Total seconds of each stage
+        """
+        return {name: sum(stats.seconds) for name, stats in self.stages.items()}
+
+
+def runJob(strokes, traceMemory=False):
+    """
+    The strokes through a fresh Backend as the consumer compiles them, each
+    run of strokes with the same brush as a batch streamed in chunks, see
+    Backend.iterEncoded. Returns the profiler, the job's wall time and peak
+    memory, and the G-code sent.
+    """
+    backend = makeBackend()
+    profiler = backend.profiler = TracingProfiler(traceMemory)
+    if traceMemory:
+        tracemalloc.start()
+    output = []
+    start = time.perf_counter()
+    for _, batch in itertools.groupby(strokes, key=brushKey):
+        output.extend(data for data, _ in backend.iterEncoded(list(batch)))
+    seconds = time.perf_counter() - start
+    peak = 0
+    if traceMemory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return profiler, seconds, peak, b"".join(output)
+
+
+def measure(strokes, repeat=3):
+    """
+    Best of repeat timings per stage, allocations from a separate
+    traced run since tracing slows everything down
+    """
+    runs = [runJob(strokes) for _ in range(repeat)]
+    traced, _, peak, output = runJob(strokes, traceMemory=True)
+    assert all(run[3] == output for run in runs), "job output is not repeatable"
+    stages = runs[0][0].seconds()
+    return {
+        "strokes": len(strokes),
+        "points": sum(len(s["data"]) for s in strokes),
+        "lines": output.count(b"\n"),
+        "bytes": len(output),
+        "total": min(run[1] for run in runs),
+        "firstChunk": runs[0][0].summary()["batch.first"]["p50"],
+        "peakMemory": peak,
+        "seconds": {s: min(run[0].seconds()[s] for run in runs) for s in stages},
+        "allocated": traced.allocated,
+        "peak": traced.peak,
+    }
+
+
+def report(name, result):
+    print(
+        f"{name}: {result['strokes']} strokes, {result['points']} points -> "
+        f"{result['lines']} lines, {result['bytes']} bytes, "
+        f"{result['total'] * 1000:.1f} ms, first chunk p50 "
+        f"{result['firstChunk'] * 1000:.2f} ms, peak {result['peakMemory'] / 1e6:.2f} MB"
+    )
+    for stage, seconds in result["seconds"].items():
+        print(
+            f"  {stage:<32}{seconds * 1000:10.2f} ms"
+            f"{result['allocated'].get(stage, 0) / 1e6:10.2f} MB kept"
+            f"{result['peak'].get(stage, 0) / 1e6:10.2f} MB peak"
+        )
+
+
+def gitCommit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    """
+    Differences from baseline worth a look, output that changed and stages
+    that got slower or use more memory than the tolerances allow
+    """
+    problems = []
+    for name, result in results.items():
+        old = baseline["jobs"].get(name)
+        if old is None:
+            continue
+        for key in ("lines", "bytes"):
+            if result[key] != old[key]:
+                problems.append(f"{name}: {key} {old[key]} -> {result[key]}")
+        for stage in result["seconds"].keys() & old["seconds"].keys():
+            before, after = old["seconds"][stage], result["seconds"][stage]
+            if max(before, after) >= MIN_SECONDS and after > before * TIME_TOLERANCE:
+                problems.append(
+                    f"{name} {stage}: {before * 1000:.2f} -> {after * 1000:.2f} ms"
+                )
+        for stage in result["peak"].keys() & old["peak"].keys():
+            before, after = old["peak"][stage], result["peak"][stage]
+            if after > before * MEMORY_TOLERANCE and after - before > 1e5:
+                problems.append(
+                    f"{name} {stage}: peak {before / 1e6:.2f} -> {after / 1e6:.2f} MB"
+                )
+        if "total" in old:
+            speedup = old["total"] / result["total"]
+            print(f"  {name:<24}{speedup:8.2f}x baseline speed")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("jobs", nargs="*", help="jobs to run, all by default")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--max-points",
+        type=int,
+        default=max(SYNTHETIC_SIZES.values()),
+        help="leave out synthetic strokes longer than this",
+    )
+    parser.add_argument("--save", metavar="NAME", help="save as baselines/NAME.json")
+    parser.add_argument(
+        "--compare", metavar="NAME", help="compare with baselines/NAME.json"
+    )
+    args = parser.parse_args()
+    # the Backend logs every stage of every stroke
+    logging.disable(logging.INFO)
+
+    results = {}
+    for name, strokes in loadJobs(args.jobs, args.max_points).items():
+        results[name] = measure(strokes, repeat=args.repeat)
+        report(name, results[name])
+
+    if args.compare:
+        with open(BASELINES / f"{args.compare}.json") as f:
+            baseline = json.load(f)
+        print(f"compared with {args.compare} ({baseline['commit']})")
+        problems = compare(baseline, results)
+        for problem in problems:
+            print(f"  {problem}")
+        if problems:
+            sys.exit(1)
+    if args.save:
+        BASELINES.mkdir(exist_ok=True)
+        with open(BASELINES / f"{args.save}.json", "w") as f:
+            json.dump(
+                {
+                    "commit": gitCommit(),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "jobs": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,78 @@
-from gcode import Command
+from gcode import Command, Flag
 from const import *
+from strokeBuffer import StrokeBuffer
+from arcFit import arcExtremes
 import numpy as np
 
+# Adapters take either a list of Command or a StrokeBuffer,
+# and return the same type
 
+MIRROR_FLAG_BITS = int(Flag.mirrorOnY | Flag.adapter)
 
-def startAndEndLift(commands):
+
+def chunked(needsEnds=False, checksStroke=False):
+    """
+    Mark an adapter as safe to apply to a stroke one chunk at a time,
+    see Backend.iterRun. Adapters with needsEnds take isFirst and isLast
+    keyword arguments saying where the chunk is in the stroke.
+    Adapters with checksStroke raise on commands that can't be sent, and
+    are also applied to the whole stroke before its first chunk is sent,
+    see Backend._checkStroke.
+    """
+
+    def mark(adapter):
+        adapter.chunkSafe = True
+        adapter.chunkEnds = needsEnds
+        adapter.checksStroke = checksStroke
+        return adapter
+
+    return mark
+
+
+@chunked(needsEnds=True)
+def startAndEndLift(commands, isFirst=True, isLast=True):
+    """
+    Lift before travelling to the start of the stroke, and after it ends.
+    When applied to a chunk of a stroke, the start lift is only added to
+    the first chunk and the end lift to the last.
+    """
+    if isinstance(commands, StrokeBuffer):
+        lift = Flag.adapter | Flag.lift
+        start = StrokeBuffer(
+            [np.nan, commands.x[0]],
+            [np.nan, commands.y[0]],
+            [0, 0],
+            BASE_FEED_RATE,
+            flags=[lift, Flag.contact],
+            dtype=commands.dtype,
+        )
+        end = StrokeBuffer(
+            [np.nan], [np.nan], [0], BASE_FEED_RATE, flags=[lift], dtype=commands.dtype
+        )
+        return StrokeBuffer.concat(
+            [start if isFirst else None, commands, end if isLast else None]
+        )
     new = []
-    start = commands[0]
-    new.append(Command(z=0, f=BASE_FEED_RATE, flags=["adapter", "lift"]))
-    new.append(Command(x=start.x, y=start.y, z=0, f=BASE_FEED_RATE, flags=["contact"]))
+    if isFirst:
+        start = commands[0]
+        new.append(Command(z=0, f=BASE_FEED_RATE, flags=["adapter", "lift"]))
+        new.append(
+            Command(x=start.x, y=start.y, z=0, f=BASE_FEED_RATE, flags=["contact"])
+        )
     new.extend(commands)
 
-    new.append(Command(z=0, f=BASE_FEED_RATE, flags=["adapter", "lift"]))
+    if isLast:
+        new.append(Command(z=0, f=BASE_FEED_RATE, flags=["adapter", "lift"]))
     return new
 
 
+@chunked()
 def speedUp(commands):
+    if isinstance(commands, StrokeBuffer):
+        commands.f[:] = 8000
+        commands.x = np.round(commands.x, 2)
+        commands.y = np.round(commands.y, 2)
+        return commands
     new = []
     for command in commands:
         command.f = 8000
@@ -26,7 +83,19 @@ def speedUp(commands):
     return new
 
 
+@chunked()
 def mirrorOnY(commands):
+    if isinstance(commands, StrokeBuffer):
+        new = commands.copy()
+        mask = new.hasFlag(Flag.contact) & ~np.isnan(new.y)
+        new.y[mask] = np.abs(BED_MIN_Y + new.y[mask])
+        new.addFlags(Flag.mirrorOnY | Flag.adapter, mask)
+        # mirroring reverses the direction of arcs
+        g2, g3 = StrokeBuffer.KINDS.index("G2"), StrokeBuffer.KINDS.index("G3")
+        arcs = mask & new.isArc()
+        new.j[arcs] *= -1
+        new.kind[arcs] = np.where(new.kind[arcs] == g2, g3, g2)
+        return new
 
     new = []
     for command in commands:
@@ -43,24 +112,42 @@ def mirrorOnY(commands):
             y=y,
             z=command.z,
             f=command.f,
-            flags=command.flags + ["mirrorOnY", "adapter"],
+            flags=command.flagBits | MIRROR_FLAG_BITS,
         )
+        if command.isArc():
+            # mirroring reverses the direction of arcs
+            c.commandType = "G3" if command.commandType == "G2" else "G2"
+            c.i, c.j = command.i, -1 * command.j
         new.append(c)
     return new
 
 
+@chunked(checksStroke=True)
 def checkLimits(commands):
-    coords = [c._convCoords() for c in commands]
-    x, y, z = zip(*coords)
-    x = [x for x in x if x is not None]
-    y = [y for y in y if y is not None]
-    z = [z for z in z if z is not None]
-    x_min = min(x)
-    x_max = max(x)
-    y_min = min(y)
-    y_max = max(y)
-    z_min = min(z)
-    z_max = max(z)
+    if isinstance(commands, StrokeBuffer):
+        arcX, arcY = [], []
+        if commands.isArc().any():
+            arcX, arcY = _arcExtremePoints(commands.toCommands())
+        x_min, x_max = _nanBounds(-1 * np.concatenate((commands.x, arcX)))
+        y_min, y_max = _nanBounds(-1 * np.concatenate((commands.y, arcY)))
+        z_min, z_max = _nanBounds(commands.z)
+    else:
+        coords = [c._convCoords() for c in commands]
+        x, y, z = zip(*coords)
+        x = [x for x in x if x is not None]
+        y = [y for y in y if y is not None]
+        z = [z for z in z if z is not None]
+        # arcs can bulge past their end points
+        arcX, arcY = _arcExtremePoints(commands)
+        x.extend(-1 * v for v in arcX)
+        y.extend(-1 * v for v in arcY)
+        # an axis no command moves, e.g. a chunk of macros, is within limits
+        x_min = min(x, default=BED_MIN_X)
+        x_max = max(x, default=BED_MAX_X)
+        y_min = min(y, default=BED_MIN_Y)
+        y_max = max(y, default=BED_MAX_Y)
+        z_min = min(z, default=BED_MIN_Z)
+        z_max = max(z, default=BED_MAX_Z)
 
     if any(
         [
@@ -78,6 +165,25 @@ def checkLimits(commands):
     return commands
 
 
+def _arcExtremePoints(commands):
+    # points where arcs reach furthest along each axis, unconverted coordinates
+    arcX, arcY = [], []
+    lastX, lastY = None, None
+    for c in commands:
+        if c.isArc() and lastX is not None and lastY is not None:
+            for px, py in arcExtremes(lastX, lastY, c):
+                arcX.append(px)
+                arcY.append(py)
+        lastX = c.x if c.x is not None else lastX
+        lastY = c.y if c.y is not None else lastY
+    return arcX, arcY
+
+
+def _nanBounds(values):
+    # min and max ignoring missing (NaN) coordinates
+    return np.nanmin(values), np.nanmax(values)
+
+
 def leadIn(commands, steps=20):
     if len(commands) < steps * 2:
         steps = len(commands) // 10
@@ -1,5 +1,37 @@
 MAX_BUFFER_SIZE = 128
 MAX_FEED_RATE = 14000
+# max distance in mm, in x y and z, between a simplified stroke and the original
+SIMPLIFY_TOLERANCE = 0.1
+# smoothZ, weight of each new z in the running average, and the smallest z change sent
+Z_SMOOTHING = 0.5
+Z_DEADBAND = 0.05
+# seconds allowed for ordering each batch of queued strokes to cut travel
+SCHEDULE_TIME_BUDGET = 0.05
+# longest in seconds a stroke can be held back to group strokes by brush
+MAX_REORDER_LATENCY = 30
+# mm, max distance between a fitted G2/G3 arc and the stroke points it replaces
+ARC_FIT_TOLERANCE = 0.05
+# stroke points compiled per chunk when streaming a stroke before it is fully compiled
+STREAM_CHUNK_SIZE = 256
+# encoded chunks compiled ahead of the serial writer before compiling waits
+WRITER_QUEUE_SIZE = 8
+# seconds write waits on a full writer queue before checking the writer has not stopped
+WRITER_POLL = 0.1
+# bytes of GRBL's RX buffer that have to be free before the next write, 1 to send
+# each line as soon as it fits, keeping the buffer full, more to coalesce writes
+STREAM_MIN_WRITE = 1
+# precompiled refills per pot, and the seed their random dips are made from
+MACRO_VARIANTS = 8
+MACRO_SEED = 0
+# holders and pots past the bed limits that checkLimits enforces, their macros are
+# built without it, every other macro has to pass it when Backend starts
+UNCHECKED_HOLDERS = (5,)
+UNCHECKED_POTS = (5,)
+# stroke points the tracker keeps, older ones are dropped
+TRACKER_CAPACITY = 10000
+# timings kept per stage by the profiler, and strokes between its logged reports
+PROFILE_WINDOW = 1000
+PROFILE_REPORT_EVERY = 100
 
 POT_BOARD_CORNER_X = 128.5  # corner nearest home in the X
 POT_BOARD_CORNER_Y = 128  # corner nearest home
@@ -35,4 +67,14 @@ MAX_STROKE_LENGTH = 999999999
 BASE_FEED_RATE = 12000
 HOLDER_FEED_RATE = 6000
 
+# planner settings, match GRBL's $120-$122 (mm/s^2) and $11 (mm)
+AXIS_ACCELERATION = (300, 300, 100)
+JUNCTION_DEVIATION = 0.01
+# GRBL's planner blocks, line buffer in characters and $12 arc tolerance in mm
+PLANNER_BLOCKS = 16
+LINE_BUFFER_SIZE = 80
+GRBL_ARC_TOLERANCE = 0.002
+# seconds the GRBL simulator takes to home
+SIM_HOMING_SECONDS = 10
+
 ARANDOMNUMBER = 589231
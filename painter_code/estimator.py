@@ -0,0 +1,313 @@
+import re
+import functools
+import logging
+import numpy as np
+from dataclasses import dataclass, field
+from gcode import Command, Macro, FLAG_BITS
+from strokeBuffer import StrokeBuffer
+import kinematics
+from const import *
+
+LOGGER = logging.getLogger(__name__)
+
+# flag categories time is split into, a command counts towards the first
+# of these it is flagged with, or "other"
+CATEGORIES = ("brushChange", "paintPot", "lift", "contact")
+OTHER = len(CATEGORIES)
+NAMES = CATEGORIES + ("other",)
+
+WORD = re.compile(r"([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))")
+COMMENT = re.compile(r"\([^)]*\)|;.*")
+
+
+def categories(flags):
+    """
+    Index into NAMES of the category of each flag bitmask
+    """
+    flags = np.asarray(flags, dtype=np.int64)
+    index = np.full(len(flags), OTHER, dtype=np.intp)
+    for idx in reversed(range(len(CATEGORIES))):
+        index[(flags & FLAG_BITS[CATEGORIES[idx]]) != 0] = idx
+    return index
+
+
+def _fill(column, first):
+    """
+    Replace the NaNs in column with the value before them, first before the start
+    """
+    values = np.concatenate(([first], column))
+    idx = np.where(np.isnan(values), 0, np.arange(len(values)))
+    return values[np.maximum.accumulate(idx)][1:]
+
+
+@dataclass
+class Estimate:
+    """
+    Predicted machine time of a command stream in seconds, and the
+    distance moved in mm, by flag category. end is where the machine
+    finishes, in machine coordinates.
+    """
+
+    seconds: dict = field(default_factory=lambda: dict.fromkeys(NAMES, 0.0))
+    distance: dict = field(default_factory=lambda: dict.fromkeys(NAMES, 0.0))
+    end: tuple = (0.0, 0.0, 0.0)
+
+    @property
+    def total(self):
+        return sum(self.seconds.values())
+
+    def __add__(self, other: "Estimate"):
+        return Estimate(
+            seconds={k: v + other.seconds[k] for k, v in self.seconds.items()},
+            distance={k: v + other.distance[k] for k, v in self.distance.items()},
+            end=other.end,
+        )
+
+    def __str__(self):
+        parts = ", ".join(f"{k} {v:.2f}s" for k, v in self.seconds.items() if v)
+        return f"{self.total:.2f}s ({parts})" if parts else "0.00s"
+
+
+class Estimator:
+    """
+    Machine time of commands added a chunk at a time, planned as one
+    stream when result is called, with a trapezoidal speed profile, each
+    axis limited to its own acceleration and GRBL's junction deviation
+    (see kinematics). The planner sees the whole stream, where GRBL only
+    sees what is in its planner, so this is the fastest GRBL could go.
+
+    Parameters
+    ----------
+    start : tuple
+        machine coordinates the stream starts from
+    """
+
+    def __init__(
+        self,
+        start=(0.0, 0.0, 0.0),
+        axisAccel=AXIS_ACCELERATION,
+        deviation=JUNCTION_DEVIATION,
+        maxRate=MAX_FEED_RATE,
+        arcTolerance=GRBL_ARC_TOLERANCE,
+    ):
+        self.axisAccel = axisAccel
+        self.deviation = deviation
+        self.maxRate = maxRate
+        self.arcTolerance = arcTolerance
+        self.position = np.asarray(start, dtype=np.float64)
+        self.feed = np.nan
+        self.motion = 0
+        # finished runs, the machine stops between them
+        self.runs = []
+        self.dwell = np.zeros(len(NAMES))
+        self._newRun()
+
+    def _newRun(self):
+        self._points = [self.position[None, :]]
+        self._feeds = []
+        self._categories = []
+
+    def _stop(self):
+        if self._feeds:
+            self.runs.append(
+                (
+                    np.concatenate(self._points),
+                    np.concatenate(self._feeds),
+                    np.concatenate(self._categories),
+                )
+            )
+        self._newRun()
+
+    def add(self, commands):
+        """
+        commands is a list of Command, a StrokeBuffer, G-code as bytes or
+        str such as encodeCommands makes, or a list of chunks of those
+        """
+        if isinstance(commands, StrokeBuffer):
+            return self._addBuffer(commands, mirrored=True)
+        if isinstance(commands, (bytes, bytearray, str)):
+            return self._addGcode(commands, 0)
+        run = []
+        for item in commands:
+            if isinstance(item, Command) and item.commandType in StrokeBuffer.KINDS:
+                run.append(item)
+                continue
+            if run:
+                self._addBuffer(StrokeBuffer.fromCommands(run), mirrored=True)
+                run = []
+            if isinstance(item, Macro):
+                self._addGcode(item.data, item.flagBits, cached=True)
+            elif isinstance(item, Command):
+                # a pause or anything else GRBL waits on, the machine stops
+                self._stop()
+            else:
+                self.add(item)
+        if run:
+            self._addBuffer(StrokeBuffer.fromCommands(run), mirrored=True)
+
+    def _addBuffer(self, stroke: StrokeBuffer, mirrored, flagBits=None):
+        """
+        mirrored is True for Command coordinates, which _convCoords negates
+        in x and y, False for machine coordinates. flagBits, if given, is
+        used for every point in place of the stroke's flags.
+        """
+        if not len(stroke):
+            return
+        sign = -1 if mirrored else 1
+        targets = np.column_stack(
+            (
+                _fill(sign * stroke.x.astype(np.float64), self.position[0]),
+                _fill(sign * stroke.y.astype(np.float64), self.position[1]),
+                _fill(stroke.z.astype(np.float64), self.position[2]),
+            )
+        )
+        filled = _fill(stroke.f.astype(np.float64), self.feed)
+        self.feed = filled[-1]
+        kinds = stroke.kind
+        feeds = np.where(kinds == StrokeBuffer.KINDS.index("G0"), self.maxRate, filled)
+        # feeds GRBL would reject, missing or 0, are taken as the max rate
+        feeds = np.where(np.isnan(feeds) | (feeds <= 0), self.maxRate, feeds)
+        if flagBits is None:
+            cats = categories(stroke.flags)
+        else:
+            cats = np.full(len(stroke), categories([flagBits])[0])
+
+        arcs = np.flatnonzero(kinds >= StrokeBuffer.KINDS.index("G2"))
+        done = 0
+        for k in arcs:
+            self._extend(targets[done:k], feeds[done:k], cats[done:k])
+            start = targets[k - 1] if k else self.position
+            points = kinematics.arcPoints(
+                start,
+                targets[k],
+                (sign * stroke.i[k], sign * stroke.j[k]),
+                clockwise=StrokeBuffer.KINDS[kinds[k]] == "G2",
+                tolerance=self.arcTolerance,
+            )
+            self._extend(
+                points, np.full(len(points), feeds[k]), np.full(len(points), cats[k])
+            )
+            done = k + 1
+        self._extend(targets[done:], feeds[done:], cats[done:])
+        self.position = targets[-1]
+
+    def _extend(self, points, feeds, cats):
+        if len(points):
+            self._points.append(points)
+            self._feeds.append(feeds)
+            self._categories.append(cats)
+
+    def _addGcode(self, data, flagBits, cached=False):
+        """
+        Add G-code text, in machine coordinates, with every line flagged
+        flagBits. cached for text that is added again and again, macros.
+        """
+        if isinstance(data, bytearray):
+            data = bytes(data)
+        parse = _parseCached if cached else parseGcode
+        pieces, self.motion = parse(data, self.motion)
+        for kind, value in pieces:
+            if kind == "moves":
+                self._addBuffer(value, mirrored=False, flagBits=flagBits)
+            elif kind == "feed":
+                self.feed = value
+            elif kind == "dwell":
+                self._stop()
+                self.dwell[categories([flagBits])[0]] += value
+            else:
+                # homed, the machine is at its origin
+                self._stop()
+                self.position = np.zeros(3)
+                self._newRun()
+
+    def result(self) -> Estimate:
+        """
+        Plan everything added so far
+        """
+        self._stop()
+        seconds = self.dwell.copy()
+        distance = np.zeros(len(NAMES))
+        for xyz, feeds, cats in self.runs:
+            lengths, _ = kinematics.segmentVectors(xyz)
+            _, times = kinematics.planSegments(
+                xyz, feeds, axisAccel=self.axisAccel, deviation=self.deviation
+            )
+            seconds += np.bincount(cats, weights=times, minlength=len(NAMES))
+            distance += np.bincount(cats, weights=lengths, minlength=len(NAMES))
+        return Estimate(
+            seconds=dict(zip(NAMES, seconds.tolist())),
+            distance=dict(zip(NAMES, distance.tolist())),
+            end=tuple(self.position.tolist()),
+        )
+
+
+def parseGcode(data, motion=0):
+    """
+    The moves, feed changes, dwells and homing in G-code text, in order, as
+    ("moves", StrokeBuffer), ("feed", F), ("dwell", seconds) and ("home", None)
+    pieces, and the motion mode, 0 to 3, in force at the end.
+    The StrokeBuffer is in machine coordinates, missing axes and feeds NaN.
+    """
+    if isinstance(data, bytes):
+        data = data.decode()
+    pieces, rows = [], []
+
+    def flush():
+        if rows:
+            columns = dict(zip(("x", "y", "z", "f", "kind", "i", "j"), zip(*rows)))
+            pieces.append(("moves", StrokeBuffer(**columns)))
+            rows.clear()
+
+    nan = np.nan
+    for line in data.splitlines():
+        line = COMMENT.sub("", line).replace(" ", "").upper()
+        if not line:
+            continue
+        if line == "$H":
+            flush()
+            pieces.append(("home", None))
+            continue
+        words, isDwell, feed = {}, False, nan
+        for letter, value in WORD.findall(line):
+            value = float(value)
+            if letter == "G" and value in (0, 1, 2, 3):
+                motion = int(value)
+            elif letter == "G" and value == 4:
+                isDwell = True
+            elif letter == "F":
+                feed = value
+            else:
+                words[letter] = value
+        if isDwell:
+            flush()
+            pieces.append(("dwell", words.get("P", 0.0)))
+        elif words.keys() & set("XYZ"):
+            rows.append(
+                (
+                    words.get("X", nan),
+                    words.get("Y", nan),
+                    words.get("Z", nan),
+                    feed,
+                    StrokeBuffer.KINDS.index(f"G{motion}"),
+                    words.get("I", nan),
+                    words.get("J", nan),
+                )
+            )
+        elif feed == feed:
+            flush()
+            pieces.append(("feed", feed))
+    flush()
+    return tuple(pieces), motion
+
+
+# macros are the same few G-code texts added over and over
+_parseCached = functools.lru_cache(maxsize=256)(parseGcode)
+
+
+def estimate(commands, start=(0.0, 0.0, 0.0), **kwargs) -> Estimate:
+    """
+    Predicted machine time of commands, anything Estimator.add takes
+    """
+    estimator = Estimator(start, **kwargs)
+    estimator.add(commands)
+    return estimator.result()
@@ -1,10 +1,85 @@
+import json
 import math
+import warnings
+import numpy as np
+from enum import IntFlag, auto
 from const import *
 from pathlib import Path
 
 ROOT = Path(__file__).parent
 
 
+class Flag(IntFlag):
+    """
+    Bit values for the flags used to identify command types.
+    Member names match the flag strings used on Command,
+    so Flag["contact"] is the bit for the "contact" flag.
+    """
+
+    contact = auto()
+    lift = auto()
+    required = auto()
+    paintPot = auto()
+    brushChange = auto()
+    pickup = auto()
+    drop = auto()
+    scrape = auto()
+    adapter = auto()
+    mirrorOnY = auto()
+    leadIn = auto()
+    style = auto()
+    pointillism = auto()
+
+    @classmethod
+    def fromNames(cls, names):
+        """
+        Combine a list of flag names into a single Flag value
+        """
+        return cls(toFlagBits(names))
+
+    @classmethod
+    def toNames(cls, value):
+        """
+        List the flag names set in value, in definition order
+        """
+        return [member.name for member in cls if value & member]
+
+
+class _FlagBits(dict):
+    """
+    Plain int bits for flag names and Flag values,
+    IntFlag operators are too slow for per-command use.
+    Combined Flag values are converted on first use then cached.
+    """
+
+    def __missing__(self, key):
+        bits = self[key] = toFlagBits(key)
+        return bits
+
+
+FLAG_BITS = _FlagBits({member.name: int(member) for member in Flag})
+
+
+def toFlagBits(flags):
+    """
+    Convert flags given as a name, list of names, Flag or int to an int bitmask.
+    Raises ValueError on a name that isn't a Flag
+    """
+    if flags is None:
+        return 0
+    if isinstance(flags, int):
+        return int(flags)
+    if isinstance(flags, str):
+        try:
+            return int(Flag[flags])
+        except KeyError:
+            raise ValueError(f"Unknown command flag {flags!r}") from None
+    bits = 0
+    for name in flags:
+        bits |= FLAG_BITS[name]
+    return bits
+
+
 class Command:
     """
     Parameters
@@ -17,12 +92,18 @@ class Command:
         z coordinate
     f : float
         feed rate
-    flags : list | str | None
+    i, j : float
+        arc center offset from the start point, for G2/G3 commands
+    flags : list | str | Flag | int | None
         flags for identifying the command type
         e.g. "contact", "lift"
+        stored as a bitmask in flagBits and read back as a Flag,
+        names that aren't a Flag raise ValueError
 
     """
 
+    __slots__ = ("id", "x", "y", "z", "f", "i", "j", "flagBits", "commandType")
+
     _autoinc = 0
 
     @classmethod
@@ -30,15 +111,27 @@ class Command:
         cls._autoinc += 1
         return cls._autoinc
 
-    def __init__(self, x=None, y=None, z=None, f=None, flags=None, command=None):
+    def __init__(
+        self, x=None, y=None, z=None, f=None, flags=None, command=None, i=None, j=None
+    ):
         self.id = Command.autoincrement()
         self.x = x
         self.y = y
         self.z = z
         self.f = f
-        self.flags = flags if isinstance(flags, list) else [flags] if flags else []
+        self.i = i
+        self.j = j
+        self.flagBits = toFlagBits(flags)
         self.commandType = "G1" if command is None else command
 
+    @property
+    def flags(self) -> Flag:
+        return Flag(self.flagBits)
+
+    @flags.setter
+    def flags(self, flags):
+        self.flagBits = toFlagBits(flags)
+
     def __str__(self):
         coords = self._convCoords()
         x, y, z = coords
@@ -49,12 +142,14 @@ class Command:
             base += f" Y{y:.3f}"
         if self.z is not None:
             base += f" Z{z:.3f}"
+        if self.i is not None:
+            base += f" I{-1 * self.i:.3f} J{-1 * self.j:.3f}"
         base += f" F{self.f}"
         return base
 
     def __repr__(self):
         return f"""Command(id={self.id}, gcode_command={self.commandType}, x={self.x}, y={self.y},
-        z={self.z}, feed={self.f}, flags={self.flags})"""
+        z={self.z}, i={self.i}, j={self.j}, feed={self.f}, flags={Flag.toNames(self.flagBits)})"""
 
     def distanceTo(self, other: "Command"):
         return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2)
@@ -73,8 +168,24 @@ class Command:
 
         return [xConv, yConv, self.z]
 
+    def isArc(self):
+        return self.commandType in ("G2", "G3")
+
     def hasFlag(self, flag):
-        return flag in self.flags
+        """
+        Whether flag, a name or Flag, is set. Names that aren't a Flag are
+        never set, as when flags were a list of strings
+        """
+        try:
+            return self.flagBits & FLAG_BITS[flag] != 0
+        except ValueError:
+            return False
+
+    def addFlags(self, flags):
+        """
+        Set flags on the command, flags that are already set are unchanged
+        """
+        self.flagBits |= toFlagBits(flags)
 
 
 class Pause(Command):
@@ -82,6 +193,8 @@ class Pause(Command):
     Use to add a pause at a position
     """
 
+    __slots__ = ("pause",)
+
     def __init__(self, x, y, z, f):
         super().__init__(x, y, z, f)
         self.pause = True
@@ -96,42 +209,155 @@ class Pause(Command):
         return self.pause == other.pause
 
 
+class Macro(Command):
+    """
+    A precompiled sequence of commands, such as a pot refill, held as the
+    G-code bytes it encodes to. The serializer splices the bytes into its
+    output as they are, see macros.MacroCache.
+    """
+
+    __slots__ = ("name", "data")
+
+    def __init__(self, name: str, data: bytes, flags=None):
+        super().__init__(flags=flags, command="MACRO")
+        self.name = name
+        self.data = data
+
+    def __str__(self):
+        return self.data.decode().rstrip("\n")
+
+    def __repr__(self):
+        return f"Macro(name={self.name}, bytes={len(self.data)}, flags={Flag.toNames(self.flagBits)})"
+
+    def __eq__(self, other):
+        return isinstance(other, Macro) and self.data == other.data
+
+
 class GcodeMaker:
     """
     Takes stream data in the form 207.516 311.226 0.11 344.786
     Data should be the coordinates for a single stroke
     Generates a list of commands:Command
+
+    pressureTable is a (pressures, zs) pair of increasing pressures and
+    the z each maps to, interpolated between and extrapolated along the end
+    segments past either end, see loadPressureTable.
+    Without it the linear formula in parsePressure is used.
     """
 
-    def __init__(self):
+    def __init__(self, pressureTable=None):
         self.commands: list[Command] = []
+        self.pressureTable = pressureTable
 
     def parse(self, streamData):
         """
         streamData is a list of strings in the form "207.516 311.226 0.11 344.786"
+        or an (n, 4) array of the same values
         """
-        commands = []
-        for line in streamData:
-            if line == "":
-                continue
-            data = line.split(" ")
-            x = float(data[0])
-            y = float(data[1])
-            z = self.parsePressure(data[2])
-            f = min([int(float(data[3]) * 60), MAX_FEED_RATE])
-            commands.append(Command(x, y, z, f, flags=["contact"]))
-
-        self.commands = commands
+        self.stroke = self.parseBulk(streamData)
+        self.commands = self.stroke.toCommands()
         return str(self)
 
+    def parseBulk(self, streamData):
+        """
+        Parse the whole of streamData in one pass into a StrokeBuffer,
+        without creating a Command for each line.
+        Blank lines are skipped, and the pressure to z mapping and feed rate
+        clamp are applied to whole columns.
+        """
+        from strokeBuffer import StrokeBuffer
+
+        columns = self.parseColumns(streamData)
+        x, y, pressure, speed = columns.T
+        z = self.parsePressures(pressure)
+        f = np.minimum(np.trunc(speed * 60), MAX_FEED_RATE)
+        return StrokeBuffer(x, y, z, f, flags=Flag.contact)
+
+    def parseColumns(self, streamData):
+        """
+        Convert stream lines to an (n, 4) array of x, y, pressure, speed.
+        An (n, 4) array, as decoded from a binary stroke, is used as is.
+        Raises ValueError on a line with fewer than 4 fields, or a field
+        that isn't a number, fields after the 4th are ignored like parse.
+        """
+        if isinstance(streamData, np.ndarray):
+            return np.asarray(streamData, dtype=np.float64).reshape(-1, 4)
+        lines = [line for line in streamData if line != ""]
+        values = None
+        # every line has to have 4 fields, not just the total be 4 per line
+        if {line.count(" ") for line in lines} <= {3}:
+            with warnings.catch_warnings():
+                # fromstring warns, and stops early, or raises, depending on
+                # the numpy version, on text it can't parse
+                warnings.simplefilter("ignore", DeprecationWarning)
+                try:
+                    values = np.fromstring(" ".join(lines), dtype=np.float64, sep=" ")
+                except ValueError:
+                    pass
+        if values is None or len(values) != 4 * len(lines):
+            # lines with extra or malformed fields, parse line by line
+            values = np.array([self._lineFields(line) for line in lines])
+        return values.reshape(-1, 4)
+
+    @staticmethod
+    def _lineFields(line):
+        fields = line.split(" ")
+        if len(fields) < 4:
+            raise ValueError(f"Stream line needs x y pressure speed: {line!r}")
+        return [float(v) for v in fields[:4]]
+
     def parsePressure(self, pressure):
         """
         Alters the value of the z axis based on the pressure
         Needs to be adjusted while we test
         """
         pressure = float(pressure)
+        if self.pressureTable is not None:
+            return float(self.parsePressures(np.array([pressure]))[0])
         return max(BRUSH_TIP_Z_OFFSET - pressure * 1, BED_MIN_Z)
 
+    def parsePressures(self, pressures):
+        """
+        parsePressure for a whole array of pressures
+        """
+        if self.pressureTable is not None:
+            table, zs = self.pressureTable
+            z = np.interp(pressures, table, zs)
+            # np.interp holds the end values, keep the end slopes instead
+            below = pressures < table[0]
+            above = pressures > table[-1]
+            if below.any():
+                slope = (zs[1] - zs[0]) / (table[1] - table[0])
+                z[below] = zs[0] + (pressures[below] - table[0]) * slope
+            if above.any():
+                slope = (zs[-1] - zs[-2]) / (table[-1] - table[-2])
+                z[above] = zs[-1] + (pressures[above] - table[-1]) * slope
+            return np.maximum(z, BED_MIN_Z)
+        return np.maximum(BRUSH_TIP_Z_OFFSET - pressures * 1, BED_MIN_Z)
+
+    @staticmethod
+    def loadPressureTable(config, size=None):
+        """
+        The pressure to z table for a brush size from a pressure config,
+        a json file, or its contents, keyed by brush size with a "default"
+        entry for sizes it doesn't list
+        """
+        if not isinstance(config, dict):
+            with open(config) as f:
+                config = json.load(f)
+        entry = config.get(str(float(size)) if size is not None else "default")
+        if entry is None:
+            entry = config["default"]
+        pressures = np.asarray(entry["pressure"], dtype=np.float64)
+        zs = np.asarray(entry["z"], dtype=np.float64)
+        if (
+            len(pressures) < 2
+            or len(pressures) != len(zs)
+            or (np.diff(pressures) <= 0).any()
+        ):
+            raise ValueError(f"Bad pressure table for brush size {size}")
+        return pressures, zs
+
     def addCommand(self, command: Command):
         self.commands.append(command)
 
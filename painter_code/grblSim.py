@@ -0,0 +1,705 @@
+"""
+GRBL emulator for streaming G-code without the Arduino.
+
+GrblSim models the parts of GRBL 1.1 that decide how fast a job streams:
+the 128 byte serial RX buffer, the 80 character line buffer, the planner,
+ok, error:N and ALARM:N responses, $H, the realtime ? ! ~ and ctrl-x, and
+motion time from the feed rates, axis accelerations and junction deviation
+(see kinematics). It understands the G-code Pablo sends, anything else is
+error:20.
+
+SimSerial connects a SerialSession to a GrblSim in process, PtyServer serves
+one on a pseudo terminal for anything that opens a serial port.
+Run this file to paint the circle stack test job on a simulator and print
+the streaming figures, or with --pty to serve one.
+"""
+
+import re
+import os
+import time
+import json
+import select
+import tempfile
+import logging
+import argparse
+import threading
+from collections import deque
+import numpy as np
+import kinematics
+from const import *
+
+LOGGER = logging.getLogger(__name__)
+
+BANNER = b"Grbl 1.1h ['$' for help]"
+HELP = b"[HLP:$$ $# $G $I $N $x=val $Nx=line $J=line $SLP $C $X $H ~ ! ? ctrl-x]"
+REALTIME = b"?!~\x18"
+END_OF_LINE = re.compile(rb"[\r\n]")
+WORDS = re.compile(rb"(?:[A-Z][-+]?(?:\d+\.?\d*|\.\d+))*")
+WORD = re.compile(rb"([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))")
+COMMENT = re.compile(rb"\([^)]*\)|;.*")
+
+# GRBL's error and alarm codes
+ERROR_EXPECTED_COMMAND = 1
+ERROR_BAD_NUMBER = 2
+ERROR_INVALID_STATEMENT = 3
+ERROR_IDLE = 8
+ERROR_ALARM_LOCK = 9
+ERROR_LINE_OVERFLOW = 11
+ERROR_UNSUPPORTED = 20
+ERROR_UNDEFINED_FEED = 22
+ERROR_INVALID_TARGET = 33
+ALARM_SOFT_LIMIT = 2
+
+SUPPORTED_G = {0, 1, 2, 3, 4, 17, 21, 54, 90, 91, 94}
+SUPPORTED_M = {0, 2, 3, 4, 5, 8, 9, 30}
+
+
+class Block:
+    """
+    A planner block, a straight move or, with sync, a dwell or homing
+    cycle that waits for the planner to empty and takes duration seconds
+    """
+
+    __slots__ = (
+        "target",
+        "length",
+        "unit",
+        "feed",
+        "sync",
+        "homing",
+        "start",
+        "duration",
+        "exitSq",
+    )
+
+    def __init__(
+        self,
+        target,
+        length=0.0,
+        unit=None,
+        feed=0.0,
+        sync=False,
+        duration=0.0,
+        homing=False,
+    ):
+        self.target = target
+        self.length = length
+        self.unit = unit
+        self.feed = feed
+        self.sync = sync
+        self.homing = homing
+        self.start = 0.0
+        self.duration = duration
+        self.exitSq = 0.0
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+
+class GrblSim:
+    """
+    Simulated GRBL, driven by receive and advance. Responses are queued in
+    output as lines ending \\r\\n, as GRBL sends them.
+
+    Time is the simulated clock in seconds. Blocks are planned as GRBL
+    does, with the blocks in the planner as the lookahead, so a planner
+    that runs short of blocks slows the machine down and one that runs
+    empty stops it, counted in stats as a starvation.
+
+    Parameters
+    ----------
+    plannerSize : int
+        planner ring buffer size, one slot is kept free as in GRBL
+    softLimits : ((min, max), (min, max), (min, max)) | None
+        machine travel in x, y and z, moves outside it raise ALARM:2
+    homingRequired : bool
+        start in alarm, locked until $H or $X, as GRBL does with homing on
+    """
+
+    def __init__(
+        self,
+        rxSize=MAX_BUFFER_SIZE,
+        plannerSize=PLANNER_BLOCKS,
+        axisAccel=AXIS_ACCELERATION,
+        deviation=JUNCTION_DEVIATION,
+        maxRate=MAX_FEED_RATE,
+        softLimits=None,
+        homingRequired=False,
+        homingTime=SIM_HOMING_SECONDS,
+    ):
+        self.rxSize = rxSize
+        self.plannerSize = plannerSize
+        self.axisAccel = axisAccel
+        self.deviation = deviation
+        self.maxRate = maxRate
+        self.softLimits = softLimits
+        self.homingTime = homingTime
+        self.clock = 0.0
+        self.output = deque()
+        self.stats = {
+            "bytes": 0,
+            "lines": 0,
+            "ok": 0,
+            "errors": 0,
+            "alarms": 0,
+            "overflows": 0,
+            "blocks": 0,
+            "motionSeconds": 0.0,
+            "starvations": 0,
+            "starvedSeconds": 0.0,
+        }
+        self.alarm = homingRequired
+        self._reset()
+        if homingRequired:
+            self._send(b"[MSG:'$H'|'$X' to unlock]")
+
+    def _reset(self):
+        self.rx = bytearray()
+        self.line = bytearray()
+        self.planner = deque()
+        # blocks of the line being executed that don't fit in the planner yet
+        self.waiting = deque()
+        self.owesOk = False
+        self.hold = False
+        self.position = np.zeros(3)  # where the last planned block ends
+        self.machinePosition = np.zeros(3)  # where the last finished block ends
+        self.motion = 0
+        self.feed = None
+        self.relative = False
+        self.entrySq = 0.0
+        self.idleSince = None
+        self.output.append(b"\r\n" + BANNER + b"\r\n")
+
+    def _send(self, line: bytes):
+        self.output.append(line + b"\r\n")
+
+    def _ok(self):
+        self.stats["ok"] += 1
+        self._send(b"ok")
+
+    def _error(self, code):
+        self.stats["errors"] += 1
+        self._send(f"error:{code}".encode())
+
+    def _alarm(self, code):
+        """
+        Stop, throwing away the planner and anything received, as GRBL does
+        """
+        self.stats["alarms"] += 1
+        self._send(f"ALARM:{code}".encode())
+        self.rx.clear()
+        self.line.clear()
+        self.planner.clear()
+        self.waiting.clear()
+        self.owesOk = False
+        self.entrySq = 0.0
+        self.alarm = True
+        self._send(b"[MSG:Reset to continue]")
+
+    def receive(self, data: bytes):
+        """
+        Bytes from the host. Realtime commands are acted on straight away,
+        the rest go in the RX buffer, and are lost if it is full.
+        """
+        self.stats["bytes"] += len(data)
+        if data.translate(None, REALTIME) == data:
+            return self._buffer(data)
+        start = 0
+        for idx in range(len(data)):
+            char = data[idx : idx + 1]
+            if char in REALTIME:
+                self._buffer(data[start:idx])
+                self._realtime(char)
+                start = idx + 1
+        self._buffer(data[start:])
+
+    def _buffer(self, data):
+        # lines are taken out of the buffer as it fills, unless one is waiting
+        while data:
+            space = self.rxSize - len(self.rx)
+            if not space:
+                self.stats["overflows"] += len(data)
+                LOGGER.warning(f"RX buffer overflow, {len(data)} bytes lost")
+                return
+            self.rx += data[:space]
+            data = data[space:]
+            self._execute()
+
+    def _realtime(self, char):
+        if char == b"?":
+            self._send(self.statusReport())
+        elif char == b"!":
+            self.hold = True
+        elif char == b"~":
+            self.hold = False
+        elif char == b"\x18":
+            wasMoving = bool(self.planner)
+            self._reset()
+            if wasMoving:
+                self.alarm = True
+
+    def statusReport(self) -> bytes:
+        if self.alarm:
+            state = "Alarm"
+        elif self.hold:
+            state = "Hold:0"
+        elif self.planner and self.planner[0].homing:
+            state = "Home"
+        elif self.planner:
+            state = "Run"
+        else:
+            state = "Idle"
+        position = self.machinePosition
+        feed = 0
+        if self.planner and self.planner[0].duration > 0:
+            head = self.planner[0]
+            done = min((self.clock - head.start) / head.duration, 1)
+            position = position + done * (head.target - position)
+            feed = head.feed
+        x, y, z = position
+        free = self.plannerSize - 1 - len(self.planner)
+        return (
+            f"<{state}|MPos:{x:.3f},{y:.3f},{z:.3f}|"
+            f"Bf:{free},{self.rxSize - len(self.rx)}|FS:{feed:.0f},0>"
+        ).encode()
+
+    def _execute(self):
+        """
+        Take lines from the RX buffer and run them until one has to wait
+        for room in the planner, or for it to empty
+        """
+        while True:
+            if self.owesOk:
+                self._fillPlanner()
+                if self.waiting or (self.planner and self.planner[-1].sync):
+                    return
+                self.owesOk = False
+                self._ok()
+            if not self.rx:
+                return
+            match = END_OF_LINE.search(self.rx)
+            end = len(self.rx) if match is None else match.start()
+            # characters past the line buffer are dropped, the line is an error
+            room = max(LINE_BUFFER_SIZE + 1 - len(self.line), 0)
+            self.line += self.rx[: min(end, room)]
+            del self.rx[: end + (match is not None)]
+            if match is None:
+                return
+            line, self.line = bytes(self.line), bytearray()
+            self.stats["lines"] += 1
+            if len(line) > LINE_BUFFER_SIZE:
+                self._error(ERROR_LINE_OVERFLOW)
+            else:
+                self._executeLine(line)
+
+    def _executeLine(self, line: bytes):
+        line = COMMENT.sub(b"", line).replace(b" ", b"").upper()
+        if not line:
+            return self._ok()
+        if line.startswith(b"$"):
+            return self._system(line)
+        if self.alarm:
+            return self._error(ERROR_ALARM_LOCK)
+        if not WORDS.fullmatch(line):
+            if not line[:1].isalpha():
+                return self._error(ERROR_EXPECTED_COMMAND)
+            return self._error(ERROR_BAD_NUMBER)
+
+        words = [(k.decode(), float(v)) for k, v in WORD.findall(line)]
+        axes, offsets, dwell = {}, {}, None
+        motion = self.motion
+        for letter, value in words:
+            if letter == "G":
+                if value not in SUPPORTED_G:
+                    return self._error(ERROR_UNSUPPORTED)
+                if value in (0, 1, 2, 3):
+                    motion = int(value)
+                elif value == 4:
+                    dwell = 0.0
+                elif value in (90, 91):
+                    self.relative = value == 91
+            elif letter == "M":
+                if value not in SUPPORTED_M:
+                    return self._error(ERROR_UNSUPPORTED)
+            elif letter in "XYZ":
+                axes["XYZ".index(letter)] = value
+            elif letter in "IJ":
+                offsets["IJ".index(letter)] = value
+            elif letter == "F":
+                self.feed = value
+            elif letter == "P":
+                dwell = value
+            elif letter not in "NST":
+                return self._error(ERROR_UNSUPPORTED)
+        self.motion = motion
+
+        if dwell is not None:
+            self.waiting.append(Block(self.position.copy(), sync=True, duration=dwell))
+        elif axes:
+            if motion != 0 and not self.feed:
+                return self._error(ERROR_UNDEFINED_FEED)
+            target = self.position.copy()
+            for axis, value in axes.items():
+                target[axis] = target[axis] + value if self.relative else value
+            if self._outsideLimits(target):
+                return self._alarm(ALARM_SOFT_LIMIT)
+            feed = self.maxRate if motion == 0 else self.feed
+            if motion in (2, 3):
+                if not offsets:
+                    return self._error(ERROR_INVALID_TARGET)
+                points = kinematics.arcPoints(
+                    self.position,
+                    target,
+                    (offsets.get(0, 0.0), offsets.get(1, 0.0)),
+                    clockwise=motion == 2,
+                )
+            else:
+                points = [target]
+            for point in points:
+                self._queueMove(point, feed)
+        self.owesOk = True
+
+    def _system(self, line: bytes):
+        if line == b"$":
+            self._send(HELP)
+        elif line == b"$I":
+            self._send(b"[VER:1.1h.sim:]")
+        elif line == b"$G":
+            mode = "G91" if self.relative else "G90"
+            self._send(
+                f"[GC:G{self.motion} G54 G17 G21 {mode} G94 M5 M9 T0 "
+                f"F{self.feed or 0:.0f} S0]".encode()
+            )
+        elif line in (b"$H", b"$X", b"$$"):
+            if self.planner or self.waiting:
+                return self._error(ERROR_IDLE)
+            if line == b"$H":
+                self.waiting.append(
+                    Block(np.zeros(3), sync=True, duration=self.homingTime, homing=True)
+                )
+                self.owesOk = True
+                return
+            if line == b"$X":
+                self.alarm = False
+                self._send(b"[MSG:Caution: Unlocked]")
+            else:
+                self._send(f"$110={self.maxRate:.3f}".encode())
+                for axis, accel in zip((120, 121, 122), self.axisAccel):
+                    self._send(f"${axis}={accel:.3f}".encode())
+                self._send(f"$11={self.deviation:.3f}".encode())
+                self._send(f"$12={GRBL_ARC_TOLERANCE:.3f}".encode())
+        else:
+            return self._error(ERROR_INVALID_STATEMENT)
+        self._ok()
+
+    def _outsideLimits(self, target):
+        if self.softLimits is None:
+            return False
+        return any(
+            not low <= value <= high
+            for value, (low, high) in zip(target, self.softLimits)
+        )
+
+    def _queueMove(self, target, feed):
+        delta = target - self.position
+        length = float(np.linalg.norm(delta))
+        # zero length moves aren't planned, as in GRBL
+        if length > 1e-6:
+            self.waiting.append(Block(target, length, delta / length, feed))
+        self.position = target
+
+    def _fillPlanner(self):
+        """
+        Move waiting blocks into the planner while there is room. A sync
+        block waits for the planner to empty and nothing follows it in
+        until it is done.
+        """
+        changed = False
+        while self.waiting and len(self.planner) < self.plannerSize - 1:
+            if self.planner and (self.waiting[0].sync or self.planner[-1].sync):
+                break
+            block = self.waiting.popleft()
+            self.planner.append(block)
+            self.stats["blocks"] += 1
+            if len(self.planner) == 1:
+                self._startHead()
+            changed = True
+        if changed:
+            self._replan()
+
+    def _startHead(self):
+        head = self.planner[0]
+        head.start = self.clock
+        if self.idleSince is not None and not head.sync:
+            self.stats["starvations"] += 1
+            self.stats["starvedSeconds"] += self.clock - self.idleSince
+        self.idleSince = None
+
+    def _replan(self):
+        """
+        Plan the running block again with the blocks behind it as the
+        lookahead, ending at rest after the last one
+        """
+        head = self.planner[0]
+        if head.sync:
+            return
+        moves = []
+        for block in self.planner:
+            if block.sync:
+                break
+            moves.append(block)
+        lengths = np.array([b.length for b in moves])
+        units = np.array([b.unit for b in moves])
+        cruise = np.array([b.feed for b in moves]) / 60
+        accel = kinematics.axisLimited(units, self.axisAccel)
+        limitsSq = np.minimum(
+            kinematics.junctionSpeedsSq(units, self.deviation, self.axisAccel),
+            np.minimum(cruise[:-1], cruise[1:]) ** 2,
+        )
+        speedsSq = kinematics.planJunctions(
+            lengths, accel, limitsSq, entrySq=self.entrySq
+        )
+        head.duration = float(
+            kinematics.segmentTimes(
+                lengths[:1], accel[:1], speedsSq[:1], speedsSq[1:2], cruise[:1]
+            )[0]
+        )
+        head.exitSq = float(speedsSq[1])
+
+    def nextEvent(self):
+        """
+        Time the running block finishes, None if nothing is running
+        """
+        if self.planner and not self.hold:
+            return self.planner[0].end
+        return None
+
+    def advance(self, until: float):
+        """
+        Run the machine up to until, in simulated seconds
+        """
+        while self.planner and self.planner[0].end <= until:
+            if self.hold:
+                break
+            head = self.planner.popleft()
+            self.clock = max(self.clock, head.end)
+            self.machinePosition = head.target
+            self.stats["motionSeconds"] += head.duration
+            if head.homing:
+                self.alarm = False
+                self.position = np.zeros(3)
+                self.machinePosition = np.zeros(3)
+            self.entrySq = head.exitSq
+            if self.planner:
+                self._startHead()
+                self._replan()
+            else:
+                self.entrySq = 0.0
+                # stopping after a dwell or homing isn't a starvation
+                self.idleSince = None if head.sync else self.clock
+            self._execute()
+        if self.hold and self.planner:
+            # a held block finishes later by however long it is held
+            self.planner[0].start += max(until - self.clock, 0)
+        self.clock = max(self.clock, until)
+
+    def drain(self):
+        """
+        Run until everything received has been done
+        """
+        while (event := self.nextEvent()) is not None:
+            self.advance(event)
+
+    def report(self):
+        """
+        stats with the lines per second painted and the simulated time
+        """
+        report = dict(self.stats)
+        report["simulatedSeconds"] = self.clock
+        report["linesPerSecond"] = self.stats["lines"] / self.clock if self.clock else 0
+        return report
+
+
+class SimSerial:
+    """
+    In process stand in for serial.Serial, talking to a GrblSim.
+
+    With timeScale None the simulated clock only moves on while the host
+    waits on a readline, so a job runs as fast as it can be compiled and
+    the host's time is free. Otherwise it follows the wall clock, timeScale
+    times faster, and time the host spends counts.
+    readline returns b"" when nothing more can arrive, rather than waiting
+    forever.
+    With virtual time the clock would run on whenever a reader thread
+    waits, so use SerialSession(readerThread=False), which only reads
+    when it is waiting on GRBL.
+    """
+
+    def __init__(self, sim: GrblSim = None, timeScale=None):
+        self.sim = sim if sim is not None else GrblSim()
+        self.timeScale = timeScale
+        self.writes = 0
+        self.is_open = True
+        self._start = time.monotonic()
+        # responses already waiting when the last write was sent,
+        # flushInput drops these but not the answers to that write
+        self._stale = 0
+        # held while the simulator is used, a SerialSession reads from
+        # its own thread
+        self._changed = threading.Condition()
+
+    def _now(self):
+        return (time.monotonic() - self._start) * self.timeScale
+
+    def _catchUp(self):
+        if self.timeScale is not None:
+            self.sim.advance(self._now())
+
+    def write(self, data):
+        with self._changed:
+            self._catchUp()
+            self._stale = len(self.sim.output)
+            self.sim.receive(bytes(data))
+            self.writes += 1
+            self._changed.notify_all()
+        return len(data)
+
+    def readline(self):
+        with self._changed:
+            while True:
+                self._catchUp()
+                if self.sim.output:
+                    self._stale = max(self._stale - 1, 0)
+                    return self.sim.output.popleft()
+                event = self.sim.nextEvent()
+                if event is None:
+                    return b""
+                if self.timeScale is None:
+                    self.sim.advance(event)
+                else:
+                    # a write from another thread can answer sooner
+                    self._changed.wait(max(event - self._now(), 0) / self.timeScale)
+
+    def inWaiting(self):
+        with self._changed:
+            self._catchUp()
+            return sum(len(line) for line in self.sim.output)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def flushInput(self):
+        with self._changed:
+            for _ in range(self._stale):
+                self.sim.output.popleft()
+            self._stale = 0
+
+    reset_input_buffer = flushInput
+
+    def close(self):
+        self.is_open = False
+
+
+class PtyServer(threading.Thread):
+    """
+    Serves a GrblSim on a pseudo terminal, port is the device to open,
+    with SerialSession(port=...) or any serial program.
+    Simulated time follows the wall clock, timeScale times faster.
+    """
+
+    def __init__(self, sim: GrblSim = None, timeScale=1.0):
+        super().__init__(name="grbl-sim", daemon=True)
+        import pty
+        import tty
+
+        self.sim = sim if sim is not None else GrblSim()
+        self.timeScale = timeScale
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.stopped = threading.Event()
+
+    def run(self):
+        start = time.monotonic()
+        while not self.stopped.is_set():
+            now = (time.monotonic() - start) * self.timeScale
+            self.sim.advance(now)
+            self._send()
+            event = self.sim.nextEvent()
+            timeout = 0.05
+            if event is not None:
+                timeout = min(max(event - now, 0) / self.timeScale, timeout)
+            ready, _, _ = select.select([self.master], [], [], timeout)
+            if ready:
+                data = os.read(self.master, 4096)
+                self.sim.advance((time.monotonic() - start) * self.timeScale)
+                self.sim.receive(data)
+                self._send()
+
+    def _send(self):
+        while self.sim.output:
+            os.write(self.master, self.sim.output.popleft())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def runTestJob(transport: SimSerial):
+    """
+    main.test's circle stack job, streamed to the simulator behind transport,
+    returns the simulator's report
+    """
+    from main import test
+    from session import SerialSession
+    from testStuff import dataCreators
+
+    items = dataCreators.CircleStack.create(6, 75, (300, 650))
+    for item in items:
+        item.update({"color": "1 0xff000000"})
+    session = SerialSession(
+        transport=transport, wakeDelay=0, readerThread=transport.timeScale is not None
+    )
+    start = time.perf_counter()
+    # not the tracked test_command_output.txt
+    with tempfile.TemporaryDirectory() as tmp:
+        test(items, session=session, output=os.path.join(tmp, "commands.txt"))
+    transport.sim.drain()
+    report = transport.sim.report()
+    report["wallSeconds"] = time.perf_counter() - start
+    report["writes"] = transport.writes
+    report["streamer"] = session.streamer.report()
+    session.streamer.stop()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pty", action="store_true", help="serve on a pty")
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=None,
+        help="simulated seconds per wall second, virtual time if not given",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.pty:
+        server = PtyServer(timeScale=args.time_scale or 1.0)
+        server.start()
+        print(f"GRBL simulator on {server.port}")
+        try:
+            server.join()
+        except KeyboardInterrupt:
+            server.stop()
+        return
+    report = runTestJob(SimSerial(timeScale=args.time_scale))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
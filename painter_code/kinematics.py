@@ -0,0 +1,161 @@
+import math
+import numpy as np
+from const import *
+
+# speeds are mm/s and accelerations mm/s^2 here, feeds in and out are mm/min
+
+
+def segmentVectors(xyz):
+    """
+    Length and unit direction of each segment between consecutive points,
+    zero length segments have a NaN direction
+    """
+    deltas = np.diff(xyz, axis=0)
+    lengths = np.linalg.norm(deltas, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        units = deltas / lengths[:, None]
+    return lengths, units
+
+
+def axisLimited(units, axisValues=AXIS_ACCELERATION):
+    """
+    Largest value along each direction that keeps every axis within its
+    own limit, how GRBL limits acceleration by axis
+    """
+    axisValues = np.asarray(axisValues, dtype=np.float64)
+    with np.errstate(divide="ignore"):
+        perAxis = axisValues / np.abs(units)
+    return perAxis.min(axis=1)
+
+
+def junctionSpeedsSq(units, deviation=JUNCTION_DEVIATION, axisAccel=AXIS_ACCELERATION):
+    """
+    Max squared speed through the junction between each pair of consecutive
+    segments, from GRBL's junction deviation model.
+    Straight through is unlimited, a full reversal is 0.
+    """
+    prev, nxt = units[:-1], units[1:]
+    cosTheta = -np.einsum("ij,ij->i", prev, nxt)
+    # acceleration along the direction the velocity changes in
+    change = nxt - prev
+    with np.errstate(invalid="ignore", divide="ignore"):
+        change /= np.linalg.norm(change, axis=1)[:, None]
+        accel = axisLimited(change, axisAccel)
+        sinHalf = np.sqrt(np.clip(0.5 * (1 - cosTheta), 0, 1))
+        speedSq = accel * deviation * sinHalf / (1 - sinHalf)
+    speedSq = np.where(cosTheta < -0.999999, np.inf, speedSq)
+    return np.where(cosTheta > 0.999999, 0.0, speedSq)
+
+
+def planJunctions(lengths, accel, limitsSq, entrySq=0.0, exitSq=0.0):
+    """
+    Squared speed at each of the len(lengths) + 1 junctions, after the
+    forward (accelerate) and backward (decelerate) passes.
+
+    Both passes are prefix minimums: v[k]^2 = min over m <= k of
+    limit[m] + S[k] - S[m], where S is the running sum of 2 * a * L,
+    so they are np.minimum.accumulate rather than a loop.
+    """
+    limits = np.concatenate(([entrySq], limitsSq, [exitSq]))
+    reach = np.concatenate(([0.0], np.cumsum(2 * accel * lengths)))
+    forward = reach + np.minimum.accumulate(limits - reach)
+    back = reach[-1] - reach
+    backward = back + np.minimum.accumulate((limits - back)[::-1])[::-1]
+    return np.maximum(np.minimum(forward, backward), 0)
+
+
+def peakSpeeds(lengths, accel, startSq, endSq, cruise):
+    """
+    Top speed reached in each segment, the cruise speed or the point where
+    accelerating from the start meets decelerating to the end
+    """
+    peakSq = (startSq + endSq + 2 * accel * lengths) / 2
+    return np.minimum(np.sqrt(peakSq), cruise)
+
+
+def segmentTimes(lengths, accel, startSq, endSq, cruise):
+    """
+    Time in seconds for each segment with a trapezoidal speed profile
+    """
+    peak = peakSpeeds(lengths, accel, startSq, endSq, cruise)
+    vs, ve = np.sqrt(startSq), np.sqrt(endSq)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rampDistance = (2 * peak**2 - startSq - endSq) / (2 * accel)
+        cruiseTime = np.maximum(lengths - rampDistance, 0) / peak
+        times = (peak - vs) / accel + (peak - ve) / accel + cruiseTime
+    return np.where(lengths > 0, np.nan_to_num(times), 0.0)
+
+
+def planSegments(
+    xyz,
+    feeds,
+    axisAccel=AXIS_ACCELERATION,
+    deviation=JUNCTION_DEVIATION,
+):
+    """
+    Plan a path through xyz that starts and ends at rest.
+
+    Parameters
+    ----------
+    xyz : (n, 3) array
+    feeds : (n - 1,) array
+        max feed of each segment in mm/min
+
+    Returns
+    -------
+    peak feed in mm/min and time in seconds for each segment
+    """
+    lengths, units = segmentVectors(xyz)
+    moving = lengths > 0
+    peaks = np.zeros(len(lengths))
+    times = np.zeros(len(lengths))
+    if not moving.any():
+        return peaks, times
+    # zero length segments are skipped, as GRBL does
+    lengths, units = lengths[moving], units[moving]
+    cruise = np.asarray(feeds, dtype=np.float64)[moving] / 60
+    accel = axisLimited(units, axisAccel)
+    limitsSq = np.minimum(
+        junctionSpeedsSq(units, deviation, axisAccel),
+        np.minimum(cruise[:-1], cruise[1:]) ** 2,
+    )
+    speedsSq = planJunctions(lengths, accel, limitsSq)
+    startSq, endSq = speedsSq[:-1], speedsSq[1:]
+    peaks[moving] = peakSpeeds(lengths, accel, startSq, endSq, cruise) * 60
+    times[moving] = segmentTimes(lengths, accel, startSq, endSq, cruise)
+    return peaks, times
+
+
+def arcPoints(start, target, offsets, clockwise, tolerance=GRBL_ARC_TOLERANCE):
+    """
+    Points along a G2 (clockwise) or G3 arc from start to target around
+    start + offsets in xy, cut into straight segments within tolerance as
+    GRBL's mc_arc does. z moves evenly along the arc, the last point is
+    target. A target equal to start is a full circle.
+    """
+    start = np.asarray(start, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    center = start[:2] + np.asarray(offsets, dtype=np.float64)
+    r, rt = start[:2] - center, target[:2] - center
+    radius = float(np.hypot(*r))
+    angle = math.atan2(r[0] * rt[1] - r[1] * rt[0], r[0] * rt[0] + r[1] * rt[1])
+    if clockwise and angle >= -5e-7:
+        angle -= 2 * math.pi
+    elif not clockwise and angle <= 5e-7:
+        angle += 2 * math.pi
+    segments = 0
+    if radius > tolerance:
+        chord = math.sqrt(tolerance * (2 * radius - tolerance))
+        segments = int(abs(0.5 * angle * radius) / chord)
+    if segments < 2:
+        return target[None, :]
+    steps = np.arange(1, segments) / segments
+    theta = math.atan2(r[1], r[0]) + angle * steps
+    points = np.column_stack(
+        (
+            center[0] + radius * np.cos(theta),
+            center[1] + radius * np.sin(theta),
+            start[2] + (target[2] - start[2]) * steps,
+        )
+    )
+    return np.vstack((points, target))
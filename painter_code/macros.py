@@ -0,0 +1,157 @@
+import random
+import logging
+from gcode import Command, Macro
+from serializer import encodeCommands
+from wrappers import PaintPot, Brush
+from const import *
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MacroCache:
+    """
+    Pot refills and brush pickups and drops, compiled into Macro commands
+    by build when Backend starts so none are built, adapted and encoded
+    while painting. Ones build wasn't given are built on first use.
+
+    Each pot gets `variants` refills, built with a random.Random seeded from
+    seed and the pot index so the dips into the pot still vary between
+    refills but the same variants are built on every run. Refills cycle
+    through the variants.
+
+    Parameters
+    ----------
+    compile : callable | None
+        compile(commands, checked) is applied to each command list before
+        it is encoded: Backend arc fits it and applies its command adapters,
+        leaving out checkLimits and any other adapter that checksStroke
+        when checked is False. mirrorOnY leaves macros alone, they are in
+        machine coordinates and have no contact commands
+    uncheckedHolders, uncheckedPots : iterable of int
+        indices of the holders and pots allowed past the bed limits, their
+        macros are compiled unchecked with a warning logged once for each.
+        Any other macro that fails the checks raises
+    """
+
+    def __init__(
+        self,
+        compile=None,
+        variants=MACRO_VARIANTS,
+        seed=MACRO_SEED,
+        uncheckedHolders=UNCHECKED_HOLDERS,
+        uncheckedPots=UNCHECKED_POTS,
+    ):
+        self.compile = compile
+        self.variants = variants
+        self.seed = seed
+        self.uncheckedHolders = set(uncheckedHolders)
+        self.uncheckedPots = set(uncheckedPots)
+        # ("holder" | "pot", index) already warned about being unchecked
+        self.warned = set()
+        self.refills = {}
+        self.uses = {}
+        self.pickups = {}
+        self.drops = {}
+
+    @staticmethod
+    def brushKey(brush: Brush):
+        return brush.holder.index, brush.holderSlotIndex
+
+    def build(self, holders):
+        """
+        Build the pickups and drops for every brush in holders and the
+        refills for their pots
+        """
+        pots = {}
+        for holder in holders:
+            for brush in holder.brushes:
+                self._pickups(brush)
+                self._drop(brush)
+                pots[brush.paintPot.index] = brush.paintPot
+        for pot in pots.values():
+            self._refills(pot)
+        LOGGER.info(
+            f"Built macros for {len(self.pickups)} brushes and {len(pots)} pots"
+        )
+
+    def _checked(self, kind, index, unchecked):
+        """
+        Whether the macros of holder or pot index are checked, warning the
+        first time one isn't
+        """
+        if index not in unchecked:
+            return True
+        if (kind, index) not in self.warned:
+            self.warned.add((kind, index))
+            LOGGER.warning(f"Macros for {kind} {index} skip the bed limit checks")
+        return False
+
+    def _build(self, name, commands: "list[Command]", checked=True) -> Macro:
+        if self.compile is not None:
+            try:
+                commands = self.compile(commands, checked)
+            except Exception as e:
+                raise Exception(f"Macro {name} failed: {e}") from e
+        flags = 0
+        for command in commands:
+            flags |= command.flagBits
+        macro = Macro(name, encodeCommands(commands), flags=flags)
+        LOGGER.info(f"Macro {name} built, {len(macro.data)} bytes")
+        return macro
+
+    def _refills(self, pot: PaintPot) -> "list[Macro]":
+        if pot.index not in self.refills:
+            rng = random.Random(self.seed + pot.index)
+            checked = self._checked("pot", pot.index, self.uncheckedPots)
+            self.refills[pot.index] = [
+                self._build(f"refill pot {pot.index} #{k}", pot.use(rng=rng), checked)
+                for k in range(self.variants)
+            ]
+        return self.refills[pot.index]
+
+    def _pickups(self, brush: Brush) -> "list[Macro]":
+        key = self.brushKey(brush)
+        if key not in self.pickups:
+            name = f"holder {key[0]} slot {key[1]}"
+            checked = self._checked("holder", key[0], self.uncheckedHolders)
+            self.pickups[key] = [
+                self._build(f"pickup {name}", brush.pickup(isFirst=False), checked),
+                self._build(
+                    f"first pickup {name}", brush.pickup(isFirst=True), checked
+                ),
+            ]
+        return self.pickups[key]
+
+    def _drop(self, brush: Brush) -> Macro:
+        key = self.brushKey(brush)
+        if key not in self.drops:
+            self.drops[key] = self._build(
+                f"drop holder {key[0]} slot {key[1]}",
+                brush.drop(),
+                self._checked("holder", key[0], self.uncheckedHolders),
+            )
+        return self.drops[key]
+
+    def refill(self, pot: PaintPot, nextMove: Command = None) -> "list[Command]":
+        """
+        PaintPot.use from the cache
+        """
+        variants = self._refills(pot)
+        uses = self.uses.get(pot.index, 0)
+        macro = variants[uses % len(variants)]
+        self.uses[pot.index] = uses + 1
+        if nextMove is None:
+            return [macro]
+        return [macro, pot.moveTo(nextMove)]
+
+    def pickup(self, brush: Brush, isFirst=False) -> "list[Command]":
+        """
+        Brush.pickup from the cache
+        """
+        return [self._pickups(brush)[int(isFirst)]]
+
+    def drop(self, brush: Brush) -> "list[Command]":
+        """
+        Brush.drop from the cache
+        """
+        return [self._drop(brush)]
@@ -1,6 +1,14 @@
 import asyncio
 from preprocess import PreProcessors
 from gcode import GcodeMaker, Command
+from strokeBuffer import StrokeBuffer
+from serializer import encodeCommands
+from arcFit import fitArcs
+import wire
+from macros import MacroCache
+from estimator import Estimator, Estimate, estimate
+from profiling import NullProfiler, profiledStroke
+from scheduler import StrokeScheduler, BrushBatcher, PendingStroke, brushKey
 import commandAdapters as CA
 from const import *
 from wrappers import (
@@ -11,7 +19,7 @@ from wrappers import (
     Tracker,
     PaintPotRandom,
 )
-from session import SerialSession
+from session import SerialSession, SerialWriter, WriterStopped
 from pathlib import Path
 import json
 from PIL import Image
@@ -19,6 +27,10 @@ import websockets
 from websockets.exceptions import ConnectionClosedError
 import logging
 import time
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import functools
 
 PaintPot = PaintPotRandom
 
@@ -34,6 +46,33 @@ logging.basicConfig(
 )
 
 
+def logsEstimate(label):
+    """
+    For Backend methods that yield chunks of commands, passes the chunks on
+    and logs the estimated machine time of them all once they are done.
+    Goes outside profiledStroke, estimating is timed as its own stage.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            chunks = method(self, *args, **kwargs)
+            if not self.estimateTime:
+                yield from chunks
+                return
+            estimator = Estimator(start=self.estimatedPosition)
+            for chunk in chunks:
+                self.profiler.run("estimate", estimator.add, chunk)
+                yield chunk
+            result = estimator.result()
+            self.estimatedPosition = result.end
+            self.log.info(f"{label} estimated machine time {result}")
+
+        return wrapper
+
+    return decorator
+
+
 class Backend:
     def __init__(
         self,
@@ -44,19 +83,33 @@ class Backend:
         commandAdapters=None,
         strokeAdapters=None,
         preprocessors=None,
+        arcTolerance=None,
+        pressureConfig=None,
+        useMacros=True,
+        drawCanvas=False,
+        estimateTime=True,
+        profiler=None,
     ):
         self.log = logging.getLogger("backend")
         self.session = serialSession
         self.commandAdapters = commandAdapters if commandAdapters else []
         self.strokeAdapters = strokeAdapters if strokeAdapters else []
         self.preprocessors = preprocessors if preprocessors else []
+        # max deviation in mm when replacing points with G2/G3 arcs, None to disable
+        self.arcTolerance = arcTolerance
+        # pressure to z tables by brush size, None to use GcodeMaker's formula
+        self.pressureConfig = None
+        if pressureConfig is not None:
+            with open(pressureConfig) as f:
+                self.pressureConfig = json.load(f)
         self.needsKill = False
-        self.tracker = Tracker(
-            length=0,
-            canvas=Image.new(
+        # drawing what is painted is for debugging, Tracker.show to see it
+        canvas = None
+        if drawCanvas:
+            canvas = Image.new(
                 "RGB", (BED_MAX_X - BED_MIN_X, BED_MAX_Y - BED_MIN_Y), (255, 255, 255)
-            ),
-        )
+            )
+        self.tracker = Tracker(length=0, canvas=canvas)
         if isinstance(potConfig, str):
             with open(Path(potConfig)) as f:
                 self.pots = [PaintPot(**pot) for pot in json.load(f)]
@@ -79,11 +132,45 @@ class Backend:
             currentBrush=None,
             currentPaintPot=self.pots[0],
         )
-
-    def applyCommandAdapters(self, commands):
-        if self.commandAdapters is not None:
-            for adapter in self.commandAdapters:
-                commands = adapter(commands)
+        # log the machine time each stroke is estimated to take, see estimator
+        self.estimateTime = estimateTime
+        # machine coordinates the last estimated stroke ended at, home to start
+        self.estimatedPosition = (0.0, 0.0, 0.0)
+        # the consumer's SerialWriter while it streams, shutdown goes through it
+        self.writer = None
+        # the brush in the holder arm as far as has been sent, hand.currentBrush
+        # is the one compiled for, set by whoever streams, see consumer
+        self.loadedBrush = None
+        # held while a chunk is compiled, so shutdown never reads the Backend
+        # part way through changing it
+        self.lock = threading.Lock()
+        # xy the last compiled stroke ends at, see lastPosition
+        self.lastPoint = None
+        # times each stage of compiling, a profiling.Profiler, off by default
+        self.profiler = profiler if profiler is not None else NullProfiler()
+        # refills, pickups and drops compiled once, None to build them each time
+        self.macros = None
+        if useMacros:
+            self.macros = MacroCache(compile=self._compileMacro)
+            self.macros.build(self.holders)
+
+    def applyCommandAdapters(self, commands, isFirst=True, isLast=True, adapters=None):
+        """
+        Apply the command adapters, or just adapters if given, isFirst and
+        isLast say where commands is in the stroke when it is only a chunk
+        of it, see iterRun
+        """
+        if adapters is None:
+            adapters = self.commandAdapters
+        if adapters is not None:
+            for adapter in adapters:
+                name = f"adapter.{adapter.__name__}"
+                if getattr(adapter, "chunkEnds", False):
+                    commands = self.profiler.run(
+                        name, adapter, commands, isFirst=isFirst, isLast=isLast
+                    )
+                else:
+                    commands = self.profiler.run(name, adapter, commands)
                 self.log.info(
                     f"Command Adapter:{adapter.__name__} applied -> {len(commands)} commands"
                 )
@@ -111,51 +198,211 @@ class Backend:
         """
         Handle the gcode lines.
         """
+        commands = []
+        for chunk in self.iterHandleGCode(streamLines):
+            commands.extend(chunk)
+        self.log.info(f"{len(commands)} commands produced")
+        return commands
+
+    def iterHandleGCode(self, streamLines: list, chunkSize=None):
+        """
+        Handle the gcode lines, yielding the finished commands in chunks of
+        about chunkSize stroke points so the first chunk can be sent while
+        the rest of the stroke is still being processed.
+        Parsing, preprocessing and refills need the whole stroke and are
+        done up front, arc fitting and the adapters are done chunk by chunk.
+        With chunkSize None the whole stroke is one chunk.
+        """
+        yield from self._iterAdapt(self._compileStroke(streamLines), chunkSize)
+
+    def _compileStroke(self, streamLines) -> "list[Command]":
+        """
+        Parse, preprocess and add refills to a stroke, everything before
+        arc fitting and the adapters
+        """
         self.log.info(f"{len(streamLines)} lines recieved")
-        gcodeMaker = GcodeMaker()
-        gcodeMaker.parse(streamLines)
-        baseCommands = self.applyPreProcessors(gcodeMaker.commands)
-        self.log.info(
-            f"Preprocessed {len(gcodeMaker.commands)} commands -> {len(baseCommands)}"
+        gcodeMaker = GcodeMaker(self.pressureTable())
+        parsed = self.profiler.run("parse", gcodeMaker.parseBulk, streamLines)
+        stroke = self.applyPreProcessors(parsed)
+        self.log.info(f"Preprocessed {len(parsed)} commands -> {len(stroke)}")
+        if len(stroke):
+            self.lastPoint = float(stroke.x[-1]), float(stroke.y[-1])
+        commands = self.profiler.run("toCommands", stroke.toCommands)
+        return self.profiler.run("refill", self._handleStrokeLength, commands)
+
+    def _iterAdapt(self, baseCommands, chunkSize=None, isFirst=True, isLast=True):
+        """
+        Arc fit and adapt baseCommands about chunkSize at a time. Either way
+        the whole of baseCommands is checked before this returns: one chunk
+        is adapted here, more are checked first, see _checkStroke.
+        isFirst and isLast say whether baseCommands start and end what is
+        being sent, see runBatch
+        """
+        if chunkSize is None or not self._adaptersChunkSafe():
+            chunkSize = max(len(baseCommands), 1)
+        if chunkSize >= len(baseCommands):
+            return list(self._adaptChunks(baseCommands, chunkSize, isFirst, isLast))
+        self._checkStroke(baseCommands, isFirst, isLast)
+        return self._adaptChunks(baseCommands, chunkSize, isFirst, isLast)
+
+    def _adaptChunks(self, baseCommands, chunkSize, isFirst=True, isLast=True):
+        for start in range(0, len(baseCommands), chunkSize):
+            chunk = self.applyArcFitting(baseCommands[start : start + chunkSize])
+            yield self.applyCommandAdapters(
+                chunk,
+                isFirst=isFirst and start == 0,
+                isLast=isLast and start + chunkSize >= len(baseCommands),
+            )
+
+    def _checkStroke(self, baseCommands, isFirst=True, isLast=True):
+        """
+        Apply the adapters, up to the last one that checksStroke such as
+        checkLimits, to the whole of baseCommands and discard the result,
+        so a stroke that would fail part way is rejected before any of it
+        is sent. Arcs can bulge past the points checked here, those are
+        still checked chunk by chunk once they are fitted.
+        """
+        checks = [
+            i
+            for i, adapter in enumerate(self.commandAdapters)
+            if getattr(adapter, "checksStroke", False)
+        ]
+        if checks:
+            self.profiler.run(
+                "checkStroke",
+                self.applyCommandAdapters,
+                baseCommands,
+                isFirst=isFirst,
+                isLast=isLast,
+                adapters=self.commandAdapters[: checks[-1] + 1],
+            )
+
+    def _liftOnError(self, chunks):
+        """
+        Pass on chunks, and if making one fails once some have been sent,
+        send a lift before raising so the brush isn't left down on the bed
+        """
+        sent = False
+        try:
+            for chunk in chunks:
+                yield chunk
+                sent = True
+        except Exception:
+            if sent:
+                self.log.error("Stroke failed part way through, lifting the brush")
+                yield [Command(z=0, f=BASE_FEED_RATE, flags=["adapter", "lift"])]
+            raise
+
+    def _compileMacro(self, commands, checked=True):
+        """
+        Arc fit and adapt a macro as if it were in the middle of a stroke,
+        without the adapters that checksStroke unless checked, see MacroCache
+        """
+        adapters = self.commandAdapters
+        if not checked:
+            adapters = [a for a in adapters if not getattr(a, "checksStroke", False)]
+        return self.applyCommandAdapters(
+            self.applyArcFitting(commands),
+            isFirst=False,
+            isLast=False,
+            adapters=adapters,
         )
 
-        baseCommands = self._handleStrokeLength(baseCommands)
-        commands = self.applyCommandAdapters(baseCommands)
-        self.log.info(f"{len(commands)} commands produced")
-        return commands
+    def refill(self, brush: Brush, nextMove: Command = None):
+        if self.macros is not None:
+            return self.macros.refill(brush.paintPot, nextMove)
+        return brush.refill(nextMove=nextMove)
+
+    def pickup(self, brush: Brush, isFirst=False):
+        if self.macros is not None:
+            return self.macros.pickup(brush, isFirst=isFirst)
+        return brush.pickup(isFirst=isFirst)
 
-    def applyPreProcessors(self, commands: "list[Command]") -> "list[Command]":
+    def drop(self, brush: Brush):
+        if self.macros is not None:
+            return self.macros.drop(brush)
+        return brush.drop()
+
+    def lastPosition(self):
+        """
+        xy of the last stroke point painted, in the app's coordinates,
+        None before the first stroke
+        """
+        return self.lastPoint
+
+    def pressureTable(self):
+        """
+        Pressure to z table for the current brush
+        """
+        if self.pressureConfig is None:
+            return None
+        brush = self.hand.currentBrush
+        return GcodeMaker.loadPressureTable(
+            self.pressureConfig, None if brush is None else brush.size
+        )
+
+    def _adaptersChunkSafe(self):
+        unsafe = [
+            a.__name__
+            for a in self.commandAdapters
+            if not getattr(a, "chunkSafe", False)
+        ]
+        if unsafe:
+            self.log.warning(
+                f"Adapters {unsafe} need the whole stroke, not splitting into chunks"
+            )
+        return not unsafe
+
+    def applyPreProcessors(self, commands: StrokeBuffer) -> StrokeBuffer:
         """
         Apply changes to commands produced by GcodeMaker,
-        before anything such as refill, brush, and lift-off commands are added
+        before anything such as refill, brush, and lift-off commands are added.
+        Preprocessors work on the whole stroke as a StrokeBuffer
         """
         for pp in self.preprocessors:
-            commands = pp(commands)
+            commands = self.profiler.run(f"preprocess.{pp.__name__}", pp, commands)
         return commands
 
+    def applyArcFitting(self, commands: "list[Command]") -> "list[Command]":
+        """
+        Replace runs of points on a circle with G2/G3 arcs,
+        after the preprocessors and refills, and before the adapters
+        """
+        if self.arcTolerance is None:
+            return commands
+        fitted = self.profiler.run(
+            "arcFit", fitArcs, commands, tolerance=self.arcTolerance
+        )
+        self.log.info(
+            f"Arc fitting: {len(commands)} commands -> {len(fitted)}, "
+            f"{len(commands) - len(fitted)} lines removed"
+        )
+        return fitted
+
     def _handleStrokeLength(self, commands: "list[Command]") -> "list[Command]":
         """
         Add refills to the commands.
         NOTE: the commands MUST be just those from the raw data, parsed by gcodeMaker.
         Any commands added by adapters, or by this class, may be removed
+
+        The stroke's arc length is a prefix sum built once, so the tracker
+        length at any command, the remaining length, and the next point the
+        limit is crossed are lookups rather than sums over the stroke.
         """
-        # find the total length of the stroke
         returnCommands = []
 
         limit = self.hand.currentBrush.maxStrokeLength
-        total = 0
-        distVals = []
-        filtCommands = list(filter(lambda c: c.hasFlag("contact"), commands))
+        filtCommands = [c for c in commands if c.hasFlag("contact")]
         if self.tracker.length > limit:
             self.log.info(
                 f"Refill, reason = Leftover stroke length from previous stroke"
             )
-            refillCommands = self.hand.currentBrush.refill(nextMove=filtCommands[0])
+            refillCommands = self.refill(
+                self.hand.currentBrush, nextMove=filtCommands[0]
+            )
             returnCommands.extend(refillCommands)
             self.tracker.length = 0
-        total += self.tracker.length
-        hasStartRefill = False
-        self.log.info(f"Total length: {total}, limit: {limit}")
+        self.log.info(f"Total length: {self.tracker.length}, limit: {limit}")
         if not len(filtCommands) == len(commands):
             self.log.warning(
                 """_handleStrokeLength: commands removed by filtering,
@@ -163,17 +410,19 @@ class Backend:
                 other than those produced by gcodeMaker"""
             )
 
-        for i, command in enumerate(filtCommands[:-1]):
-            dist = command.distanceTo(filtCommands[i + 1])
-            distVals.append(dist)
-            total += dist
+        # distance[i] is the stroke length up to filtCommands[i]
+        distance = StrokeBuffer.fromCommands(filtCommands).arcLengths()
+        strokeLength = distance[-1]
+        total = self.tracker.length + strokeLength
 
         if (
             limit * 0.9 < total < limit * 1.1 and returnCommands == []
         ):  # check that returnCommands is empty
             # (not added to by the self.tracker.length > limit block)
             self.log.info("Refill, reason = Stroke length is within 10% of limit")
-            refillCommands = self.hand.currentBrush.refill(nextMove=filtCommands[0])
+            refillCommands = self.refill(
+                self.hand.currentBrush, nextMove=filtCommands[0]
+            )
 
             self.tracker.length = 0
             returnCommands.extend(commands)
@@ -181,55 +430,69 @@ class Backend:
             return returnCommands
 
         elif total > limit:
-            for i, command in enumerate(filtCommands):
-                self.tracker.add(command)
-
-                if self.tracker.length > self.hand.currentBrush.maxStrokeLength:
-                    # if the remaining stroke length is less that 25% of the max stroke length,
-                    # just refill at the start of next stroke
-                    if (
-                        sum(distVals[i:])
-                        < 0.25 * self.hand.currentBrush.maxStrokeLength
-                    ):
-                        self.log.info(
-                            """Skipping Refill, reason = remainder of stroke exceeds
-                            max stroke length by less than 25%"""
-                        )
-                        # add the rest of the commands we havent iterated over
-                        for c in filtCommands[i:]:
-                            self.tracker.add(c)
-                        returnCommands.extend(filtCommands[i:])
-                        # dont reset tracker length, so will refill next stroke start
-                        return returnCommands
-                    # if we exceed the max length within the first 25% of the stroke,
-                    # refill at the start of the stroke
-                    elif (
-                        sum(distVals[:i]) < 0.25 * sum(distVals) and not hasStartRefill
-                    ):
-                        self.log.info(
-                            """Refill, reason = refilling at start of stroke as stroke length
-                            exceeded within the first 25% of the stroke"""
-                        )
-                        # add the rest of the commands we havent iterated over
-                        returnCommands.append(command)
-                        refillCommands = self.hand.currentBrush.refill(nextMove=command)
-
-                        # add the refill commands to the start of returnCommands
-                        returnCommands = refillCommands + returnCommands
-                        self.tracker.length = 0
-                        hasStartRefill = True
-                    # otherwise, simply add a refill step before the current command
-                    else:
-                        self.log.info(
-                            f"""Refill, reason = Stroke length is over limit
-                            ({self.tracker.length} > {self.hand.currentBrush.maxStrokeLength})"""
-                        )
-                        returnCommands.append(command)
-                        refillCommands = self.hand.currentBrush.refill(nextMove=command)
-                        returnCommands.extend(refillCommands)
-                        self.tracker.length = 0
-
+            # length the tracker has added once it has reached each command,
+            # the first includes the move from the last tracked command
+            lead = 0
+            if self.tracker.last is not None:
+                lead = self.tracker.last.distanceTo(filtCommands[0])
+            tracked = lead + distance
+            # tracked value and tracker length at the last refill
+            base, offset = 0.0, self.tracker.length
+            hasStartRefill = False
+            done = 0  # commands before this are in returnCommands and the tracker
+            while True:
+                # first command that takes the tracker over the limit
+                i = int(np.searchsorted(tracked, base + limit - offset, side="right"))
+                if i >= len(filtCommands):
+                    break
+                returnCommands.extend(filtCommands[done:i])
+                self.tracker.addMany(filtCommands[done : i + 1])
+                command = filtCommands[i]
+                # if the remaining stroke length is less that 25% of the max stroke length,
+                # just refill at the start of next stroke
+                if strokeLength - distance[i] < 0.25 * limit:
+                    self.log.info(
+                        """Skipping Refill, reason = remainder of stroke exceeds
+                        max stroke length by less than 25%"""
+                    )
+                    # add the rest of the commands we havent iterated over
+                    self.tracker.addMany(filtCommands[i:])
+                    returnCommands.extend(filtCommands[i:])
+                    # dont reset tracker length, so will refill next stroke start
+                    return returnCommands
+                # if we exceed the max length within the first 25% of the stroke,
+                # refill at the start of the stroke
+                elif distance[i] < 0.25 * strokeLength and not hasStartRefill:
+                    self.log.info(
+                        """Refill, reason = refilling at start of stroke as stroke length
+                        exceeded within the first 25% of the stroke"""
+                    )
+                    returnCommands.append(command)
+                    refillCommands = self.refill(
+                        self.hand.currentBrush, nextMove=command
+                    )
+
+                    # add the refill commands to the start of returnCommands
+                    returnCommands = refillCommands + returnCommands
+                    hasStartRefill = True
+                # otherwise, simply add a refill step before the current command
+                else:
+                    self.log.info(
+                        f"""Refill, reason = Stroke length is over limit
+                        ({self.tracker.length} > {limit})"""
+                    )
+                    returnCommands.append(command)
+                    refillCommands = self.refill(
+                        self.hand.currentBrush, nextMove=command
+                    )
+                    returnCommands.extend(refillCommands)
+                self.tracker.length = 0
+                base, offset = tracked[i], 0
                 returnCommands.append(command)
+                done = i + 1
+
+            returnCommands.extend(filtCommands[done:])
+            self.tracker.addMany(filtCommands[done:])
             return returnCommands
         else:
             return commands
@@ -242,7 +505,7 @@ class Backend:
             self.log.info(
                 f"Drop commands issued for brush {self.hand.currentBrush.size}"
             )
-            commands.extend(self.hand.currentBrush.drop())
+            commands.extend(self.drop(self.hand.currentBrush))
         newBrush = None
         for holder in self.holders:
             # colorIdx is the same as the holder index,
@@ -259,10 +522,10 @@ class Backend:
 
         newBrush.used = True
         # get the new brush
-        commands.extend(newBrush.pickup(isFirst=self.hand.currentBrush is None))
+        commands.extend(self.pickup(newBrush, isFirst=self.hand.currentBrush is None))
         self.log.info(f"Pick up commands issued for brush {newBrush.size}")
         # fill it with paint
-        commands.extend(newBrush.refill())
+        commands.extend(self.refill(newBrush))
         self.hand.currentBrush = newBrush
         self.log.info(f"Refill commands issued for brush {newBrush.size}")
         self.tracker.length = 0
@@ -275,31 +538,146 @@ class Backend:
         if self.needsKill:
             return
         allCommands = []
+        for chunk in self.iterRun(streamData):
+            allCommands.extend(chunk)
+        return allCommands
+
+    def estimate(self, commands) -> Estimate:
+        """
+        Estimated machine time of commands, anything Estimator.add takes,
+        from where the last estimated stroke ended
+        """
+        return estimate(commands, start=self.estimatedPosition)
+
+    @logsEstimate("Stroke")
+    @profiledStroke("stroke")
+    def iterRun(self, streamData, chunkSize=None):
+        """
+        Run a single input, yielding commands as they are ready.
+        Any brush change is yielded first, then the stroke in chunks of
+        about chunkSize points, see iterHandleGCode.
+        """
+        if self.needsKill:
+            return
+
+        brushCommands = self._selectBrush(streamData)
+        # the stroke is compiled and checked before the brush change is sent
+        chunks = self._iterAdapt(self._compileStroke(streamData["data"]), chunkSize)
+        if brushCommands:
+            yield self.applyArcFitting(brushCommands)
 
+        yield from self._liftOnError(chunks)
+
+    @logsEstimate("Batch")
+    @profiledStroke("batch")
+    def runBatch(self, items, chunkSize=None):
+        """
+        Run several inputs that use the same brush as one unit, yielding
+        commands as they are ready like iterRun.
+        Between strokes the brush only lifts to BRUSH_BACKOFF_Z and travels
+        to the next start, rather than each stroke lifting to the top and
+        being checked and sent on its own.
+        Each stroke is compiled once the one before it has been yielded, so
+        the first stroke can be sent while the rest are compiled.
+        """
+        if self.needsKill or not items:
+            return
+        keys = {brushKey(item) for item in items}
+        if len(keys) > 1:
+            raise ValueError(f"runBatch inputs must all use the same brush, {keys}")
+        self.log.info(f"Batch of {len(items)} strokes")
+
+        brushCommands = self._selectBrush(items[0])
+        strokes = self._iterBatchStrokes(items)
+        count = len(items)
+        if chunkSize is None or not self._adaptersChunkSafe():
+            # adapters that need the whole stroke get the whole batch
+            strokes = iter([[c for stroke in strokes for c in stroke]])
+            count, chunkSize = 1, None
+        # the first stroke is compiled and checked before the brush change is sent
+        chunks = self._iterAdapt(next(strokes), chunkSize, isLast=count == 1)
+        if brushCommands:
+            yield self.applyArcFitting(brushCommands)
+
+        def batchChunks():
+            yield from chunks
+            for index, stroke in enumerate(strokes, start=1):
+                yield from self._iterAdapt(
+                    stroke, chunkSize, isFirst=False, isLast=index == count - 1
+                )
+
+        yield from self._liftOnError(batchChunks())
+
+    def iterEncoded(self, items, chunkSize=STREAM_CHUNK_SIZE):
+        """
+        runBatch's chunks as the consumer streams them, (data, commands)
+        pairs of each chunk encoded and the commands it was encoded from,
+        keeping the modal state so words are elided across chunks
+        """
+        modalState = {}
+        for commands in self.runBatch(items, chunkSize=chunkSize):
+            data = self.profiler.run("serialize", encodeCommands, commands, modalState)
+            yield data, commands
+
+    def _iterBatchStrokes(self, items):
+        """
+        The base commands of each stroke in items as they are compiled,
+        each after the first starting with the travel from the one before
+        """
+        painted = False
+        for item in items:
+            stroke = self._compileStroke(item["data"])
+            if painted and stroke:
+                stroke = self._strokeTransition(stroke[0]) + stroke
+            painted = painted or bool(stroke)
+            yield stroke
+
+    def _strokeTransition(self, nextCommand: Command) -> "list[Command]":
+        """
+        Lift off the end of one stroke in a batch and travel to the start of
+        the next, which may be a refill rather than a stroke point
+        """
+        commands = [
+            Command(z=BRUSH_BACKOFF_Z, f=BASE_FEED_RATE, flags=["adapter", "lift"])
+        ]
+        if nextCommand.hasFlag("contact"):
+            # contact so the travel is mirrored with the stroke, see startAndEndLift
+            commands.append(
+                Command(
+                    x=nextCommand.x,
+                    y=nextCommand.y,
+                    z=BRUSH_BACKOFF_Z,
+                    f=BASE_FEED_RATE,
+                    flags=["contact", "lift"],
+                )
+            )
+        return commands
+
+    def _selectBrush(self, streamData) -> "list[Command]":
+        """
+        Commands to change to the brush streamData is painted with,
+        empty if it is already loaded
+        """
         # setup for color and brush
         size = float(streamData["size"].split(" ")[1])
         sizeIdx = 3 - int(streamData["size"].split(" ")[0])
         colorIdx = int(streamData["color"].split(" ")[0]) - 1
-        lines = streamData["data"]
         self.log.info(
-            f"""Stream recieved: lines={len(lines)}, size={size},
+            f"""Stream recieved: lines={len(streamData["data"])}, size={size},
             sizeIdx={sizeIdx},colorIdx={colorIdx}"""
         )
         if self.hand.currentBrush is None:
             self.log.info(f"No brush selected, selecting brush {size}")
-            commands = self.swapBrush(colorIdx, sizeIdx)
-            allCommands.extend(commands)
+            return self.swapBrush(colorIdx, sizeIdx)
 
         elif (
             sizeIdx != self.hand.currentBrush.holderSlotIndex
             or colorIdx != self.hand.currentBrush.paintPot.index
         ):
-            allCommands.extend(self.swapBrush(colorIdx, sizeIdx))
+            commands = self.swapBrush(colorIdx, sizeIdx)
             self.log.info(f"Changing brush to {size} {colorIdx}")
-
-        strokeCommands = self.handleGCode(lines)
-        allCommands.extend(strokeCommands)
-        return allCommands
+            return commands
+        return []
 
     def shutdown(self):
         """
@@ -307,12 +685,28 @@ class Backend:
         """
         KILL_EVENT.set()
         self.needsKill = True
-        commands = []
-        if self.hand.currentBrush is not None:
-            self.log.info("Shutdown: Putting brush back in holder")
-            commands.extend(self.hand.currentBrush.drop())
-            self.session.safeWrite(commands)
-        self.session.home()
+
+        def park():
+            commands = []
+            with self.lock:
+                brush = self.loadedBrush
+                self.loadedBrush = None
+            if brush is not None:
+                self.log.info("Shutdown: Putting brush back in holder")
+                # streaming can stop part way through a stroke, lift off first
+                commands.append(
+                    Command(z=0, f=BASE_FEED_RATE, flags=["adapter", "lift"])
+                )
+                commands.extend(brush.drop())
+            if commands:
+                self.session.safeWrite(commands)
+            self.session.home()
+
+        if self.writer is not None:
+            # after the chunk the writer is streaming, not in between its lines
+            self.writer.stop(then=park)
+        else:
+            park()
         return True
 
 
@@ -320,16 +714,22 @@ async def producer(queue):
     logger = logging.getLogger("producer")
 
     async def toQueue(res):
-        decoded = json.loads((json.loads(res))["data"])
-        decoded["data"] = json.loads(decoded["data"])
-        await queue.put(decoded)
+        # binary frames are packed strokes, text frames the nested JSON,
+        # stamped on arrival so time spent in the queue counts as waiting
+        await queue.put((time.monotonic(), wire.decodeMessage(res)))
 
-    while True:
-        async with websockets.connect("---REDACTED---") as websocket:
+    while not KILL_EVENT.is_set():
+        async with websockets.connect(
+            "---REDACTED---", subprotocols=wire.SUBPROTOCOLS
+        ) as websocket:
+            logger.info(f"Connected, stroke format {websocket.subprotocol or 'json'}")
             while not KILL_EVENT.is_set():
                 try:
                     res = await asyncio.wait_for(websocket.recv(), timeout=10)
                     logger.info("Recieved Data")
+                    if KILL_EVENT.is_set():
+                        # nothing paints strokes queued after shutdown
+                        break
                     await toQueue(res)
                     logger.info("Data queued")
                 except ConnectionClosedError:
@@ -339,36 +739,117 @@ async def producer(queue):
                     pass
 
 
-async def consumer(queue, session, handler: Backend):
+async def consumer(queue, session, handler: Backend, batchStrokes=True):
+    """
+    Paint the strokes from the queue, (arrival time, stroke) pairs as
+    producer queues them. With batchStrokes, each batch of strokes that
+    share a brush is compiled and streamed as one unit, see
+    Backend.runBatch, otherwise each stroke is run on its own.
+
+    Compiling runs in a single worker executor and streaming in a
+    SerialWriter thread, so the next unit is compiled while the last one
+    is streamed and the event loop is free for the producer.
+    Each stroke taken off the queue is marked done once its unit is sent,
+    or when the consumer stops or the writer drops it, so queue.join
+    always returns.
+    """
     logger = logging.getLogger("consumer")
+    loop = asyncio.get_running_loop()
     i = 0
     while not session.ready:
-        time.sleep(0.2)
+        await asyncio.sleep(0.2)
         if i % 30 == 0:
             print("waiting")
             i = 0
         i += 1
 
-    while not KILL_EVENT.is_set():
-        data = await queue.get()
-        logger.info("Data recieved from queue")
-        commands = handler.run(data)
-        logger.info("Data processed")
-        res = session.safeWrite(commands)
-
-        if "ALARM" in res:
-            logger.critical(
-                f"ALARM: {res}\nFrom commands: {''.join([str(c) for c in commands])}"
-            )
-        logger.info("Data sent to arduino")
+    writer = SerialWriter(session)
+    writer.start()
+    handler.writer = writer
+    # one worker, compiling changes the Backend's brush and tracker state
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compile")
 
-        print(res)
+    def markDone(count):
+        for _ in range(count):
+            queue.task_done()
         handler.log.info("Commands sent")
 
-        queue.task_done()
-
-
-def test(test_data):
+    def brushLoaded(brush):
+        handler.loadedBrush = brush
+
+    # strokes taken off the queue, and the sizes of the units whose done
+    # marker has gone to the writer, which marks those strokes done
+    taken = 0
+    handedOff = []
+    # the brush the last chunk given to the writer was compiled for
+    queuedBrush = handler.loadedBrush
+
+    def compileUnit(unit):
+        nonlocal queuedBrush
+        chunks = handler.iterEncoded(unit)
+        # stream each chunk as soon as it is compiled
+        while True:
+            with handler.lock:
+                chunk = next(chunks, None)
+                brush = handler.hand.currentBrush
+            if chunk is None:
+                break
+            data, commands = chunk
+            onSent = None
+            if brush is not queuedBrush:
+                # this chunk changes the brush, it is loaded once it is sent
+                queuedBrush = brush
+                onSent = functools.partial(brushLoaded, brush)
+            writer.write(data, commands, onSent=onSent)
+        # the queue items are done once everything before this is sent,
+        # or dropped if the writer stops first
+        done = lambda: loop.call_soon_threadsafe(markDone, len(unit))
+        writer.write(b"", onSent=done, onDropped=done)
+        handedOff.append(len(unit))
+
+    scheduler = StrokeScheduler()
+    batcher = BrushBatcher()
+    # strokes taken off the queue but not painted yet
+    pending = []
+    try:
+        while not KILL_EVENT.is_set():
+            received = [] if pending else [await queue.get()]
+            while not queue.empty():
+                received.append(queue.get_nowait())
+            taken += len(received)
+            pending.extend(PendingStroke.fromItem(*item) for item in received)
+            # group the strokes waiting by brush, where painter's order allows,
+            # then order each group to cut the travel between its strokes
+            batch = [stroke.item for stroke in batcher.take(pending)]
+            batch = scheduler.order(batch, start=handler.lastPosition())
+            logger.info(f"{len(batch)} strokes taken from queue")
+
+            units = [batch] if batchStrokes else [[data] for data in batch]
+            for unit in units:
+                await loop.run_in_executor(executor, compileUnit, unit)
+                logger.info("Data processed and queued for the arduino")
+    except WriterStopped:
+        logger.info("Writer stopped, no more strokes are painted")
+    finally:
+        # doesn't block, the writer drops what is queued and stops
+        writer.stop()
+        handler.writer = None
+        # a unit being compiled stops at its next write, wait for it so
+        # nothing more is handed to the writer after the count below
+        await loop.run_in_executor(None, executor.shutdown)
+        for _ in range(taken - sum(handedOff)):
+            queue.task_done()
+        while not queue.empty():
+            queue.get_nowait()
+            queue.task_done()
+
+
+def test(test_data, session=None, output=ROOT / "test_command_output.txt"):
+    """
+    Paint test_data, one stroke or a list, on session,
+    a new SerialSession if not given, appending the commands sent to
+    output, None to not keep them
+    """
     if not isinstance(test_data, list):
         test_data = [test_data]
     logger = logging.getLogger("main")
@@ -377,16 +858,18 @@ def test(test_data):
     HANDLER = Backend(
         brushConfig=str(ROOT / "configs/brushConfig.json"),
         holderConfig=str(ROOT / "configs/brushHolderConfig.json"),
+        pressureConfig=str(ROOT / "configs/pressureConfig.json"),
         serialSession=None,
         commandAdapters=[CA.startAndEndLift, CA.mirrorOnY, CA.checkLimits],
     )
-    SESSION = SerialSession()
+    SESSION = session if session is not None else SerialSession()
     for item in test_data:
         commands = HANDLER.run(item)
-        with open(ROOT / "test_command_output.txt", "a+") as f:
-            for c in commands:
-                f.write(repr(c) + "\n")
-        SESSION.safeWrite(commands)
+        if output is not None:
+            with open(output, "a+") as f:
+                for c in commands:
+                    f.write(repr(c) + "\n")
+        SESSION.safeWrite(encodeCommands(commands))
 
 
 def testCreator():
@@ -408,12 +891,28 @@ async def main(event=None):
     HANDLER = Backend(
         brushConfig=str(ROOT / "configs/brushConfig.json"),
         holderConfig=str(ROOT / "configs/brushHolderConfig.json"),
+        pressureConfig=str(ROOT / "configs/pressureConfig.json"),
         serialSession=SESSION,
         commandAdapters=[CA.startAndEndLift, CA.mirrorOnY, CA.checkLimits],
-        preprocessors=[PreProcessors.excludePointsWithin, PreProcessors.modFeedRate],
+        preprocessors=[
+            PreProcessors.excludePointsWithin,
+            PreProcessors.smoothZ,
+            PreProcessors.simplify,
+            PreProcessors.modFeedRate,
+        ],
     )
     producers = [asyncio.create_task(producer(queue))]
     consumers = [asyncio.create_task(consumer(queue, SESSION, HANDLER))]
+
+    def consumerDone(task):
+        # nothing awaits the consumer, so log what ended it here
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error("Consumer failed, shutting down", exc_info=task.exception())
+        HANDLER.shutdown()
+
+    for c in consumers:
+        c.add_done_callback(consumerDone)
     if event is not None:
         event.cont = HANDLER
         event.set()
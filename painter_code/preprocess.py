@@ -1,19 +1,104 @@
 from scipy.spatial import cKDTree
+from scipy.signal import lfilter
 import numpy as np
 import logging
 from const import *
+from strokeBuffer import StrokeBuffer
+import kinematics
+
 LOGGER = logging.getLogger(__name__)
 
 
 class PreProcessors:
-    def excludePointsWithin(commands, radius=1):
+    """
+    Each preprocessor takes either a list of Command or a StrokeBuffer,
+    and returns the same type
+
+    stats holds figures recorded by the last run of each preprocessor
+    """
+
+    stats = {}
+
+    def excludePointsWithin(commands, radius=1, mode="tree"):
+        """
+        Merge points that are close together.
+
+        mode "tree", the default, is the original per point cKDTree query:
+        each point not yet merged takes every point within radius of it.
+
+        mode "grid" hashes the points into square cells of side radius and
+        replaces the points of each cell with one point at their mean
+        x, y, z and feed rate. Cells are kept in the order the stroke first
+        enters them, and points with no xy are kept as they are.
+        It is much faster but not "within radius": points up to radius * √2
+        apart in one cell are merged, and points any distance under radius
+        apart on either side of a cell edge are not.
+        """
+        if mode == "tree":
+            return PreProcessors._excludePointsWithinTree(commands, radius)
+        if mode != "grid":
+            raise ValueError(f"Unknown excludePointsWithin mode {mode}")
+        isBuffer = isinstance(commands, StrokeBuffer)
+        stroke = commands if isBuffer else StrokeBuffer.fromCommands(commands)
+        n = len(stroke)
+        if n == 0:
+            return commands
+
+        xy = stroke.xy()
+        valid = ~np.isnan(xy).any(axis=1)
+        if not valid.all():
+            LOGGER.info("Warning: some commands have no xy")
+        keys = np.empty(n, dtype=np.int64)
+        if valid.any():
+            cells = np.floor(xy[valid] / radius).astype(np.int64)
+            cells -= cells.min(axis=0)
+            keys[valid] = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+            nextKey = keys[valid].max() + 1
+        else:
+            nextKey = 0
+        # each point with no xy is a cell of its own
+        keys[~valid] = nextKey + np.arange(n - valid.sum())
+
+        _, first, inverse, counts = np.unique(
+            keys, return_index=True, return_inverse=True, return_counts=True
+        )
+        # renumber cells in stroke order, by the first point in each
+        order = np.argsort(first, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        group = rank[inverse.ravel()]
+        counts = counts[order]
+
+        def mean(column):
+            return np.bincount(group, weights=column, minlength=len(order)) / counts
+
+        merged = stroke[first[order]]
+        merged.x, merged.y, merged.z, merged.f = (
+            mean(col).astype(stroke.dtype)
+            for col in (stroke.x, stroke.y, stroke.z, stroke.f)
+        )
+        # whole feed rates, as GcodeMaker parses them
+        merged.f = np.trunc(merged.f)
+        LOGGER.info("Reduced {} commands to {}".format(n, len(merged)))
+        return merged if isBuffer else merged.toCommands()
+
+    def _excludePointsWithinTree(commands, radius=1):
+        """
+        The original excludePointsWithin, a ball query per point.
+        Keeps the first command of each neighbourhood unchanged, the
+        averaged coordinates are not used.
+        """
         consumed = set()
         retPoints = []
         retIndicies = []
         idx = 0
-        xyToConsider = [
-            (c.x, c.y) for c in commands if c.x is not None and c.y is not None
-        ]
+        if isinstance(commands, StrokeBuffer):
+            xy = commands.xy()
+            xyToConsider = xy[~np.isnan(xy).any(axis=1)]
+        else:
+            xyToConsider = [
+                (c.x, c.y) for c in commands if c.x is not None and c.y is not None
+            ]
         if len(xyToConsider) != len(commands):
             LOGGER.info("Warning: some commands have no xy")
 
@@ -40,11 +125,183 @@ class PreProcessors:
                     consumed.add(i)
             consumed.add(idx)
             idx += 1
-        newCommands = [commands[i] for i in retIndicies]
+        if isinstance(commands, StrokeBuffer):
+            newCommands = commands[np.asarray(retIndicies, dtype=np.intp)]
+        else:
+            newCommands = [commands[i] for i in retIndicies]
         LOGGER.info("Reduced {} commands to {}".format(len(commands), len(newCommands)))
         return newCommands
 
+    def smoothZ(commands, alpha=Z_SMOOTHING, deadband=Z_DEADBAND):
+        """
+        Smooth out pressure noise in z so the z axis, the slowest, isn't
+        moving up and down on every point.
+        A causal exponential moving average (each z only depends on the ones
+        before it) then a deadband: z holds until the smoothed value has
+        moved at least deadband away from it.
+        The moving average is a single lfilter call, but the deadband
+        depends on the last value held so it stays a per-point loop over a
+        plain list. Stepping between changes with array searches instead
+        was slower, as z changes on most points of a noisy stroke.
+        The z travel removed is logged and kept in stats["smoothZ"].
+        """
+        isBuffer = isinstance(commands, StrokeBuffer)
+        stroke = commands if isBuffer else StrokeBuffer.fromCommands(commands)
+        z = stroke.z
+        if len(z) < 2 or np.isnan(z).any():
+            return commands
+
+        smoothed, _ = lfilter([alpha], [1, alpha - 1], z, zi=[(1 - alpha) * z[0]])
+        held = smoothed.tolist()
+        last = held[0]
+        for idx, value in enumerate(held):
+            if abs(value - last) >= deadband:
+                last = value
+            held[idx] = last
+
+        if not isBuffer:
+            stroke = stroke.copy()
+        stroke.z = np.asarray(held, dtype=stroke.dtype)
+        before = float(np.abs(np.diff(z)).sum())
+        after = float(np.abs(np.diff(stroke.z)).sum())
+        PreProcessors.stats["smoothZ"] = {
+            "travelBefore": before,
+            "travelAfter": after,
+            "travelRemoved": before - after,
+        }
+        LOGGER.info(f"Smoothed z travel {before:.2f}mm -> {after:.2f}mm")
+        return stroke if isBuffer else stroke.toCommands()
+
+    def simplify(commands, tolerance=SIMPLIFY_TOLERANCE):
+        """
+        Ramer-Douglas-Peucker simplification in x, y and z, so points
+        where only the pressure changes are kept. Iterative rather than
+        recursive, each pass splits every open range of the stroke at once
+        with whole array operations.
+        Points with a missing coordinate and points where the flags change
+        are always kept, the stroke is simplified between them.
+        The point reduction ratio is logged and kept in stats["simplify"].
+        """
+        isBuffer = isinstance(commands, StrokeBuffer)
+        stroke = commands if isBuffer else StrokeBuffer.fromCommands(commands)
+        n = len(stroke)
+        if n < 3:
+            return commands
+
+        xyz = np.column_stack((stroke.x, stroke.y, stroke.z))
+        missing = np.isnan(xyz).any(axis=1)
+        keep = missing.copy()
+        keep[1:] |= stroke.flags[1:] != stroke.flags[:-1]
+        keep[[0, -1]] = True
+        anchors = np.flatnonzero(keep)
+        starts, ends = anchors[:-1], anchors[1:]
+        # ranges with a missing end point are kept as they are
+        open_ = (ends - starts > 1) & ~missing[starts] & ~missing[ends]
+        starts, ends = starts[open_], ends[open_]
+        while len(starts):
+            interior = ends - starts - 1
+            rangeIdx = np.repeat(np.arange(len(starts)), interior)
+            offsets = np.concatenate(([0], np.cumsum(interior)[:-1]))
+            points = np.arange(len(rangeIdx)) - offsets[rangeIdx] + starts[rangeIdx] + 1
+            distances = PreProcessors._segmentDistancesSq(
+                xyz[points], xyz[starts[rangeIdx]], xyz[ends[rangeIdx]]
+            )
+            furthest = np.maximum.reduceat(distances, offsets)
+            split = furthest > tolerance**2
+            # first point in each range at its furthest distance
+            atMax = np.flatnonzero(distances == furthest[rangeIdx])
+            _, firstAtMax = np.unique(rangeIdx[atMax], return_index=True)
+            splitPoints = points[atMax[firstAtMax]][split]
+            keep[splitPoints] = True
+            starts = np.concatenate((starts[split], splitPoints))
+            ends = np.concatenate((splitPoints, ends[split]))
+            open_ = ends - starts > 1
+            starts, ends = starts[open_], ends[open_]
+
+        simplified = stroke[keep]
+        ratio = len(simplified) / n
+        PreProcessors.stats["simplify"] = {
+            "before": n,
+            "after": len(simplified),
+            "ratio": ratio,
+        }
+        LOGGER.info(f"Simplified {n} commands to {len(simplified)} ({ratio:.1%})")
+        return simplified if isBuffer else simplified.toCommands()
+
+    def _segmentDistancesSq(points, starts, ends):
+        """
+        Squared distance from each point to the segment from the matching
+        start to end
+        """
+        segments = ends - starts
+        lengthSq = np.einsum("ij,ij->i", segments, segments)
+        rel = points - starts
+        t = np.divide(
+            np.einsum("ij,ij->i", rel, segments),
+            lengthSq,
+            out=np.zeros(len(points)),
+            where=lengthSq > 0,
+        )
+        rel -= np.clip(t, 0, 1)[:, None] * segments
+        return np.einsum("ij,ij->i", rel, rel)
+
     def modFeedRate(commands, factor=0.6):
+        if isinstance(commands, StrokeBuffer):
+            commands.f = np.minimum(commands.f * factor, MAX_FEED_RATE)
+            return commands
         for c in commands:
             c.f = min([c.f * factor, MAX_FEED_RATE])
-        return commands
\ No newline at end of file
+        return commands
+
+    def planFeedRate(commands, maxFeed=MAX_FEED_RATE, factor=0.6):
+        """
+        Lookahead feed planner, in place of modFeedRate's constant factor.
+        Each command gets the top speed GRBL can reach on the segment that
+        ends at it, from the segment lengths, the junction angles and the
+        axis accelerations, capped at maxFeed and at the speed the app sent
+        for that point. Straight runs go as fast as the app allows and only
+        corners and short segments slow down further.
+        The estimated time against modFeedRate(factor) is logged and kept
+        in stats["planFeedRate"].
+        """
+        isBuffer = isinstance(commands, StrokeBuffer)
+        stroke = commands if isBuffer else StrokeBuffer.fromCommands(commands)
+        n = len(stroke)
+        if n < 2:
+            return commands
+
+        xyz = np.column_stack((stroke.x, stroke.y, stroke.z))
+        # the app's speed is an upper bound, a feed of 0 leaves it to maxFeed
+        limits = np.where(
+            stroke.f[1:] > 0, np.minimum(stroke.f[1:], maxFeed), maxFeed
+        )
+        planned, plannedTimes = kinematics.planSegments(xyz, limits)
+        constant = np.minimum(stroke.f[1:] * factor, MAX_FEED_RATE)
+        # feeds of 0 never finish, leave those segments out of the comparison
+        compared = constant > 0
+        _, constantTimes = kinematics.planSegments(
+            xyz, np.where(compared, constant, maxFeed)
+        )
+
+        # zero length segments keep the feed before them
+        feeds = np.where(planned > 0, planned, np.nan)
+        feeds = np.concatenate((feeds[:1], feeds))
+        filled = np.where(~np.isnan(feeds), np.arange(n), 0)
+        feeds = feeds[np.maximum.accumulate(filled)]
+        feeds = np.where(np.isnan(feeds), maxFeed, feeds)
+        if not isBuffer:
+            stroke = stroke.copy()
+        stroke.f = np.maximum(np.trunc(feeds), 1)
+
+        before = float(constantTimes[compared].sum())
+        after = float(plannedTimes[compared].sum())
+        PreProcessors.stats["planFeedRate"] = {
+            "constantSeconds": before,
+            "plannedSeconds": after,
+            "savedSeconds": before - after,
+        }
+        LOGGER.info(
+            f"Planned feeds: {after:.2f}s against {before:.2f}s "
+            f"with modFeedRate, {before - after:.2f}s saved"
+        )
+        return stroke if isBuffer else stroke.toCommands()
@@ -0,0 +1,237 @@
+import cProfile
+import functools
+import heapq
+import io
+import itertools
+import logging
+import pstats
+import time
+from collections import deque
+import numpy as np
+from const import *
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _size(value):
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+class StageStats:
+    """
+    The last window timings of a stage, and the sizes of what went in and
+    came out of it
+    """
+
+    __slots__ = ("calls", "seconds", "sizeIn", "sizeOut")
+
+    def __init__(self, window=PROFILE_WINDOW):
+        self.calls = 0
+        self.seconds = deque(maxlen=window)
+        self.sizeIn = deque(maxlen=window)
+        self.sizeOut = deque(maxlen=window)
+
+    def add(self, seconds, sizeIn=None, sizeOut=None):
+        self.calls += 1
+        self.seconds.append(seconds)
+        if sizeIn is not None:
+            self.sizeIn.append(sizeIn)
+        if sizeOut is not None:
+            self.sizeOut.append(sizeOut)
+
+    def summary(self) -> dict:
+        p50, p95, p99 = np.percentile(self.seconds, (50, 95, 99))
+        return {
+            "calls": self.calls,
+            "p50": p50,
+            "p95": p95,
+            "p99": p99,
+            "max": max(self.seconds),
+            "meanIn": np.mean(self.sizeIn) if self.sizeIn else None,
+            "meanOut": np.mean(self.sizeOut) if self.sizeOut else None,
+        }
+
+
+class Profiler:
+    """
+    Times named stages of compiling a stroke, such as each preprocessor and
+    adapter, with the sizes of what goes in and comes out, keeping the last
+    window timings of each for the p50, p95 and p99.
+
+    Parameters
+    ----------
+    window : int
+        timings kept per stage
+    slowest : int
+        cProfile every stroke and keep the profiles of the slowest this
+        many, 0 to not run cProfile, which slows compiling down a lot
+    reportEvery : int
+        log the report every this many strokes, 0 to not log it
+    """
+
+    enabled = True
+
+    def __init__(
+        self, window=PROFILE_WINDOW, slowest=0, reportEvery=PROFILE_REPORT_EVERY
+    ):
+        self.window = window
+        self.slowest = slowest
+        self.reportEvery = reportEvery
+        self.stages = {}
+        self.strokes = 0
+        # (seconds, tiebreak, label, pstats.Stats) heap of the slowest strokes
+        self._profiles = []
+        self._tiebreak = itertools.count()
+
+    def record(self, name, seconds, sizeIn=None, sizeOut=None):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats(self.window)
+        stats.add(seconds, sizeIn, sizeOut)
+
+    def run(self, name, fn, *args, **kwargs):
+        """
+        fn(*args, **kwargs), timed as the stage name
+        """
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.record(name, seconds, _size(args[0]) if args else None, _size(result))
+        return result
+
+    def iterStroke(self, label, chunks):
+        """
+        Pass on the chunks of a stroke, timing only the work done making
+        them, not what the caller does with each, as label and the time to
+        the first chunk as label.first
+        """
+        profile = cProfile.Profile() if self.slowest else None
+        chunks = iter(chunks)
+        seconds, first, size = 0.0, None, 0
+        while True:
+            start = time.perf_counter()
+            if profile is not None:
+                profile.enable()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            finally:
+                if profile is not None:
+                    profile.disable()
+                seconds += time.perf_counter() - start
+            if first is None:
+                first = seconds
+            size += _size(chunk) or 0
+            yield chunk
+        self.record(label, seconds, sizeOut=size)
+        if first is not None:
+            self.record(f"{label}.first", first)
+        if profile is not None:
+            self._keep(seconds, label, profile)
+        self.strokes += 1
+        if self.reportEvery and self.strokes % self.reportEvery == 0:
+            LOGGER.info(f"Compile times after {self.strokes} strokes\n{self.report()}")
+
+    def _keep(self, seconds, label, profile):
+        entry = (seconds, next(self._tiebreak), label, pstats.Stats(profile))
+        if len(self._profiles) < self.slowest:
+            heapq.heappush(self._profiles, entry)
+        elif seconds > self._profiles[0][0]:
+            heapq.heapreplace(self._profiles, entry)
+
+    def summary(self) -> dict:
+        """
+        The summary of each stage by name, see StageStats.summary
+        """
+        return {name: stats.summary() for name, stats in self.stages.items()}
+
+    def report(self) -> str:
+        """
+        A table of the stage timings in ms
+        """
+        lines = [
+            f"{'stage':<32}{'calls':>8}{'p50':>10}{'p95':>10}{'p99':>10}"
+            f"{'max':>10}{'in':>10}{'out':>10}"
+        ]
+        for name, s in self.summary().items():
+            sizes = "".join(
+                f"{'':>10}" if v is None else f"{v:10.0f}"
+                for v in (s["meanIn"], s["meanOut"])
+            )
+            lines.append(
+                f"{name:<32}{s['calls']:>8}"
+                + "".join(f"{s[k] * 1000:10.2f}" for k in ("p50", "p95", "p99", "max"))
+                + sizes
+            )
+        return "\n".join(lines)
+
+    def slowestProfiles(self, limit=20, sort="cumulative") -> "list[tuple]":
+        """
+        (seconds, label, profile text) of the slowest strokes profiled,
+        slowest first, each with its top limit functions by sort
+        """
+        profiles = []
+        for seconds, _, label, stats in sorted(self._profiles, reverse=True):
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats(sort).print_stats(limit)
+            profiles.append((seconds, label, out.getvalue()))
+        return profiles
+
+    def dumpSlowest(self, directory):
+        """
+        Save the slowest strokes' profiles as .prof files for pstats or
+        snakeviz, slowest first
+        """
+        ordered = sorted(self._profiles, reverse=True)
+        for rank, (seconds, _, label, stats) in enumerate(ordered):
+            stats.dump_stats(
+                f"{directory}/{rank:02d}_{label}_{seconds * 1000:.0f}ms.prof"
+            )
+
+
+class NullProfiler:
+    """
+    A Profiler that records nothing, so profiling costs a function call
+    per stage when it is off
+    """
+
+    enabled = False
+
+    def run(self, name, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def iterStroke(self, label, chunks):
+        return chunks
+
+    def summary(self) -> dict:
+        return {}
+
+    def report(self) -> str:
+        return ""
+
+    def slowestProfiles(self, limit=20, sort="cumulative") -> "list[tuple]":
+        return []
+
+    def dumpSlowest(self, directory):
+        pass
+
+
+def profiledStroke(label):
+    """
+    For Backend methods that yield chunks of commands, times making the
+    chunks with the Backend's profiler as label, see Profiler.iterStroke
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            return self.profiler.iterStroke(label, method(self, *args, **kwargs))
+
+        return wrapper
+
+    return decorator
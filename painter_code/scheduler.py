@@ -0,0 +1,291 @@
+import time
+import logging
+import numpy as np
+from dataclasses import dataclass
+from const import *
+
+LOGGER = logging.getLogger(__name__)
+
+
+def brushKey(item: dict):
+    """
+    (colorIdx, sizeIdx) of a queued stroke, as the app sends them
+    """
+    return int(item["color"].split(" ")[0]), int(item["size"].split(" ")[0])
+
+
+def strokePoints(item: dict):
+    """
+    (n, 2) array of the xy points of a queued stroke
+    """
+    data = item["data"]
+    if isinstance(data, np.ndarray):
+        return np.asarray(data[:, :2], dtype=np.float64)
+    lines = [line.split(" ", 2)[:2] for line in data if line != ""]
+    return np.array(lines, dtype=np.float64).reshape(-1, 2)
+
+
+def strokeBounds(item: dict, points=None):
+    """
+    (minX, minY, maxX, maxY) of a queued stroke, widened by half the brush
+    size so it covers the paint and not just the path. None if it has no points.
+    """
+    points = strokePoints(item) if points is None else points
+    if not len(points):
+        return None
+    pad = float(item["size"].split(" ")[1]) / 2
+    (minX, minY), (maxX, maxY) = points.min(axis=0), points.max(axis=0)
+    return minX - pad, minY - pad, maxX + pad, maxY + pad
+
+
+def boundsOverlap(a, b):
+    if a is None or b is None:
+        return False
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def reverseStroke(item: dict) -> dict:
+    """
+    The same stroke painted from the other end
+    """
+    data = item["data"]
+    return dict(item, data=data[::-1])
+
+
+def travelDistance(starts, ends, order, reversed_, start=None):
+    """
+    Total distance travelled between strokes painted in order,
+    reversed_ says which strokes are painted end to start
+    """
+    first = np.where(reversed_[:, None], ends[order], starts[order])
+    last = np.where(reversed_[:, None], starts[order], ends[order])
+    travel = np.hypot(*(first[1:] - last[:-1]).T).sum()
+    if start is not None and len(order):
+        travel += np.hypot(*(first[0] - start))
+    return float(travel)
+
+
+class StrokeScheduler:
+    """
+    Orders a batch of strokes painted with the same brush to cut the travel
+    between them: a nearest neighbour tour, then 2-opt moves until no move
+    helps or the time budget runs out. Strokes may be painted in either
+    direction.
+
+    Parameters
+    ----------
+    timeBudget : float
+        seconds allowed for ordering each batch
+    """
+
+    def __init__(self, timeBudget=SCHEDULE_TIME_BUDGET):
+        self.timeBudget = timeBudget
+        self.log = LOGGER
+
+    def order(self, items: "list[dict]", start=None) -> "list[dict]":
+        """
+        Reorder items, reversing the strokes that are shorter to reach from
+        their end. start is the xy the brush is at, if known.
+        """
+        if len(items) < 2:
+            return items
+        deadline = time.perf_counter() + self.timeBudget
+        points = [strokePoints(item) for item in items]
+        keep = [i for i, p in enumerate(points) if len(p)]
+        if len(keep) < 2:
+            return items
+        starts = np.array([points[i][0] for i in keep])
+        ends = np.array([points[i][-1] for i in keep])
+        start = None if start is None else np.asarray(start, dtype=np.float64)
+
+        before = travelDistance(
+            starts, ends, np.arange(len(keep)), np.zeros(len(keep), bool), start
+        )
+        order, reversed_ = self._nearestNeighbour(starts, ends, start)
+        order, reversed_ = self._twoOpt(starts, ends, order, reversed_, start, deadline)
+        after = travelDistance(starts, ends, order, reversed_, start)
+        if after >= before:
+            return items
+
+        self.log.info(
+            f"Scheduled {len(keep)} strokes, travel {before:.0f}mm -> {after:.0f}mm "
+            f"({before - after:.0f}mm saved)"
+        )
+        ordered = [
+            reverseStroke(items[keep[i]]) if flip else items[keep[i]]
+            for i, flip in zip(order, reversed_)
+        ]
+        # strokes with no points have no travel, leave them at the end
+        return ordered + [items[i] for i in range(len(items)) if not len(points[i])]
+
+    def _nearestNeighbour(self, starts, ends, start):
+        n = len(starts)
+        remaining = np.ones(n, bool)
+        order = np.empty(n, np.intp)
+        reversed_ = np.zeros(n, bool)
+        position = starts[0] if start is None else start
+        for k in range(n):
+            toStart = np.hypot(*(starts - position).T)
+            toEnd = np.hypot(*(ends - position).T)
+            toStart[~remaining] = np.inf
+            toEnd[~remaining] = np.inf
+            best = int(np.argmin(np.minimum(toStart, toEnd)))
+            order[k] = best
+            reversed_[k] = toEnd[best] < toStart[best]
+            remaining[best] = False
+            position = starts[best] if reversed_[k] else ends[best]
+        return order, reversed_
+
+    def _twoOpt(self, starts, ends, order, reversed_, start, deadline):
+        """
+        Reverse runs of the tour, which also flips the direction each stroke
+        in the run is painted, while that shortens the travel
+        """
+        n = len(order)
+        improved = True
+        while improved and time.perf_counter() < deadline:
+            improved = False
+            first = np.where(reversed_[:, None], ends[order], starts[order])
+            last = np.where(reversed_[:, None], starts[order], ends[order])
+            for i in range(n):
+                # point the brush comes from before stroke i
+                before = last[i - 1] if i > 0 else start
+                # reversing i..j joins before to last[j] and first[i] to first[j + 1],
+                # with j == i just painting stroke i the other way
+                j = np.arange(i, n)
+                removed = np.zeros(len(j))
+                added = np.zeros(len(j))
+                if before is not None:
+                    removed += np.hypot(*(first[i] - before))
+                    added += np.hypot(*(last[j] - before).T)
+                hasNext = j < n - 1
+                nxt = first[np.minimum(j + 1, n - 1)]
+                removed += np.where(hasNext, np.hypot(*(nxt - last[j]).T), 0)
+                added += np.where(hasNext, np.hypot(*(nxt - first[i]).T), 0)
+                gain = removed - added
+                best = int(np.argmax(gain))
+                if gain[best] > 1e-9:
+                    e = j[best]
+                    order[i : e + 1] = order[i : e + 1][::-1]
+                    reversed_[i : e + 1] = ~reversed_[i : e + 1][::-1]
+                    improved = True
+                    break
+                if time.perf_counter() >= deadline:
+                    break
+        return order, reversed_
+
+
+@dataclass
+class PendingStroke:
+    """
+    A stroke taken off the queue and waiting to be painted
+    """
+
+    item: dict
+    key: tuple
+    bounds: tuple
+    # when the message arrived, on the time.monotonic clock
+    receivedAt: float
+
+    @classmethod
+    def fromItem(cls, receivedAt: float, item: dict):
+        """
+        The PendingStroke for item, received at receivedAt on the
+        time.monotonic clock
+        """
+        return cls(
+            item=item,
+            key=brushKey(item),
+            bounds=strokeBounds(item),
+            receivedAt=receivedAt,
+        )
+
+    @property
+    def color(self):
+        return self.key[0]
+
+
+class BrushBatcher:
+    """
+    Picks the strokes to paint next from those waiting, grouping strokes
+    by (colorIdx, sizeIdx) so the brush is swapped less often.
+
+    A stroke is only moved ahead of strokes it doesn't overlap, or that are
+    the same color, so the painting comes out the same. Once a stroke has
+    waited maxLatency seconds its brush is the next one used.
+
+    Parameters
+    ----------
+    maxLatency : float
+        longest a stroke can be held back, in seconds
+    """
+
+    def __init__(self, maxLatency=MAX_REORDER_LATENCY):
+        self.maxLatency = maxLatency
+        self.log = LOGGER
+        self.paintedKey = None
+        # brush swaps saved so far against painting in the order received
+        self.swapsAvoided = 0
+
+    def take(self, pending: "list[PendingStroke]", now=None) -> "list[PendingStroke]":
+        """
+        Remove and return the next batch from pending, all the strokes of one
+        brush that can be painted now, in the order they were received
+        """
+        if not pending:
+            return []
+        now = time.monotonic() if now is None else now
+        oldest = pending[0]
+        if now - oldest.receivedAt > self.maxLatency:
+            key = oldest.key
+        elif self.paintedKey is not None and self._movable(pending, self.paintedKey):
+            key = self.paintedKey
+        else:
+            key = oldest.key
+
+        inOrder = self._swaps(self.paintedKey, pending)
+        batch, skipped = [], []
+        for stroke in pending:
+            if stroke.key == key and not any(
+                other.color != stroke.color
+                and boundsOverlap(other.bounds, stroke.bounds)
+                for other in skipped
+            ):
+                batch.append(stroke)
+            else:
+                skipped.append(stroke)
+        pending[:] = skipped
+
+        swapped = self.paintedKey is not None and key != self.paintedKey
+        self.swapsAvoided += inOrder - swapped - self._swaps(key, skipped)
+        self.paintedKey = key
+        self.log.info(
+            f"Batch of {len(batch)} strokes for brush {key}, "
+            f"{len(skipped)} waiting, {self.swapsAvoided} brush swaps avoided so far"
+        )
+        return batch
+
+    @staticmethod
+    def _swaps(key, pending):
+        """
+        Brush swaps to paint pending in order with key's brush loaded
+        """
+        swaps = 0
+        for stroke in pending:
+            if key is not None and stroke.key != key:
+                swaps += 1
+            key = stroke.key
+        return swaps
+
+    def _movable(self, pending, key):
+        """
+        If the first stroke for key can be moved to the front
+        """
+        for idx, stroke in enumerate(pending):
+            if stroke.key == key:
+                return not any(
+                    other.color != stroke.color
+                    and boundsOverlap(other.bounds, stroke.bounds)
+                    for other in pending[:idx]
+                )
+        return False
@@ -0,0 +1,100 @@
+from gcode import Command, Macro
+from strokeBuffer import StrokeBuffer
+from const import *
+
+# motion commands that GRBL keeps modal, so they can be left out of
+# following lines until the motion mode changes
+MODAL_MOTION = ("G0", "G1", "G2", "G3")
+
+
+def encodeCommands(commands, state=None) -> bytes:
+    """
+    Serialize a whole command sequence to G-code bytes, one line per command.
+    Modal words that repeat are left out, the G1 prefix, an unchanged feed
+    and unchanged axes, so each line takes less of GRBL's RX buffer.
+    Commands that would be left with no words are dropped.
+    Arc I and J offsets are not modal and are always written.
+
+    Parameters
+    ----------
+    commands : list[Command] | StrokeBuffer
+        commands in the same coordinates as Command, the X and Y
+        conversion done by Command._convCoords is applied here
+    state : dict | None
+        modal state left by a previous call, updated in place so a
+        following call can continue eliding words. Without it the first
+        line is written in full.
+
+    Macro commands are already encoded, their bytes are copied in as they are.
+    """
+    if state is None:
+        state = {}
+    if isinstance(commands, StrokeBuffer):
+        rows = _bufferRows(commands)
+    else:
+        rows = _commandRows(commands)
+
+    parts, lines = [], []
+    for commandType, x, y, z, i, j, f, raw in rows:
+        if commandType not in MODAL_MOTION:
+            # anything else is written as is, and the modal state is unknown after it
+            if isinstance(raw, bytes):
+                if lines:
+                    parts.append(("\n".join(lines) + "\n").encode())
+                    lines = []
+                parts.append(raw)
+            else:
+                lines.append(raw())
+            state.clear()
+            continue
+        words = []
+        if state.get("G") != commandType:
+            words.append(commandType)
+            state["G"] = commandType
+        for axis, value in (("X", x), ("Y", y), ("Z", z)):
+            if value is None:
+                continue
+            word = f"{axis}{value:.3f}"
+            if state.get(axis) != word:
+                words.append(word)
+                state[axis] = word
+        if i is not None:
+            words.append(f"I{i:.3f} J{j:.3f}")
+        if f is not None:
+            word = f"F{f:g}"
+            if state.get("F") != word:
+                words.append(word)
+                state["F"] = word
+        if words:
+            lines.append(" ".join(words))
+
+    if lines:
+        parts.append(("\n".join(lines) + "\n").encode())
+    return b"".join(parts)
+
+
+def _commandRows(commands: "list[Command]"):
+    for c in commands:
+        if isinstance(c, Macro):
+            yield c.commandType, None, None, None, None, None, None, c.data
+            continue
+        x, y, z = c._convCoords()
+        i, j = (None, None) if c.i is None else (-1 * c.i, -1 * c.j)
+        yield c.commandType, x, y, z, i, j, c.f, c.__str__
+
+
+def _bufferRows(stroke: StrokeBuffer):
+    x, y, z, i, j, f = (
+        StrokeBuffer.columnToList(col)
+        for col in (
+            -1 * stroke.x,
+            -1 * stroke.y,
+            stroke.z,
+            -1 * stroke.i,
+            -1 * stroke.j,
+            stroke.f,
+        )
+    )
+    kinds = [StrokeBuffer.KINDS[k] for k in stroke.kind.tolist()]
+    for row in zip(kinds, x, y, z, i, j, f):
+        yield (*row, None)
@@ -1,80 +1,474 @@
 from pathlib import Path
+import logging
+import queue
+import threading
 import serial
 import time
+import bisect
+import numpy as np
+from collections import deque
 from const import *
 
 ROOT = Path(__file__).parent
+NEWLINE = ord("\n")
+
+
+class GrblStreamer:
+    """
+    Streams lines to GRBL keeping its RX buffer as full as it can be
+    without overflowing: the lengths of the lines GRBL hasn't answered are
+    kept in a deque with their running total, and once minWrite bytes are
+    free as many whole lines as fit are sent with one write.
+
+    With threaded, a reader thread takes each response as it arrives,
+    otherwise responses are read when a line has to wait for room, which
+    a SimSerial with virtual time needs, see grblSim.
+
+    Parameters
+    ----------
+    transport : serial.Serial
+        or anything with its write and readline
+    rxSize : int
+        bytes GRBL's RX buffer holds, its ring buffer keeps one byte free
+    minWrite : int
+        bytes that have to be free before writing, unless less than that
+        is left to send. The default 1 keeps the RX buffer full, more
+        makes fewer bigger writes for a less full RX buffer, and is only
+        for benchmarking until it is tried on the machine
+    """
+
+    def __init__(
+        self,
+        transport,
+        rxSize=MAX_BUFFER_SIZE - 1,
+        threaded=True,
+        minWrite=STREAM_MIN_WRITE,
+    ):
+        self.transport = transport
+        self.rxSize = rxSize
+        self.threaded = threaded
+        self.minWrite = minWrite
+        self.log = logging.getLogger("streamer")
+        # (length, line) of each line sent and not answered yet
+        self.inFlight = deque()
+        self.inFlightBytes = 0
+        self.status = None
+        self.lastResponse = None
+        self.stats = {
+            "lines": 0,
+            "bytes": 0,
+            "writes": 0,
+            "ok": 0,
+            "errors": 0,
+            "alarms": 0,
+        }
+        # errors and alarms since stream last returned
+        self._problems = []
+        self._alarm = False
+        self._statusCount = 0
+        # seconds GRBL has had lines to work on, for the lines per second
+        self._busySeconds = 0.0
+        self._busySince = None
+        self._changed = threading.Condition()
+        self._writeLock = threading.Lock()
+        self._stopped = threading.Event()
+        # anything already waiting answers what was sent before, not a streamed line
+        while transport.inWaiting():
+            transport.readline()
+        self.reader = None
+        if threaded:
+            self.reader = threading.Thread(
+                target=self._read, name="grbl-reader", daemon=True
+            )
+            self.reader.start()
+
+    def _write(self, data):
+        with self._writeLock:
+            self.transport.write(data)
+
+    def _read(self):
+        while not self._stopped.is_set():
+            try:
+                line = self.transport.readline()
+            except Exception:
+                if not self._stopped.is_set():
+                    self.log.exception("Reading from GRBL failed")
+                break
+            if line:
+                self._handle(line)
+            else:
+                # a read timed out, or a SimSerial with nothing to send
+                time.sleep(0.001)
+        with self._changed:
+            self._stopped.set()
+            self._changed.notify_all()
+
+    def _readOne(self):
+        line = self.transport.readline()
+        if not line:
+            raise RuntimeError(
+                f"GRBL stopped answering with {len(self.inFlight)} lines unanswered"
+            )
+        self._handle(line)
+
+    def _answered(self):
+        length, line = self.inFlight.popleft() if self.inFlight else (0, b"")
+        self.inFlightBytes -= length
+        if not self.inFlight and self._busySince is not None:
+            self._busySeconds += time.perf_counter() - self._busySince
+            self._busySince = None
+        return line
+
+    def _clear(self):
+        # GRBL throws away what it was sent on an alarm or reset
+        while self.inFlight:
+            self._answered()
+
+    def _handle(self, raw: bytes):
+        response = raw.strip()
+        if not response:
+            return
+        with self._changed:
+            if response == b"ok":
+                self._answered()
+                self.stats["ok"] += 1
+                self.lastResponse = "ok"
+            elif response.startswith(b"error"):
+                line = bytes(self._answered()).strip().decode()
+                self.stats["errors"] += 1
+                self.lastResponse = f"{response.decode()} on {line}"
+                self._problems.append(self.lastResponse)
+                self.log.warning(f"GRBL {self.lastResponse}")
+            elif response.startswith(b"ALARM"):
+                self._clear()
+                self.stats["alarms"] += 1
+                self._alarm = True
+                self.lastResponse = response.decode()
+                self._problems.append(self.lastResponse)
+                self.log.error(f"GRBL {self.lastResponse}")
+            elif response.startswith(b"<"):
+                self.status = response.decode()
+                self._statusCount += 1
+            elif response.startswith(b"Grbl"):
+                self._clear()
+                self.log.info(f"GRBL reset: {response.decode()}")
+            else:
+                self.log.debug(f"GRBL: {response.decode()}")
+            self._changed.notify_all()
+
+    def _wait(self, ready):
+        """
+        Wait with the condition held until ready() is True
+        """
+        while not ready():
+            if not self.threaded:
+                self._readOne()
+            elif self._stopped.is_set():
+                raise RuntimeError("GRBL reader stopped")
+            else:
+                self._changed.wait()
+
+    def stream(self, blocks) -> str:
+        """
+        streamBuffer for a list of lines, bytes without the newline
+        """
+        lines = (block.strip() for block in blocks)
+        return self.streamBuffer(b"".join(line + b"\n" for line in lines if line))
+
+    def streamBuffer(self, data) -> str:
+        """
+        Send data, lines each ending in \\n such as encodeCommands makes,
+        writing as many whole lines as fit in GRBL's RX buffer at a time as
+        slices of a memoryview of data, so data isn't copied. Stops if GRBL
+        alarms. Returns after the last line is sent, with the errors and
+        alarms GRBL has sent since the last stream returned, one per line.
+        """
+        view = memoryview(data)
+        if len(view) and view[-1] != NEWLINE:
+            view = memoryview(bytes(view) + b"\n")
+        ends = (np.flatnonzero(np.frombuffer(view, np.uint8) == NEWLINE) + 1).tolist()
+        with self._changed:
+            self._alarm = False
+            start, idx = 0, 0
+            while idx < len(ends):
+                length = ends[idx] - start
+                if length > self.rxSize:
+                    line = bytes(view[start : ends[idx]])
+                    raise ValueError(f"Line longer than GRBL's RX buffer: {line}")
+                needed = max(length, min(self.minWrite, len(view) - start))
+                self._wait(lambda: self.rxSize - self.inFlightBytes >= needed)
+                if self._alarm:
+                    break
+                # every whole line that fits
+                stop = bisect.bisect_right(
+                    ends, start + self.rxSize - self.inFlightBytes, idx
+                )
+                if self._busySince is None:
+                    self._busySince = time.perf_counter()
+                lineStart = start
+                for end in ends[idx:stop]:
+                    self.inFlight.append((end - lineStart, view[lineStart:end]))
+                    lineStart = end
+                end = ends[stop - 1]
+                self.inFlightBytes += end - start
+                self.stats["lines"] += stop - idx
+                self.stats["bytes"] += end - start
+                self.stats["writes"] += 1
+                self._write(view[start:end])
+                start, idx = end, stop
+            if not self.threaded:
+                # answers already in need not wait for the next line
+                while self.inFlight and self.transport.inWaiting():
+                    self._readOne()
+            problems = "\n".join(self._problems)
+            self._problems.clear()
+        return problems
+
+    def command(self, line: bytes) -> str:
+        """
+        Send line once everything before it is answered and wait for its
+        answer, which is returned
+        """
+        self.waitIdle()
+        self.stream([line])
+        self.waitIdle()
+        return self.lastResponse
+
+    def waitIdle(self):
+        """
+        Wait until GRBL has answered every line sent
+        """
+        with self._changed:
+            self._wait(lambda: not self.inFlight)
+
+    def requestStatus(self) -> str:
+        """
+        Ask for a status report and wait for it, realtime commands go past
+        the RX buffer so this is answered even while it is full
+        """
+        with self._changed:
+            count = self._statusCount
+            self._write(b"?")
+            self._wait(lambda: self._statusCount > count)
+            return self.status
+
+    def report(self) -> dict:
+        """
+        stats with the lines GRBL answers per second while it has lines
+        """
+        with self._changed:
+            busy = self._busySeconds
+            if self._busySince is not None:
+                busy += time.perf_counter() - self._busySince
+            report = dict(self.stats, inFlightBytes=self.inFlightBytes)
+        answered = report["ok"] + report["errors"]
+        report["busySeconds"] = busy
+        report["linesPerSecond"] = answered / busy if busy else 0.0
+        return report
+
+    def stop(self):
+        self._stopped.set()
+        if self.reader is not None:
+            self.reader.join(timeout=1)
 
 
 class SerialSession:
-    def __init__(self):
-        self.c_line = []
-        self.g_count = 0
-        self.l_count = 0
+    """
+    GRBL over serial.
+    transport is used in place of opening port, anything with pyserial's
+    Serial methods, such as a grblSim.SimSerial. wakeDelay is the seconds
+    given to GRBL to start up and to home. Lines are streamed with a
+    GrblStreamer, reading GRBL's answers on its own thread if readerThread.
+    """
+
+    def __init__(
+        self, port="/dev/ttyACM0", transport=None, wakeDelay=5, readerThread=True
+    ):
         self.ready = False
-        self.session = serial.Serial("/dev/ttyACM0", 115200)
+        self.wakeDelay = wakeDelay
+        if transport is not None:
+            self.session = transport
+        else:
+            self.session = serial.Serial(port, 115200)
         # Wake up grbl
         self.session.write("\r\n\r\n".encode())
-        time.sleep(5)
+        time.sleep(self.wakeDelay)
 
         self.session.flushInput()
+        self.streamer = GrblStreamer(self.session, threaded=readerThread)
 
         self.home()
 
     def home(self):
         self._write("$H")
 
-        time.sleep(5)
-        res = self._write("$?")
-
-        while not res.startswith("<Idle") or res == "ok":
-            res = self.session.readline().decode().strip()
+        time.sleep(self.wakeDelay)
+        res = ""
+        while not res.startswith("<Idle"):
+            res = self.streamer.requestStatus()
             print(res)
         self.ready = True
 
     def _write(self, text):
-        if not text.endswith("\n"):
-            text += "\n"
-        self.session.write(text.encode())
-        self.session.flushInput()  # Flush startup text in serial input
-        grbl_out = (
-            self.session.readline()
-        )  # Wait for grbl response with carriage return
-        output = grbl_out.decode().strip()
+        output = self.streamer.command(text.strip().encode())
         if "ALARM" in output:
             print(text)
         print(output)
         return output
 
     def safeWrite(self, commands):
-        if not isinstance(commands, list):
-            commands = [commands]
-        if not isinstance(commands[0], str):
-            cStrings = [str(c) for c in commands]
+        """
+        Stream commands to grbl, keeping its RX buffer from overflowing.
+        commands can be Command objects, strings, or a buffer of
+        newline separated G-code bytes such as serializer.encodeCommands makes.
+        Returns the errors and alarms GRBL has sent since the last call.
+        """
+        if isinstance(commands, (bytes, bytearray, memoryview)):
+            return self.streamer.streamBuffer(commands)
         else:
-            cStrings = commands
-
-        ok_b = bytes("ok", "utf-8")
-        error_b = bytes("error", "utf-8")
-        for line in cStrings:
-            self.l_count += 1  # Iterate line counter
-            l_block = line.strip()
-            self.c_line.append(
-                len(l_block) + 1
-            )  # Track number of characters in grbl serial read buffer
-            grbl_out = ""
-            while sum(self.c_line) >= MAX_BUFFER_SIZE - 1 | self.session.inWaiting():
-                out_temp = self.session.readline().strip()  # Wait for grbl response
-                if out_temp.find(ok_b) < 0 and out_temp.find(error_b) < 0:
-                    print("  Debug: ", out_temp)  # Debug response
-                else:
-                    grbl_out += out_temp.decode("utf-8")
-                    self.g_count += 1  # Iterate g-code counter
-                    grbl_out += str(self.g_count)
-                    # Add line finished indicator
-                    del self.c_line[
-                        0
-                    ]  # Delete the block character count corresponding to the last 'ok'
-
-            self.session.write(bytes(l_block + "\n", "utf-8"))  # Print g-code block
-        return grbl_out
+            if not isinstance(commands, list):
+                commands = [commands]
+            if not isinstance(commands[0], str):
+                cStrings = [str(c) for c in commands]
+            else:
+                cStrings = commands
+            blocks = [bytes(line, "utf-8") for line in cStrings]
+        return self.streamer.stream(blocks)
+
+
+class WriterStopped(RuntimeError):
+    """
+    Raised by SerialWriter.write once the writer has been stopped
+    """
+
+
+class SerialWriter(threading.Thread):
+    """
+    Streams G-code to a SerialSession from its own thread, fed by a queue,
+    so compiling and the event loop never wait on the serial port.
+    write blocks once maxQueued chunks are waiting, which holds compiling
+    back when it gets too far ahead of the machine.
+    If streaming fails the writer stops, and the error is raised from
+    the next write.
+    Every item written either has its onSent or its onDropped called,
+    the latter when the writer stops or fails before sending it.
+    """
+
+    def __init__(self, session: SerialSession, maxQueued=WRITER_QUEUE_SIZE):
+        super().__init__(name="serial-writer", daemon=True)
+        self.session = session
+        self.queue = queue.Queue(maxsize=maxQueued)
+        self.log = logging.getLogger("writer")
+        # what stopped the writer if streaming failed
+        self.error = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._then = None
+        self._done = False
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+        if self._stopped.is_set():
+            raise WriterStopped("SerialWriter is stopped")
+
+    def write(self, data, commands=None, onSent=None, onDropped=None):
+        """
+        Queue data, anything safeWrite takes, to be streamed.
+        commands are what data was encoded from, logged if GRBL alarms.
+        onSent is called from the writer thread once data is sent, or
+        onDropped instead if the writer stops first.
+        Raises what stopped the writer if it has failed, WriterStopped if
+        it was stopped.
+        """
+        while True:
+            self._check()
+            try:
+                self.queue.put(
+                    (data, commands, onSent, onDropped), timeout=WRITER_POLL
+                )
+                if self._done:
+                    # the writer finished while this was queued, nothing will send it
+                    self._dropQueued()
+                return
+            except queue.Full:
+                pass
+
+    def stop(self, then=None):
+        """
+        Stop once the chunk being streamed is sent, dropping anything still
+        queued, without blocking. then is called from the writer thread
+        once it has stopped, so nothing it writes lands in between the
+        lines of a chunk, or from here if the writer has already stopped.
+        """
+        with self._lock:
+            self._stopped.set()
+            if not self._done:
+                self._then = then if then is not None else self._then
+                then = None
+        self._dropQueued()
+        try:
+            # wakes the writer if it is waiting for the next item
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        if then is not None:
+            then()
+
+    def _dropQueued(self):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                self._drop(item)
+
+    @staticmethod
+    def _drop(item):
+        onDropped = item[3]
+        if onDropped is not None:
+            onDropped()
+
+    def run(self):
+        try:
+            self._stream()
+        finally:
+            with self._lock:
+                self._done = True
+                then = self._then
+            self._dropQueued()
+            if then is not None:
+                then()
+
+    def _stream(self):
+        while not self._stopped.is_set():
+            item = self.queue.get()
+            if item is None:
+                break
+            if self._stopped.is_set():
+                self._drop(item)
+                break
+            data, commands, onSent, _ = item
+            try:
+                if data:
+                    res = self.session.safeWrite(data)
+                    if "ALARM" in res:
+                        self.log.critical(
+                            f"ALARM: {res}\nFrom commands: "
+                            f"{''.join([str(c) for c in commands or []])}"
+                        )
+            except Exception as e:
+                self.log.exception("Serial write failed, stopping the writer")
+                self.error = e
+                self._drop(item)
+                return
+            if onSent is not None:
+                onSent()
+            streamer = getattr(self.session, "streamer", None)
+            if streamer is not None and self.queue.empty():
+                report = streamer.report()
+                self.log.info(
+                    f"Streamed {report['lines']} lines, "
+                    f"{report['linesPerSecond']:.1f} lines/s"
+                )
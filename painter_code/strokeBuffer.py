@@ -0,0 +1,189 @@
+import numpy as np
+from gcode import Command, Flag, toFlagBits
+from const import *
+
+
+class StrokeBuffer:
+    """
+    Columnar (struct-of-arrays) container for the points of a stroke.
+    Used in place of a list of Command objects so the stroke pipeline can
+    work on whole arrays, and converted to and from Command at the edges.
+
+    Parameters
+    ----------
+    x, y, z, f : array-like
+        coordinate and feed rate columns, missing values are NaN
+    flags : array-like | None
+        Flag bitmask for each point
+    kind : array-like | None
+        index into StrokeBuffer.KINDS for each point, defaults to G1
+    i, j : array-like | None
+        arc center offsets for G2/G3 points, NaN for everything else
+    dtype : numpy dtype
+        float type of the coordinate columns, float64 or float32
+    """
+
+    KINDS = ("G1", "G0", "G2", "G3")
+    FLAG_DTYPE = np.uint32
+    KIND_DTYPE = np.uint8
+    COLUMNS = ("x", "y", "z", "f", "flags", "kind", "i", "j")
+
+    def __init__(
+        self,
+        x,
+        y,
+        z=None,
+        f=None,
+        flags=None,
+        kind=None,
+        i=None,
+        j=None,
+        dtype=np.float64,
+    ):
+        self.x = np.asarray(x, dtype=dtype)
+        n = len(self.x)
+        self.y = np.asarray(y, dtype=dtype)
+        self.z = self._column(z, n, np.nan, dtype)
+        self.f = self._column(f, n, np.nan, dtype)
+        self.flags = self._column(flags, n, 0, self.FLAG_DTYPE)
+        self.kind = self._column(kind, n, 0, self.KIND_DTYPE)
+        self.i = self._column(i, n, np.nan, dtype)
+        self.j = self._column(j, n, np.nan, dtype)
+        if not all(len(col) == n for col in self._columns()):
+            raise ValueError("StrokeBuffer columns must all be the same length")
+
+    @staticmethod
+    def _column(values, n, fill, dtype):
+        if values is None:
+            return np.full(n, fill, dtype=dtype)
+        if np.isscalar(values):
+            return np.full(n, values, dtype=dtype)
+        return np.asarray(values, dtype=dtype)
+
+    def _columns(self):
+        return tuple(getattr(self, name) for name in self.COLUMNS)
+
+    def _build(self, columns):
+        return StrokeBuffer(**dict(zip(self.COLUMNS, columns)), dtype=self.dtype)
+
+    @property
+    def dtype(self):
+        return self.x.dtype
+
+    @classmethod
+    def empty(cls, dtype=np.float64):
+        return cls(np.empty(0), np.empty(0), dtype=dtype)
+
+    @classmethod
+    def fromCommands(cls, commands: "list[Command]", dtype=np.float64):
+        """
+        Build a buffer from a list of Command, None coordinates become NaN
+        """
+        nan = float("nan")
+        n = len(commands)
+        x = np.fromiter((nan if c.x is None else c.x for c in commands), dtype, n)
+        y = np.fromiter((nan if c.y is None else c.y for c in commands), dtype, n)
+        z = np.fromiter((nan if c.z is None else c.z for c in commands), dtype, n)
+        f = np.fromiter((nan if c.f is None else c.f for c in commands), dtype, n)
+        flags = np.fromiter((c.flagBits for c in commands), cls.FLAG_DTYPE, n)
+        kind = np.fromiter(
+            (cls.KINDS.index(c.commandType) for c in commands), cls.KIND_DTYPE, n
+        )
+        i = np.fromiter((nan if c.i is None else c.i for c in commands), dtype, n)
+        j = np.fromiter((nan if c.j is None else c.j for c in commands), dtype, n)
+        return cls(x, y, z, f, flags=flags, kind=kind, i=i, j=j, dtype=dtype)
+
+    def toCommands(self) -> "list[Command]":
+        """
+        Convert back to Command objects, NaN coordinates become None
+        """
+        commands = []
+        kinds = self.KINDS
+        for x, y, z, f, flags, kind, i, j in zip(
+            *(self.columnToList(col) for col in (self.x, self.y, self.z)),
+            self.columnToList(self.f, integral=True),
+            self.flags.tolist(),
+            self.kind.tolist(),
+            *(self.columnToList(col) for col in (self.i, self.j)),
+        ):
+            commands.append(
+                Command(x, y, z, f, flags=flags, command=kinds[kind], i=i, j=j)
+            )
+        return commands
+
+    @staticmethod
+    def columnToList(column, integral=False):
+        values = column.tolist()
+        missing = np.isnan(column)
+        present = column[~missing]
+        if integral and np.array_equal(present, np.trunc(present)):
+            # whole number feed rates are written as ints, e.g. F7200 not F7200.0
+            values = [v if v != v else int(v) for v in values]
+        if missing.any():
+            return [None if v != v else v for v in values]
+        return values
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, idx):
+        """
+        Slice, boolean mask or index array, always returns a StrokeBuffer.
+        Like numpy, a slice shares memory with this buffer.
+        """
+        if isinstance(idx, (int, np.integer)):
+            idx = [idx]
+        return self._build(col[idx] for col in self._columns())
+
+    def __repr__(self):
+        return f"StrokeBuffer(points={len(self)}, dtype={self.dtype})"
+
+    def copy(self):
+        return self._build(col.copy() for col in self._columns())
+
+    @classmethod
+    def concat(cls, buffers: "list[StrokeBuffer]"):
+        """
+        Join buffers end to end, None and empty buffers are skipped
+        """
+        buffers = [b for b in buffers if b is not None and len(b)]
+        if not buffers:
+            return cls.empty()
+        return buffers[0]._build(
+            np.concatenate(columns) for columns in zip(*(b._columns() for b in buffers))
+        )
+
+    def hasFlag(self, flag):
+        """
+        Boolean mask of the points that have flag set
+        """
+        return (self.flags & toFlagBits(flag)) != 0
+
+    def isArc(self):
+        """
+        Boolean mask of the G2/G3 points
+        """
+        return np.isin(self.kind, [self.KINDS.index("G2"), self.KINDS.index("G3")])
+
+    def addFlags(self, flags, mask=None):
+        if mask is None:
+            self.flags |= toFlagBits(flags)
+        else:
+            self.flags[mask] |= toFlagBits(flags)
+
+    def xy(self):
+        return np.column_stack((self.x, self.y))
+
+    def segmentLengths(self):
+        """
+        XY distance between consecutive points, len(self) - 1 values
+        """
+        return np.hypot(np.diff(self.x), np.diff(self.y))
+
+    def arcLengths(self):
+        """
+        XY distance along the stroke to each point, a prefix sum of
+        segmentLengths starting at 0, so the length between points a and b
+        is arcLengths[b] - arcLengths[a]
+        """
+        return np.concatenate(([0.0], np.cumsum(self.segmentLengths())))
@@ -1,49 +1,67 @@
+import argparse
+import struct
 import numpy as np
 from PIL import Image
 from pathlib import Path
 import json
 import math
+import wire
 
 ROOT = Path(__file__).parent
+# brush size in mm of each app size index, see Backend._selectBrush
+APP_SIZES = {1: 6.0, 2: 11.0, 3: 14.0}
+# one color per brush holder
+APP_COLORS = range(1, 7)
+# a binary workload is each message, see wire, after its arrival time and length
+FRAME = struct.Struct("<dI")
 
 
 class picConvert:
     def get_image(path):
-        img = Image.open(path)
-        img = img.convert("RGB")
-        return img
+        img = Image.open(path).convert("RGBA")
+        # transparent pixels are white, not whatever color is under the alpha
+        background = Image.new("RGBA", img.size, (255, 255, 255, 255))
+        return Image.alpha_composite(background, img).convert("RGB")
 
     def to_black_and_white(img):
         img = img.convert("L")
         return img
 
-    def main(path):
-        img = get_image(path)
-        img = to_black_and_white(img)
-        img = img.resize((200, 200))
+    def rowStrokes(mask, color, offset):
+        """
+        A message for each run of pixels in a row of mask
+        """
+        strokes = []
+        for row, pixels in enumerate(mask):
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], pixels, [0]))))
+            for start, end in zip(edges[::2], edges[1::2]):
+                strokes.append(
+                    {
+                        "color": color,
+                        "size": "2 6.0",
+                        "data": [
+                            f"{offset[0] + row} {offset[1] + col} 1 116"
+                            for col in range(start, end)
+                        ],
+                    }
+                )
+        return strokes
+
+    def strokes(path, size=(200, 200), offset=(150, 300)):
+        """
+        Messages painting the black pixels of the image at path in color 1
+        and the white in color 2, a stroke along each run of them in a row
+        """
+        img = picConvert.get_image(path)
+        img = picConvert.to_black_and_white(img)
+        img = img.resize(size)
         pixels = np.array(img)
-        # add 300 to the y axis
-        all_data = []
-        json_coords_black = {"color": "1 0xff000000", "size": "2 6.0", "data": []}
-        # find the indicies of black pixels
-        black_pixels = np.where(pixels < 128)
-        # convert the indicies to a list of tuples
-        black_pixels = list(zip(150 + black_pixels[0], 300 + black_pixels[1]))
-        # find the indicies of white pixels
-        white_pixels = np.where(pixels <= 128)
-        # convert the indicies to a list of tuples
-        white_pixels = list(zip(150 + white_pixels[0], 300 + white_pixels[1]))
-
-        json_coords_white = {"color": "2 0xff000000", "size": "2 6.0", "data": []}
-        for x, y in black_pixels:
-            temp_data = json_coords_black.copy()
-            temp_data["data"].append(f"{x} {y} 1 116")
-            all_data.append(temp_data)
-        for x, y in white_pixels:
-            temp_data = json_coords_white.copy()
-            temp_data["data"].append(f"{x} {y} 1 116")
-            all_data.append(temp_data)
-        data = [json_coords_black, json_coords_white]
+        black = picConvert.rowStrokes(pixels < 128, "1 0xff000000", offset)
+        white = picConvert.rowStrokes(pixels >= 128, "2 0xff000000", offset)
+        return black + white
+
+    def main(path):
+        data = picConvert.strokes(path)
         with open(ROOT / "test_from_img.json", "w") as f:
             f.write(json.dumps(data))
         return data
@@ -72,3 +90,190 @@ class CircleStack:
             y = radius * math.sin(math.radians(i)) + center[1]
             data.append(f"{x} {y} 1 116")
         return data
+
+
+class Workload:
+    """
+    Random app format stroke messages, made one at a time as they are
+    iterated over so any number can be streamed to disk. The same seed
+    gives the same messages.
+
+    Strokes wander across bounds with a smoothly turning heading.
+
+    Parameters
+    ----------
+    strokes : int
+        number of messages
+    points : int | tuple
+        points per stroke, or a (min, max) range
+    colors, sizes : dict | None
+        weight of each app color and size index, None for all equally
+    pressureNoise : float
+        standard deviation of the noise on each stroke's pressure
+    overlap : float
+        chance a stroke starts on the stroke before it, painting over it
+    interval : float
+        mean seconds between messages arriving, as a Poisson process,
+        0 for all at once
+    bounds : tuple
+        min x, min y, max x, max y of the strokes in the app's coordinates
+    step : float
+        mm between stroke points
+    curl : float
+        standard deviation in radians of the turn at each point
+    """
+
+    def __init__(
+        self,
+        strokes=100,
+        points=(50, 500),
+        colors=None,
+        sizes=None,
+        pressureNoise=0.05,
+        overlap=0.0,
+        interval=0.0,
+        bounds=(150, 300, 650, 1000),
+        step=1.0,
+        curl=0.05,
+        seed=0,
+    ):
+        self.strokes = strokes
+        self.points = points if isinstance(points, tuple) else (points, points)
+        self.colors = Workload._weights(colors, APP_COLORS)
+        self.sizes = Workload._weights(sizes, APP_SIZES)
+        self.pressureNoise = pressureNoise
+        self.overlap = overlap
+        self.interval = interval
+        self.bounds = np.asarray(bounds, dtype=np.float64)
+        self.step = step
+        self.curl = curl
+        self.seed = seed
+
+    @staticmethod
+    def _weights(weights, choices):
+        if weights is None:
+            weights = dict.fromkeys(choices, 1.0)
+        keys = list(weights)
+        p = np.array([weights[k] for k in keys], dtype=np.float64)
+        return keys, p / p.sum()
+
+    @staticmethod
+    def _fold(values, low, high):
+        # reflect values off low and high until they are between them
+        width = high - low
+        return low + width - np.abs((values - low) % (2 * width) - width)
+
+    def _path(self, rng, start, count):
+        headings = rng.uniform(0, 2 * np.pi) + np.cumsum(
+            rng.normal(0, self.curl, count)
+        )
+        steps = self.step * np.column_stack((np.cos(headings), np.sin(headings)))
+        steps[0] = 0
+        xy = start + np.cumsum(steps, axis=0)
+        minX, minY, maxX, maxY = self.bounds
+        return self._fold(xy[:, 0], minX, maxX), self._fold(xy[:, 1], minY, maxY)
+
+    def __iter__(self):
+        """
+        Yields (arrival seconds, message) with "data" an (n, 4) array of
+        x, y, pressure, speed, see messages for stream lines
+        """
+        rng = np.random.default_rng(self.seed)
+        arrival = 0.0
+        previous = None
+        for _ in range(self.strokes):
+            count = int(rng.integers(self.points[0], self.points[1] + 1))
+            if previous is not None and rng.random() < self.overlap:
+                start = previous[rng.integers(len(previous))]
+            else:
+                start = rng.uniform(self.bounds[:2], self.bounds[2:])
+            x, y = self._path(rng, start, count)
+            pressure = np.clip(
+                rng.uniform(0.2, 0.8) + rng.normal(0, self.pressureNoise, count), 0, 1
+            )
+            speed = np.maximum(rng.uniform(50, 300) + rng.normal(0, 20, count), 0)
+            data = np.column_stack((x, y, pressure, speed))
+            previous = data[:, :2]
+            color = self.colors[0][rng.choice(len(self.colors[0]), p=self.colors[1])]
+            size = self.sizes[0][rng.choice(len(self.sizes[0]), p=self.sizes[1])]
+            if self.interval:
+                arrival += rng.exponential(self.interval)
+            yield arrival, {
+                "color": f"{color} 0xff000000",
+                "size": f"{size} {APP_SIZES[size]}",
+                "data": data,
+            }
+
+    def messages(self):
+        """
+        Yields (arrival seconds, message) with "data" as stream lines,
+        as the app sends them
+        """
+        for arrival, stroke in self:
+            lines = [
+                f"{x:.3f} {y:.3f} {p:.3f} {s:.3f}" for x, y, p, s in stroke["data"]
+            ]
+            yield arrival, dict(stroke, data=lines)
+
+    def write(self, path, binary=None):
+        """
+        Stream the messages to path, as JSON lines with an "arrival" key,
+        or binary if binary or path ends in .bin. Returns the number written.
+        """
+        path = Path(path)
+        if binary is None:
+            binary = path.suffix == ".bin"
+        count = 0
+        with open(path, "wb" if binary else "w") as f:
+            if binary:
+                for arrival, stroke in self:
+                    message = wire.encodeStroke(stroke)
+                    f.write(FRAME.pack(arrival, len(message)))
+                    f.write(message)
+                    count += 1
+            else:
+                for arrival, stroke in self.messages():
+                    f.write(json.dumps(dict(stroke, arrival=arrival)) + "\n")
+                    count += 1
+        return count
+
+    @staticmethod
+    def read(path):
+        """
+        Yields (arrival seconds, message) from a file Workload.write made
+        """
+        path = Path(path)
+        with open(path, "rb") as f:
+            if path.suffix != ".bin":
+                for line in f:
+                    stroke = json.loads(line)
+                    yield stroke.pop("arrival"), stroke
+                return
+            while header := f.read(FRAME.size):
+                arrival, length = FRAME.unpack(header)
+                yield arrival, wire.decodeStroke(f.read(length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a random stroke workload")
+    parser.add_argument("path", help="output, .bin for binary, JSON lines otherwise")
+    parser.add_argument("--strokes", type=int, default=1000)
+    parser.add_argument("--points", type=int, nargs=2, default=(50, 500))
+    parser.add_argument("--pressure-noise", type=float, default=0.05)
+    parser.add_argument("--overlap", type=float, default=0.0)
+    parser.add_argument("--interval", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    workload = Workload(
+        strokes=args.strokes,
+        points=tuple(args.points),
+        pressureNoise=args.pressure_noise,
+        overlap=args.overlap,
+        interval=args.interval,
+        seed=args.seed,
+    )
+    print(f"{workload.write(args.path)} messages written to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
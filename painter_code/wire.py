@@ -0,0 +1,112 @@
+"""
+Binary packed stroke messages, an alternative to the triple nested JSON.
+
+A message is a little-endian header followed by one float32 record of
+x, y, pressure, speed per point:
+
+    magic     4s   b"PBLO"
+    version   B
+    colorIdx  B    the number before the color in the JSON "color" field
+    sizeIdx   B    the number before the size in the JSON "size" field
+    pointilism B   the JSON "pointilism" field
+    color     I    ARGB color, the hex part of the JSON "color" field
+    size      f    brush size, the float part of the JSON "size" field
+    count     I    number of points
+    points    count * 4 * f4
+
+Binary messages are sent as binary websocket frames, JSON messages as text
+frames, so both can arrive on the same connection.
+"""
+import json
+import struct
+import numpy as np
+
+MAGIC = b"PBLO"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBBIfI")
+HEADER_SIZE = HEADER.size
+POINT_DTYPE = np.dtype("<f4")
+# websocket subprotocols offered when connecting, binary preferred
+SUBPROTOCOLS = ["pablo.bin.v1", "pablo.json"]
+
+
+def isBinaryStroke(message) -> bool:
+    return (
+        isinstance(message, (bytes, bytearray, memoryview))
+        and len(message) >= HEADER_SIZE
+        and bytes(message[:4]) == MAGIC
+    )
+
+
+def encodeStroke(stroke: dict) -> bytes:
+    """
+    Pack an app format stroke dict, with "data" as stream lines or an
+    (n, 4) array, into a binary message
+    """
+    colorIdx, color = stroke["color"].split(" ")
+    sizeIdx, size = stroke["size"].split(" ")
+    data = stroke["data"]
+    if not isinstance(data, np.ndarray):
+        lines = [line for line in data if line != ""]
+        data = np.array(
+            [line.split(" ")[:4] for line in lines], dtype=np.float64
+        ).reshape(-1, 4)
+    points = np.ascontiguousarray(data, dtype=POINT_DTYPE)
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        int(colorIdx),
+        int(sizeIdx),
+        int(stroke.get("pointilism", 0)),
+        int(color, 16),
+        float(size),
+        len(points),
+    )
+    return header + points.tobytes()
+
+
+def decodeStroke(message) -> dict:
+    """
+    Unpack a binary message into the app format stroke dict.
+    "data" is an (n, 4) float32 array of x, y, pressure, speed that
+    shares memory with message rather than copying it.
+    """
+    view = memoryview(message)
+    magic, version, colorIdx, sizeIdx, pointilism, color, size, count = (
+        HEADER.unpack_from(view)
+    )
+    if magic != MAGIC:
+        raise ValueError("Not a binary stroke message")
+    if version != VERSION:
+        raise ValueError(f"Unsupported binary stroke version {version}")
+    if len(view) < HEADER_SIZE + count * 4 * POINT_DTYPE.itemsize:
+        raise ValueError(f"Binary stroke message truncated, expected {count} points")
+    points = np.frombuffer(
+        view, dtype=POINT_DTYPE, count=count * 4, offset=HEADER_SIZE
+    ).reshape(count, 4)
+    return {
+        "color": f"{colorIdx} 0x{color:08x}",
+        # size went through float32, round off the noise so 13.3 stays 13.3
+        "size": f"{sizeIdx} {round(size, 4)}",
+        "pointilism": pointilism,
+        "data": points,
+    }
+
+
+def decodeJsonStroke(message) -> dict:
+    """
+    Decode the JSON envelope sent by the server, the stroke and its
+    point list are each JSON encoded strings inside it
+    """
+    decoded = json.loads((json.loads(message))["data"])
+    decoded["data"] = json.loads(decoded["data"])
+    return decoded
+
+
+def decodeMessage(message) -> dict:
+    """
+    Decode either message format into the app format stroke dict
+    """
+    if isBinaryStroke(message):
+        return decodeStroke(message)
+    return decodeJsonStroke(message)
@@ -46,10 +46,14 @@ class PaintPot:
             flags=["required", "paintPot"],
         )
         self._spiralCoords = list(self.spiral_points(separation=2))
+        # spiral scaled to the pot, only depends on the spiral so done once
+        array = np.array(self._spiralCoords)
+        array = (array - np.min(array)) / (np.max(array) - np.min(array))
+        self._swirlOffsets = (array - 0.5) * (POT_DIAMETER - 8)
         self._scrape_c = self._scrape()
         self._enterScrape_c = self._scrape_c[: int(0.5 * len(self._scrape_c))]
 
-    def use(self, nextMove: Command = None):
+    def use(self, nextMove: Command = None, rng=random):
 
         base = (
             self._getToPotCenter()
@@ -61,15 +65,20 @@ class PaintPot:
         if nextMove is None:
             return base
         else:
-            addMove = Command(
-                x=nextMove.x,
-                y=nextMove.y,
-                z=0,
-                f=BASE_FEED_RATE,
-                flags=["contact"],  # have to flag as contact or it wont be mirrored
-            )
+            return base + [self.moveTo(nextMove)]
 
-            return base + [addMove]
+    @staticmethod
+    def moveTo(nextMove: Command):
+        """
+        Travel from the pot to the start of nextMove
+        """
+        return Command(
+            x=nextMove.x,
+            y=nextMove.y,
+            z=0,
+            f=BASE_FEED_RATE,
+            flags=["contact"],  # have to flag as contact or it wont be mirrored
+        )
 
     def _getToPotCenter(self):
         return [
@@ -114,9 +123,7 @@ class PaintPot:
 
     def _swirl(self):
 
-        array = np.array(self._spiralCoords)
-        array = (array - np.min(array)) / (np.max(array) - np.min(array))
-        array = (array - 0.5) * (POT_DIAMETER - 8)
+        array = self._swirlOffsets
         baseZ = BRUSH_TIP_Z_OFFSET + 5
         zOscillate = [baseZ + i for i in range(-2, 2, 1)]
         zOscillateArr = np.repeat(zOscillate, len(array))
@@ -203,12 +210,12 @@ class PaintPot:
 
 
 class PaintPotRandom(PaintPot):
-    def use(self, nextMove: Command = None):
+    def use(self, nextMove: Command = None, rng=random):
         base = (
             self._getToPotCenter()
             # + self._enterScrape_c
             + self._random_points_within_circle(
-                10, (POT_DIAMETER - 8) / 2, (self.x, self.y)
+                10, (POT_DIAMETER - 8) / 2, (self.x, self.y), rng=rng
             )
             + self._scrape()
             + self._exitPot()
@@ -216,15 +223,7 @@ class PaintPotRandom(PaintPot):
         if nextMove is None:
             return base
         else:
-            addMove = Command(
-                x=nextMove.x,
-                y=nextMove.y,
-                z=0,
-                f=BASE_FEED_RATE,
-                flags=["contact"],  # have to flag as contact or it wont be mirrored
-            )
-
-            return base + [addMove]
+            return base + [self.moveTo(nextMove)]
 
     def _scrape(self):
         angles = (0, 180,90, 270)
@@ -259,16 +258,16 @@ class PaintPotRandom(PaintPot):
             )
         return commands
 
-    def _random_points_within_circle(self, num_points, radius, center):
+    def _random_points_within_circle(self, num_points, radius, center, rng=random):
         """generate random points within a circle
-        with given radius and center
+        with given radius and center, rng is the random source
         """
         commands = []
         for i in range(num_points):
             # generate random angle
-            angle = random.uniform(0, 2 * math.pi)
+            angle = rng.uniform(0, 2 * math.pi)
             # generate random radius
-            _r = random.uniform(0, radius)
+            _r = rng.uniform(0, radius)
             # calculate x and y coordinates
             x = center[0] + _r * math.cos(angle)
             y = center[1] + _r * math.sin(angle)
@@ -414,7 +413,7 @@ class Brush:
             to_pot_center,  # maybe change this, we never pick it up and dont add paint
         ]
         for command in self._pickup:
-            command.flags.extend(["required", "brushChange", "pickup"])
+            command.addFlags(["required", "brushChange", "pickup"])
         self._dropoff = [
             get_safe_z,
             get_safe_xy,
@@ -428,7 +427,7 @@ class Brush:
             to_pot_center,  # always refill brush after pickup
         ]
         for command in self._dropoff:
-            command.flags.extend(["required", "brushChange", "drop"])
+            command.addFlags(["required", "brushChange", "drop"])
 
 
 @dataclass
@@ -451,46 +450,100 @@ class PablosHand:
         return f"PablosHand(x={self.x}, y={self.y}, z={self.z}, currentBrush={self.currentBrush})"
 
 
-@dataclass
 class Tracker:
     """
     Tracker class.
     Used to keep track of stroke length for refilling the paint brush
+
+    Only the last `capacity` points are kept, in a ring buffer, so memory
+    stays flat however long the session. If there is a canvas, the moves
+    are drawn when render is called rather than as they are added, as one
+    line for each add or addMany.
     """
 
-    length: float = 0
-    moves: list = None
-    canvas: Image = None
+    def __init__(
+        self, length: float = 0, canvas: Image = None, capacity=TRACKER_CAPACITY
+    ):
+        self.length = length
+        self.canvas = canvas
+        self.capacity = capacity
+        self.last = None  # last move added
+        self.count = 0  # moves added, including those no longer kept
+        self._points = np.empty((capacity, 2), dtype=np.float64)
+        # lines waiting to be drawn, and their total points
+        self._pending = []
+        self._pendingPoints = 0
 
     def __str__(self):
-        return f"Tracker: {self.id} {self.length} {self.moves}"
+        return f"Tracker: {self.length} {self.count} moves"
 
     def __repr__(self):
-        return f"Tracker(id={self.id}, length={self.length}, moves={self.moves})"
+        return f"Tracker(length={self.length}, count={self.count}, last={self.last})"
 
     def add(self, move, color=False):
-        if self.moves is None:
-            self.moves = []
-        if len(self.moves) == 0:
-            self.moves.append(move)
-        else:
-            try:
-                lastMove = self.moves[-1]
-                length = lastMove.distanceTo(move)
-                self.length += length
-                self.moves.append(move)
-
-                ImageDraw.Draw(self.canvas).line(
-                    (lastMove.x, lastMove.y, move.x, move.y),
-                    fill="green" if not color else color,
-                    width=1,
-                )
-            except Exception as e:
-                print(e)
-                print(f"lastMove: {lastMove}")
-                print(f"move: {move}")
-                print(f"length: {length}")
+        if self.last is not None:
+            self.length += self.last.distanceTo(move)
+            self._draw(np.array([(self.last.x, self.last.y), (move.x, move.y)]), color)
+        self._points[self.count % self.capacity] = move.x, move.y
+        self.count += 1
+        self.last = move
+        return self.length
+
+    def addMany(self, moves, color=False):
+        """
+        add for a list of moves at once, the same length as adding them one
+        by one, drawn as a single line through them all
+        """
+        if not moves:
+            return self.length
+        points = np.array([(m.x, m.y) for m in moves], dtype=np.float64)
+        path = points
+        if self.last is not None:
+            path = np.vstack(([self.last.x, self.last.y], points))
+        if len(path) > 1:
+            deltas = np.diff(path, axis=0)
+            self.length += float(np.hypot(deltas[:, 0], deltas[:, 1]).sum())
+            self._draw(path, color)
+        # only the last capacity points fit, older ones are overwritten
+        kept = points[-self.capacity :]
+        start = self.count + len(points) - len(kept)
+        self._points[(start + np.arange(len(kept))) % self.capacity] = kept
+        self.count += len(points)
+        self.last = moves[-1]
         return self.length
 
+    def points(self):
+        """
+        (n, 2) array of the xy of the moves kept, oldest first
+        """
+        if self.count <= self.capacity:
+            return self._points[: self.count].copy()
+        return np.roll(self._points, -(self.count % self.capacity), axis=0)
+
+    def _draw(self, points, color):
+        if self.canvas is None:
+            return
+        self._pending.append((points, color))
+        self._pendingPoints += len(points)
+        # draw now rather than hold more than capacity points
+        if self._pendingPoints > self.capacity:
+            self.render()
+
+    def render(self):
+        """
+        Draw the lines added since the last render onto the canvas
+        """
+        if self._pending:
+            draw = ImageDraw.Draw(self.canvas)
+            for points, color in self._pending:
+                draw.line(points.ravel().tolist(), fill=color or "green", width=1)
+        self._pending = []
+        self._pendingPoints = 0
+
     def show(self):
+        if self.canvas is None:
+            raise RuntimeError(
+                "Tracker has no canvas, make the Backend with drawCanvas=True to see it"
+            )
+        self.render()
         self.canvas.show()